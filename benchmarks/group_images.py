@@ -0,0 +1,88 @@
+"""
+Benchmark grouping a plate's images into imagesets.
+
+Times `splitter._group_images`, which orders the images with a single
+lexsort, against the pandas groupby it replaced, on a synthetic 1536 well
+plate with the images shuffled. Both give the same groups, which is checked
+before timing.
+
+usage: python benchmarks/group_images.py [--sites 9] [--channels 5]
+                                         [--repeats 5]
+"""
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from cptools2 import splitter
+
+# rows A to AF and columns 1 to 48 of a 1536 well plate
+ROWS = [chr(ord("A") + i) for i in range(26)] + \
+       ["A" + chr(ord("A") + i) for i in range(6)]
+COLUMNS = range(1, 49)
+
+
+def make_img_list(sites=9, channels=5, seed=42):
+    """
+    shuffled image paths of a synthetic 1536 well plate, in the old
+    ImageXpress layout
+
+    Parameters:
+    -----------
+    sites: int (default=9)
+        number of sites per well
+    channels: int (default=5)
+        number of channels per site
+    seed: int (default=42)
+        seed of the shuffle
+
+    Returns:
+    --------
+    list of image paths
+    """
+    img_list = ["/plates/plate-1/2024-01-01/1234/val screen_{}{:02d}_s{}_w{}ABCDEF.tif".format(
+                    row, column, site, channel)
+                for row in ROWS for column in COLUMNS
+                for site in range(1, sites + 1)
+                for channel in range(1, channels + 1)]
+    random.Random(seed).shuffle(img_list)
+    return img_list
+
+
+def groupby_images(df_img):
+    """the pandas groupby version of `splitter._group_images`"""
+    grouped_list = []
+    for _, group in df_img.groupby(["Metadata_well", "Metadata_site"]):
+        sort_im = group.sort_values("Metadata_channel", kind="mergesort")
+        grouped_list.append(list(sort_im["img_paths"]))
+    return grouped_list
+
+
+def main(argv=None):
+    """run the benchmark and print the best time of each version"""
+    parser = argparse.ArgumentParser(description="benchmark grouping images "
+                                                 "into imagesets")
+    parser.add_argument("--sites", type=int, default=9)
+    parser.add_argument("--channels", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args(argv)
+    img_list = make_img_list(args.sites, args.channels)
+    df_img = splitter._well_site_table(img_list)
+    assert splitter._group_images(df_img) == groupby_images(df_img)
+    print("{} images, {} imagesets".format(
+        len(img_list), len(ROWS) * len(COLUMNS) * args.sites))
+    times = {}
+    for name, func in [("groupby", groupby_images),
+                       ("lexsort", splitter._group_images)]:
+        times[name] = min(timeit.repeat(lambda: func(df_img),
+                                        number=1, repeat=args.repeats))
+        print("{:>8}: {:.4f}s".format(name, times[name]))
+    print("speed-up: {:.1f}x".format(times["groupby"] / times["lexsort"]))
+
+
+if __name__ == "__main__":
+    main()
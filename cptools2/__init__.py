@@ -1,7 +1,10 @@
 from cptools2 import filelist
+from cptools2 import metadata
+from cptools2 import catalog
 from cptools2 import splitter
 from cptools2 import commands
 from cptools2 import parse_yaml
 from cptools2 import utils
 from cptools2 import job
+from cptools2 import writer
 from cptools2 import colours
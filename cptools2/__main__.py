@@ -1,12 +1,23 @@
 import sys
 import os
+from cptools2 import backends
 from cptools2 import generate_scripts
 from cptools2 import job
+from cptools2 import metrics
 from cptools2 import parse_yaml
+from cptools2 import rerun
+from cptools2 import simulate
+from cptools2 import tune
 from cptools2 import utils
 from cptools2 import colours
 from cptools2.colours import pretty_print
 
+# commands which take their own arguments, e.g `cptools2 tune config.yml`
+SUBCOMMANDS = {"tune": tune.main,
+               "simulate": simulate.main,
+               "rerun": rerun.main,
+               "metrics": metrics.main}
+
 
 def check_arguments():
     """docstring"""
@@ -38,7 +49,10 @@ def configure_job(config):
     ---------
     nothing, saves commands and scripts to disk
     """
-    jobber = job.Job(is_new_ix=config.is_new_ix)
+    jobber = job.Job(is_new_ix=config.is_new_ix,
+                     n_workers=config.n_workers,
+                     index_location=config.index_location,
+                     streaming=config.streaming)
     # some of the optional arguments might be none if that option was not present in the
     # configuration file, in which case don't pass them as arguments to the methods
     if config.experiment_args is not None:
@@ -47,19 +61,27 @@ def configure_job(config):
         jobber.remove_plate(**config.remove_plate_args)
     if config.add_plate_args is not None:
         jobber.add_plate(**config.add_plate_args)
+    if config.subset_args is not None:
+        jobber.select_imagesets(**config.subset_args)
+    if config.channel_args is not None:
+        jobber.select_channels(**config.channel_args)
     if config.chunk_args is not None:
         jobber.chunk(**config.chunk_args)
     jobber.create_commands(**config.create_command_args)
 
 
-def make_scripts(config_file):
+def make_scripts(config_file, backend=None):
     """
-    creates the qsub scripts
+    creates the submission scripts, or with the local backend runs the
+    commands
 
     Parameters:
     -----------
     config_file: string
         path to configuration file
+    backend: backends.Backend (default=None)
+        scheduler backend, if None then uses the scheduler in the
+        configuration file
 
     Returns:
     ---------
@@ -67,24 +89,37 @@ def make_scripts(config_file):
     """
     yaml_dict = parse_yaml.open_yaml(config_file)
     config = parse_yaml.parse_config_file(config_file)
+    if backend is None:
+        backend = backends.get_backend(**config.scheduler_args)
     commands_location = config.create_command_args["commands_location"]
     commands_line_count = generate_scripts.lines_in_commands(commands_location)
+    if commands_line_count["staging"] == 0:
+        # every job was found in the result cache
+        pretty_print("no jobs left to run")
+        return
     logfile_location = os.path.join(yaml_dict["location"], "logfiles")
-    generate_scripts.make_qsub_scripts(commands_location, commands_line_count,
-                                       logfile_location=logfile_location)
+    backend.launch(commands_location, commands_line_count,
+                   logfile_location=logfile_location,
+                   tasks_per_job=config.tasks_per_job,
+                   prefetch=config.prefetch,
+                   analysis_memory=config.analysis_memory)
 
 
 def main():
     """run cptools.job.Job on a yaml file containing arguments"""
     check_arguments()
-    if not utils.on_staging_node():
-        raise EddieNodeError("Not on a staging node, cannot access datastore")
+    if sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        return
     # parse yaml file into a dictionary
     config_file = check_config_file()
     pretty_print("parsing config file {}".format(colours.yellow(config_file)))
     config = parse_yaml.parse_config_file(config_file)
+    backend = backends.get_backend(**config.scheduler_args)
+    if backend.requires_staging_node and not utils.on_staging_node():
+        raise EddieNodeError("Not on a staging node, cannot access datastore")
     configure_job(config)
-    make_scripts(config_file)
+    make_scripts(config_file, backend=backend)
     pretty_print("DONE!")
 
 
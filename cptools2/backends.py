@@ -0,0 +1,583 @@
+"""
+Scheduler backends which run the staging, analysis and destaging commands.
+
+The cluster backends (SGE and SLURM) write array job submission scripts and a
+`SUBMIT_JOBS.sh` script which submits them in the right order. The local
+backend runs the commands on the current machine instead, with a limit on
+how many commands of each phase run at once.
+"""
+
+import os
+import subprocess
+import textwrap
+import threading
+import time
+from concurrent import futures
+from datetime import datetime
+
+from cptools2 import colours, generate_scripts, metrics, result_cache, utils
+from cptools2.colours import pretty_print
+
+# phases in the order they are run for each chunk, and their commands files
+PHASES = ["staging", "analysis", "destaging"]
+COMMAND_FILES = {"staging": "staging",
+                 "analysis": "cp_commands",
+                 "destaging": "destaging"}
+
+
+class Backend(object):
+    """
+    Base class for scheduler backends.
+
+    `requires_staging_node` is True if the commands have to be generated on
+    a node which can access the datastore.
+    """
+
+    name = None
+    requires_staging_node = False
+
+    def launch(self, commands_location, commands_count_dict, logfile_location,
+               tasks_per_job=1, prefetch=None, analysis_memory="12G"):
+        """
+        create submission scripts for, or run, the commands in
+        `commands_location`
+
+        Parameters:
+        -----------
+        commands_location: string
+            path to directory that contains staging, cp_commands, and
+            destaging command files.
+        commands_count_dict: dictionary
+            dictionary of the number of commands contain in each of the jobs
+        logfile_location: string
+            where to store the log files
+        tasks_per_job: int (default=1)
+            number of commands to run in each array task
+        prefetch: int (default=None)
+            if not None then stage, analyse and destage each chunk in a
+            single pipelined job, staging up to `prefetch` chunks ahead of
+            the one being analysed. See `generate_scripts.pipelined_loop_text`
+        analysis_memory: string (default="12G")
+            memory to request for each analysis task, not used when running
+            locally
+
+        Returns:
+        --------
+        nothing
+        """
+        raise NotImplementedError
+
+
+class SGE(Backend):
+    """Sun Grid Engine array jobs, submitted with qsub"""
+
+    name = "sge"
+    requires_staging_node = True
+
+    def launch(self, commands_location, commands_count_dict, logfile_location,
+               tasks_per_job=1, prefetch=None, analysis_memory="12G"):
+        if prefetch is not None:
+            generate_scripts.make_pipelined_qsub_scripts(
+                commands_location, commands_count_dict,
+                logfile_location=logfile_location,
+                tasks_per_job=tasks_per_job, prefetch=prefetch,
+                analysis_memory=analysis_memory)
+        else:
+            generate_scripts.make_qsub_scripts(commands_location,
+                                               commands_count_dict,
+                                               logfile_location=logfile_location,
+                                               tasks_per_job=tasks_per_job,
+                                               analysis_memory=analysis_memory)
+
+
+class SLURM(Backend):
+    """
+    SLURM array jobs, submitted with sbatch.
+
+    Each array task of the analysis job is released either by the matching
+    staging task succeeding (`aftercorr`) or, failing that, once the whole
+    staging job has ended (`afterany`). An `aftercorr` dependency alone is
+    never satisfied by a staging task which fails, runs out of time or loses
+    its node, leaving the analysis job queued forever, whereas SGE's
+    -hold_jid_ad runs the next phase whatever the exit status.
+
+    In the same way a chunk has to be destaged even if its analysis failed,
+    otherwise its images are left on scratch, so each destaging task is
+    released either by its analysis succeeding or once the whole analysis
+    job has ended. With more than one pipeline there is an analysis job per
+    pipeline, and each chunk is only destaged once every pipeline has
+    analysed it.
+    """
+
+    name = "slurm"
+
+    def launch(self, commands_location, commands_count_dict, logfile_location,
+               tasks_per_job=1, prefetch=None, analysis_memory="12G"):
+        cmd_path = generate_scripts.make_command_paths(commands_location)
+        generate_scripts.write_command_indices(commands_location)
+        time_now = str(datetime.now().replace(microsecond=0)).replace(" ", "-")
+        job_file = "slurm_{}".format(time_now)
+        generate_scripts.record_job(commands_location, job_file)
+        n_commands = commands_count_dict["staging"]
+        n_pipelines = generate_scripts.n_pipelines(commands_count_dict)
+        n_tasks = generate_scripts.n_array_tasks(n_commands, tasks_per_job)
+        task_id = "$SLURM_ARRAY_TASK_ID"
+        scripts = {}
+        if prefetch is not None:
+            text = _slurm_header("pipeline", memory=analysis_memory, n_tasks=n_tasks,
+                                 output=os.path.join(logfile_location, "analysis"))
+            text += generate_scripts.load_module_text()
+            text += generate_scripts.pipelined_loop_text(
+                cmd_path, n_commands, logfile_location=logfile_location,
+                job_file=job_file, tasks_per_job=tasks_per_job,
+                prefetch=prefetch, task_id=task_id,
+                job_id="$SLURM_ARRAY_JOB_ID", n_pipelines=n_pipelines)
+            scripts["pipeline"] = text
+        else:
+            for phase in ["staging", "destaging"]:
+                text = _slurm_header(phase, memory="1G", n_tasks=n_tasks,
+                                     output=os.path.join(logfile_location, phase),
+                                     max_running=20 if phase == "staging" else None)
+                body = generate_scripts.command_lookup_text(
+                    cmd_path[COMMAND_FILES[phase]], task_id="$COMMAND_NUM")
+                body += generate_scripts.transfer_text(
+                    phase, 'bash -c "$SEED"',
+                    generate_scripts.metrics_dir(logfile_location, phase, job_file),
+                    job_id="$SLURM_ARRAY_JOB_ID")
+                text += generate_scripts.command_loop_text(
+                    body, commands_count_dict[COMMAND_FILES[phase]],
+                    tasks_per_job=tasks_per_job, task_id=task_id)
+                scripts[phase] = text
+            for pipeline_num, name in enumerate(
+                    generate_scripts.analysis_names(n_pipelines)):
+                text = _slurm_header(name, memory=analysis_memory, n_tasks=n_tasks,
+                                     output=os.path.join(logfile_location, "analysis"))
+                text += generate_scripts.load_module_text()
+                body = generate_scripts.analysis_text(
+                    cmd_path["cp_commands"], logfile_location,
+                    job_file=job_file, n_tasks=n_tasks,
+                    line_offset=pipeline_num * n_commands,
+                    job_id="$SLURM_ARRAY_JOB_ID")
+                text += generate_scripts.command_loop_text(body, n_commands,
+                                                           tasks_per_job=tasks_per_job,
+                                                           task_id=task_id)
+                scripts[name] = text
+        script_paths = {}
+        for name, text in scripts.items():
+            script_paths[name] = os.path.join(
+                commands_location, "{}_{}_script.sh".format(time_now, name))
+            with open(script_paths[name], "w") as f:
+                f.write(text)
+        submit_script = _slurm_submit_script(commands_location, time_now,
+                                             script_paths)
+        pretty_print("saving master submission script at {}".format(colours.yellow(submit_script)))
+        utils.make_executable(submit_script)
+
+
+def _slurm_header(phase, memory, n_tasks, output, max_running=None):
+    """
+    #SBATCH options for an array job
+
+    Parameters:
+    -----------
+    phase: string
+        name of the job
+    memory: string
+        memory per task, e.g "1G"
+    n_tasks: int
+        number of array tasks
+    output: string
+        directory in which to store the task's stdout and stderr
+    max_running: int (default=None)
+        maximum number of array tasks to run at once
+
+    Returns:
+    --------
+    string
+    """
+    array = "1-{}".format(n_tasks)
+    if max_running is not None:
+        array += "%{}".format(max_running)
+    return textwrap.dedent(
+        """\
+        #!/bin/bash
+        #SBATCH --job-name={phase}
+        #SBATCH --mem={memory}
+        #SBATCH --array={array}
+        #SBATCH --output={output}/%x_%A_%a.out
+        """.format(phase=phase, memory=memory, array=array, output=output)
+    )
+
+
+def _slurm_submit_script(commands_location, job_date, script_paths):
+    """
+    Create a shell script which submits the staging, analysis and destaging
+    scripts with sbatch, each depending on the previous one, or the single
+    pipelined script.
+
+    Parameters:
+    -----------
+    commands_location: string
+        path to where the commands are stored
+    job_date: string
+        date for the submission scripts
+    script_paths: dict
+        paths to the staging, analysis and destaging scripts, or to a
+        single pipeline script. With more than one pipeline the analysis
+        scripts are "analysis_0", "analysis_1" etc.
+
+    Returns:
+    --------
+    path to submit_script
+    also writes script to disk in `commands_location`.
+    """
+    if "pipeline" in script_paths:
+        sbatch_lines = "sbatch {}".format(script_paths["pipeline"])
+    else:
+        names = [name for name in script_paths if name.startswith("analysis")]
+        lines = ["STAGING_ID=$(sbatch --parsable {} | cut -d ';' -f 1)".format(
+            script_paths["staging"])]
+        analysis_ids = []
+        # each task waits for the same task of the previous phase to
+        # succeed, or else for the previous phase's jobs to end, so a task
+        # which failed doesn't hold up the rest of its chunk forever
+        for name in names:
+            analysis_id = name.upper() + "_ID"
+            lines.append('{}=$(sbatch --parsable '
+                         '--dependency=aftercorr:"$STAGING_ID"?afterany:"$STAGING_ID" '
+                         "{} | cut -d ';' -f 1)".format(analysis_id,
+                                                        script_paths[name]))
+            analysis_ids.append('"${}"'.format(analysis_id))
+        analysis_ids = ":".join(analysis_ids)
+        lines.append("sbatch --dependency=aftercorr:{0}?afterany:{0} {1}".format(
+            analysis_ids, script_paths["destaging"]))
+        sbatch_lines = "\n".join(lines)
+    output = textwrap.dedent(
+        """\
+        #!/bin/sh
+
+        # This script submits the job scripts in the correct order
+
+        # NOTE: run this as a shell script, NOT a submission script
+        # so either call `./name_of_script` or `bash name_of_script`
+
+        """)
+    output += sbatch_lines + "\n"
+    save_location = "{}/{}_SUBMIT_JOBS.sh".format(commands_location, job_date)
+    with open(save_location, "w") as f:
+        f.write(output)
+    return save_location
+
+
+class Local(Backend):
+    """
+    Run the commands on this machine.
+
+    Each chunk is staged, analysed and then destaged, with the phases of
+    different chunks overlapping. At most `n_workers[phase]` commands of each
+    phase run at once. As with the array jobs the analysis of a chunk
+    only waits for its own staging, and each command's output and metrics
+    go to `logfile_location/<phase>`. With more than one pipeline each chunk is
+    analysed by every pipeline at once, and destaged once they have all
+    finished.
+
+    Parameters:
+    -----------
+    n_workers: int or dict (default=None)
+        number of commands to run at once for each phase. Either a single
+        number for every phase or a dictionary with the keys "staging",
+        "analysis" and "destaging", missing phases use the defaults in
+        `Local.DEFAULT_WORKERS`.
+    """
+
+    name = "local"
+    DEFAULT_WORKERS = {"staging": 2,
+                       "analysis": os.cpu_count() or 1,
+                       "destaging": 2}
+
+    def __init__(self, n_workers=None):
+        if n_workers is None:
+            n_workers = {}
+        if isinstance(n_workers, int):
+            n_workers = {phase: n_workers for phase in PHASES}
+        bad_phases = set(n_workers) - set(PHASES)
+        if bad_phases:
+            raise BackendError("unknown phase(s): {}".format(sorted(bad_phases)))
+        self.n_workers = dict(self.DEFAULT_WORKERS)
+        self.n_workers.update(n_workers)
+        if any(int(i) < 1 for i in self.n_workers.values()):
+            raise BackendError("need at least one worker per phase")
+        self.lock = threading.Lock()
+
+    def launch(self, commands_location, commands_count_dict, logfile_location,
+               tasks_per_job=1, prefetch=None, analysis_memory="12G"):
+        if prefetch is not None:
+            return self.launch_pipelined(commands_location, commands_count_dict,
+                                         logfile_location,
+                                         tasks_per_job=tasks_per_job,
+                                         prefetch=prefetch)
+        # there's no scheduling overhead to amortise, so tasks_per_job
+        # doesn't change anything here
+        cmd_path = generate_scripts.make_command_paths(commands_location)
+        commands = {}
+        for phase in PHASES:
+            with open(cmd_path[COMMAND_FILES[phase]]) as f:
+                commands[phase] = [i.rstrip("\n") for i in f if i.strip()]
+        markers = None
+        markers_loc = result_cache.markers_path(commands_location)
+        if os.path.isfile(markers_loc):
+            with open(markers_loc) as f:
+                markers = [i.rstrip("\n") for i in f if i.strip()]
+        time_now = str(datetime.now().replace(microsecond=0)).replace(" ", "-")
+        log_file = os.path.join(logfile_location, "local_{}.log".format(time_now))
+        generate_scripts.record_job(commands_location, "local_{}".format(time_now))
+        pretty_print("running {} jobs locally".format(
+            colours.yellow(len(commands["analysis"]))))
+        results = self.run(commands, logfile_location, log_file,
+                           markers=markers)
+        n_failed = sum(1 for i in results["analysis"] if i != 0)
+        pretty_print("{} of {} analysis jobs failed".format(
+            colours.yellow(n_failed), colours.yellow(len(results["analysis"]))))
+
+    def launch_pipelined(self, commands_location, commands_count_dict,
+                         logfile_location, tasks_per_job=1, prefetch=1):
+        """
+        run the commands as `n_workers["analysis"]` pipelined workers, each
+        staging up to `prefetch` chunks ahead of the one it's analysing.
+
+        If `tasks_per_job` is 1 then the chunks are split evenly between the
+        workers, otherwise each worker takes `tasks_per_job` chunks at a
+        time.
+        """
+        cmd_path = generate_scripts.make_command_paths(commands_location)
+        generate_scripts.write_command_indices(commands_location)
+        time_now = str(datetime.now().replace(microsecond=0)).replace(" ", "-")
+        n_commands = commands_count_dict["staging"]
+        n_workers = self.n_workers["analysis"]
+        if tasks_per_job == 1:
+            tasks_per_job = generate_scripts.n_array_tasks(n_commands, n_workers)
+        n_tasks = generate_scripts.n_array_tasks(n_commands, tasks_per_job)
+        generate_scripts.record_job(commands_location, "local_{}".format(time_now))
+        script = generate_scripts.pipelined_loop_text(
+            cmd_path, n_commands, logfile_location=logfile_location,
+            job_file="local_{}".format(time_now), tasks_per_job=tasks_per_job,
+            prefetch=prefetch, task_id="$1", job_id="local",
+            n_pipelines=generate_scripts.n_pipelines(commands_count_dict))
+        script_path = os.path.join(commands_location,
+                                   "{}_pipeline_local.sh".format(time_now))
+        with open(script_path, "w") as f:
+            f.write("#!/bin/bash\n" + script)
+        for phase in PHASES:
+            utils.make_dir(os.path.join(logfile_location, phase))
+        pretty_print("running {} jobs locally in {} pipelines".format(
+            colours.yellow(n_commands), colours.yellow(n_tasks)))
+        # each analysis is timed and logged by the script itself
+        with futures.ThreadPoolExecutor(n_workers) as executor:
+            returncodes = list(executor.map(
+                lambda task: _run_command(
+                    "bash {} {}".format(script_path, task),
+                    os.path.join(logfile_location, "analysis",
+                                 "local.o{}".format(task)))[0],
+                range(1, n_tasks + 1)))
+        return returncodes
+
+    def run(self, commands, logfile_location, log_file, markers=None):
+        """
+        run every chunk's staging, analysis and destaging commands
+
+        Parameters:
+        -----------
+        commands: dict
+            lists of commands for each phase, the staging and destaging
+            commands with an entry per chunk, and the analysis commands with
+            a block of an entry per chunk for each pipeline
+        logfile_location: string
+            directory in which to store the output of each command
+        log_file: string
+            path to log file recording whether each analysis succeeded, in
+            the same format as the array job log
+        markers: list (default=None)
+            result cache marker of each analysis command, written when the
+            analysis succeeds. If None then there is no result cache
+
+        Returns:
+        --------
+        dictionary of the list of return codes for each phase
+        """
+        n_chunks = len(commands["staging"])
+        n_analyses = len(commands["analysis"])
+        if len(commands["destaging"]) != n_chunks or \
+                (n_chunks == 0 and n_analyses > 0) or \
+                (n_chunks > 0 and n_analyses % n_chunks != 0):
+            raise BackendError("commands files contain differing number of lines")
+        if markers is not None and len(markers) != n_analyses:
+            raise BackendError("result cache markers don't match the analysis commands")
+        n_pipelines = n_analyses // n_chunks if n_chunks else 1
+        for phase in PHASES:
+            utils.make_dir(os.path.join(logfile_location, phase))
+        results = {phase: [None] * len(commands[phase]) for phase in PHASES}
+        # analyses still running for each chunk, and whether any raised
+        remaining = [n_pipelines] * n_chunks
+        errored = [False] * n_chunks
+        counter_lock = threading.Lock()
+        finished = threading.Semaphore(0)
+        executors = {phase: futures.ThreadPoolExecutor(self.n_workers[phase])
+                     for phase in PHASES}
+        job_file = os.path.splitext(os.path.basename(log_file))[0]
+
+        def output_path(phase, line):
+            return os.path.join(logfile_location, phase,
+                                "local.o{}".format(line + 1))
+
+        def submit(phase_num, chunk):
+            phase = PHASES[phase_num]
+            lines = [chunk]
+            if phase == "analysis":
+                lines = [chunk + i * n_chunks for i in range(n_pipelines)]
+            for line in lines:
+                command = commands[phase][line]
+                if phase == "staging":
+                    command = generate_scripts.rsync_stats_text(command)
+                    command += 'exit "$RETURN_VAL"\n'
+                future = executors[phase].submit(_run_command, command,
+                                                 output_path(phase, line))
+                future.add_done_callback(
+                    lambda f, line=line: done(phase_num, chunk, line, f))
+
+        def done(phase_num, chunk, line, future):
+            phase = PHASES[phase_num]
+            ok = True
+            try:
+                returncode, wall_time, max_rss = future.result()
+                results[phase][line] = returncode
+                self._record_metrics(logfile_location, job_file, phase,
+                                     chunk, line, returncode, wall_time,
+                                     max_rss, output_path(phase, line))
+                if phase == "analysis":
+                    self._log(log_file, line + 1, returncode, wall_time,
+                              max_rss)
+                    if markers is not None and returncode == 0:
+                        result_cache.record_success(markers[line])
+            except Exception as err:
+                results[phase][line] = err
+                ok = False
+            if phase == "analysis":
+                # only move on once every pipeline has analysed the chunk
+                with counter_lock:
+                    remaining[chunk] -= 1
+                    errored[chunk] = errored[chunk] or not ok
+                    if remaining[chunk] > 0:
+                        return
+                    ok = not errored[chunk]
+            if ok and phase_num + 1 < len(PHASES):
+                try:
+                    submit(phase_num + 1, chunk)
+                    return
+                except Exception as err:
+                    results[PHASES[phase_num + 1]][chunk] = err
+            finished.release()
+
+        try:
+            for chunk in range(n_chunks):
+                submit(0, chunk)
+            for _ in range(n_chunks):
+                finished.acquire()
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+        return results
+
+    def _record_metrics(self, logfile_location, job_file, phase, chunk, line,
+                        returncode, wall_time, max_rss, output):
+        """
+        record a command's metrics in the same format as the array jobs, see
+        `generate_scripts.transfer_text`
+        """
+        end = time.time()
+        record = {"phase": phase, "job": "local", "command": line + 1,
+                  "start": round(end - wall_time, 3), "end": round(end, 3),
+                  "duration": round(wall_time, 3), "status": returncode}
+        if phase == "staging":
+            with open(output) as f:
+                record["files"], record["bytes"] = metrics.rsync_stats(f.read())
+        elif phase == "analysis":
+            record["chunk"] = chunk + 1
+            record["max_rss"] = max_rss
+        metrics.write_record(
+            generate_scripts.metrics_dir(logfile_location, phase, job_file),
+            record)
+
+    def _log(self, log_file, command_num, returncode, wall_time, max_rss):
+        """record the outcome, wall time and peak memory of an analysis command"""
+        if returncode == 0:
+            status = "Finished"
+        else:
+            status = "Failed with error code: {}".format(returncode)
+        line = "{}  local  {}  {}  {}  {}\n".format(
+            datetime.now().strftime("%Y-%m-%d %H:%M"), command_num, status,
+            int(round(wall_time)), max_rss)
+        with self.lock:
+            with open(log_file, "a") as f:
+                f.write(line)
+
+
+def _run_command(command, output):
+    """
+    run a shell command, saving its stdout and stderr
+
+    Parameters:
+    -----------
+    command: string
+        command to run with bash
+    output: string
+        file in which to save the command's output
+
+    Returns:
+    --------
+    tuple of the return code of the command, its wall time in seconds and
+    its peak memory use in kilobytes
+    """
+    start = time.time()
+    with open(output, "w") as f:
+        proc = subprocess.Popen(["bash", "-c", command], stdout=f,
+                                stderr=subprocess.STDOUT)
+        # wait4 rather than proc.wait() to get the child's resource usage
+        _, status, rusage = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode, time.time() - start, rusage.ru_maxrss
+
+
+BACKENDS = {backend.name: backend for backend in [SGE, SLURM, Local]}
+
+
+def get_backend(name="sge", n_workers=None):
+    """
+    create a scheduler backend from its name
+
+    Parameters:
+    -----------
+    name: string (default="sge")
+        one of "sge", "slurm" or "local"
+    n_workers: int or dict (default=None)
+        number of commands to run at once for each phase, only used by the
+        local backend
+
+    Returns:
+    --------
+    Backend
+    """
+    name = str(name).lower()
+    if name not in BACKENDS:
+        msg = "unknown scheduler '{}', expected one of {}".format(
+            name, sorted(BACKENDS))
+        raise BackendError(msg)
+    if name == Local.name:
+        return Local(n_workers=n_workers)
+    return BACKENDS[name]()
+
+
+class BackendError(Exception):
+    pass
@@ -0,0 +1,426 @@
+"""
+A per-plate catalog of images and their parsed metadata.
+
+The catalog is built once per plate and carries the parsed metadata through
+chunking, LoadData creation and command generation, so image paths are never
+parsed more than once. Chunks are represented as ranges of imagesets
+rather than nested lists of image paths.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from cptools2 import filelist, loaddata, metadata, splitter
+
+
+class ImageCatalog(object):
+    """
+    Images from a single plate, sorted into imagesets.
+
+    An imageset is all the channels of a single well and site. Rows of
+    `images` are sorted by well, site and then channel so each imageset is a
+    contiguous block of rows, imageset `i` spanning rows
+    `offsets[i]:offsets[i+1]`.
+
+    Directory-level metadata (plate name and number) is stored once per
+    image directory in `directories` rather than once per image.
+
+    File sizes are only known once `stat` has been called, until then
+    `sizes` is None.
+    """
+
+    def __init__(self, img_list, is_new_ix=False):
+        images, directories = metadata.parse_img_table(img_list,
+                                                       is_new_ix=is_new_ix)
+        order, offsets = splitter.imageset_order(images)
+        self.images = images.iloc[order].reset_index(drop=True)
+        self.directories = directories
+        self.offsets = offsets
+        self.sizes = None
+
+    def __len__(self):
+        """number of imagesets"""
+        return len(self.offsets) - 1
+
+    @property
+    def n_images(self):
+        """number of images"""
+        return self.images.shape[0]
+
+    def _row_slice(self, start=0, stop=None):
+        """convert a range of imagesets to a slice of image rows"""
+        if stop is None:
+            stop = len(self)
+        return slice(self.offsets[start], self.offsets[stop])
+
+    def chunks(self, job_size):
+        """
+        split the imagesets into ranges of `job_size` imagesets
+
+        Parameters:
+        -----------
+        job_size: int
+            number of imagesets per chunk
+
+        Returns:
+        --------
+        list of (start, stop) imageset ranges, the last of which may contain
+        fewer than `job_size` imagesets
+        """
+        n_imagesets = len(self)
+        return [(i, min(i + job_size, n_imagesets))
+                for i in range(0, n_imagesets, job_size)]
+
+    def _keep(self, keep):
+        """
+        keep only the images where `keep` is True, dropping any imagesets
+        left without images, and return the paths of the dropped images
+        """
+        imageset = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+        counts = np.bincount(imageset[keep], minlength=len(self))
+        dropped = self.images["img_paths"].to_numpy()[~keep].tolist()
+        self.images = self.images[keep].reset_index(drop=True)
+        self.offsets = np.append(0, np.cumsum(counts[counts > 0]))
+        if self.sizes is not None:
+            self.sizes = self.sizes[keep]
+        return dropped
+
+    def select_channels(self, channels):
+        """
+        drop the images of every channel not in `channels`, along with any
+        imagesets left without images
+
+        Parameters:
+        -----------
+        channels: list of int
+            channel numbers to keep
+
+        Returns:
+        --------
+        list of the paths of the dropped images
+        """
+        keep = np.isin(self.images["Metadata_channel"].to_numpy(), list(channels))
+        if len(self) > 0 and not keep.any():
+            raise ValueError("none of the channels {} were found".format(
+                sorted(channels)))
+        return self._keep(keep)
+
+    def select_imagesets(self, wells=None, rows=None, columns=None,
+                         sites=None, timepoints=None):
+        """
+        drop every imageset which isn't in the given wells, rows, columns,
+        sites and timepoints. Each filter which is None is not applied.
+
+        Wells are parsed once per unique well rather than once per image.
+
+        Parameters:
+        -----------
+        wells: list of strings (default=None)
+            wells to keep, e.g ["B02", "C3"]
+        rows: list of strings (default=None)
+            well rows to keep, e.g ["B", "C"]
+        columns: list of int (default=None)
+            well columns to keep
+        sites: list of int (default=None)
+            sites to keep
+        timepoints: list of int (default=None)
+            timepoints to keep, from the TimePoint_n directories of the new
+            ImageXpress paths. Images without a timepoint directory are
+            timepoint 1
+
+        Returns:
+        --------
+        list of the paths of the dropped images
+        """
+        keep = np.ones(self.n_images, dtype=bool)
+        well_codes, unique_wells = pd.factorize(self.images["Metadata_well"])
+        well_row, well_col = _split_wells(unique_wells)
+        if wells is not None:
+            wanted = set(zip(*_split_wells(wells)))
+            unique_keep = np.array([i in wanted for i in zip(well_row, well_col)],
+                                   dtype=bool)
+            keep &= unique_keep[well_codes]
+        if rows is not None:
+            wanted_rows = [str(i).upper() for i in rows]
+            keep &= np.isin(well_row, wanted_rows)[well_codes]
+        if columns is not None:
+            keep &= np.isin(well_col, [int(i) for i in columns])[well_codes]
+        if sites is not None:
+            keep &= np.isin(self.images["Metadata_site"].to_numpy(),
+                            [int(i) for i in sites])
+        if timepoints is not None:
+            dir_timepoints = self.directories["path"].str.extract(
+                r"TimePoint_([0-9]+)$", expand=False).fillna(1).astype(int)
+            dir_keep = np.isin(dir_timepoints.to_numpy(),
+                               [int(i) for i in timepoints])
+            keep &= dir_keep[self.images["dir_code"].to_numpy()]
+        return self._keep(keep)
+
+    def stat(self, root="", n_workers=None):
+        """
+        look up the size of every image file
+
+        Parameters:
+        -----------
+        root: string (default="")
+            directory the image paths are relative to, i.e the experiment
+            directory if the paths were truncated by `files_from_plate`
+        n_workers: int (default=None)
+            number of files to stat at once, if None then uses
+            `filelist.N_WORKERS`
+
+        Returns:
+        --------
+        nothing, sets `sizes` to an array of file sizes in bytes, in the
+        same order as the rows of `images`
+        """
+        img_list = [os.path.join(root, i) for i in self.img_list()]
+        sizes = filelist.file_sizes(img_list, n_workers=n_workers)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+
+    def imageset_bytes(self):
+        """
+        total size in bytes of each imageset, requires `stat` to have been
+        called
+
+        Returns:
+        --------
+        numpy array of integers, one per imageset
+        """
+        if self.sizes is None:
+            raise ValueError("file sizes unknown, call ImageCatalog.stat() first")
+        cum_sizes = np.concatenate([[0], np.cumsum(self.sizes)])
+        return np.diff(cum_sizes[self.offsets])
+
+    def n_bytes(self, start=0, stop=None):
+        """
+        total size in bytes of the images in a range of imagesets, or None
+        if the file sizes are unknown
+        """
+        if self.sizes is None:
+            return None
+        return int(self.sizes[self._row_slice(start, stop)].sum())
+
+    def chunks_by_size(self, max_bytes, job_size=None):
+        """
+        split the imagesets into ranges of roughly equal total size, each no
+        larger than `max_bytes` unless it's a single imageset, and with no
+        more than `job_size` imagesets. Requires `stat` to have been called.
+
+        The fewest chunks which satisfy both limits are used, and the
+        boundaries between them are placed as close as possible to equal
+        shares of the plate's total bytes, so there's no small
+        leftover chunk at the end.
+
+        Parameters:
+        -----------
+        max_bytes: int
+            maximum number of bytes per chunk
+        job_size: int (default=None)
+            maximum number of imagesets per chunk, if None then chunks are
+            only limited by size
+
+        Returns:
+        --------
+        list of (start, stop) imageset ranges
+        """
+        if max_bytes < 1:
+            raise ValueError("max_bytes has to be at least 1")
+        n_imagesets = len(self)
+        if n_imagesets == 0:
+            return []
+        cum_bytes = np.concatenate([[0], np.cumsum(self.imageset_bytes())])
+        total = cum_bytes[-1]
+        if total == 0:
+            return self.chunks(job_size or n_imagesets)
+        n_chunks = -(-total // max_bytes)
+        if job_size is not None:
+            n_chunks = max(n_chunks, -(-n_imagesets // job_size))
+        while n_chunks <= n_imagesets:
+            targets = total * np.arange(1, n_chunks) / n_chunks
+            # imageset boundary nearest to each target
+            idx = np.searchsorted(cum_bytes, targets)
+            below = targets - cum_bytes[idx - 1] < cum_bytes[idx] - targets
+            idx = np.where(below, idx - 1, idx)
+            bounds = np.unique(np.concatenate([[0], idx, [n_imagesets]]))
+            lengths = np.diff(bounds)
+            chunk_bytes = np.diff(cum_bytes[bounds])
+            too_big = (chunk_bytes > max_bytes) & (lengths > 1)
+            if job_size is not None:
+                too_big |= lengths > job_size
+            if not too_big.any():
+                return [(int(start), int(stop))
+                        for start, stop in zip(bounds[:-1], bounds[1:])]
+            n_chunks += 1
+        # very uneven imageset sizes, so fill each chunk in turn instead
+        return _greedy_chunks(cum_bytes, max_bytes, job_size)
+
+    def img_list(self, start=0, stop=None):
+        """
+        image paths for a range of imagesets
+
+        Parameters:
+        -----------
+        start: int (default=0)
+            first imageset
+        stop: int (default=None)
+            end of the range of imagesets (exclusive), if None then up to
+            the last imageset
+
+        Returns:
+        --------
+        list of image paths
+        """
+        return self.images["img_paths"].to_numpy()[self._row_slice(start, stop)].tolist()
+
+    def imagesets(self, start=0, stop=None):
+        """
+        image paths for a range of imagesets, grouped by imageset in the same
+        format as a chunk from `splitter.split`
+
+        Parameters:
+        -----------
+        start: int (default=0)
+            first imageset
+        stop: int (default=None)
+            end of the range of imagesets (exclusive), if None then up to
+            the last imageset
+
+        Returns:
+        --------
+        list of lists, a list of image paths per imageset
+        """
+        if stop is None:
+            stop = len(self)
+        img_paths = self.images["img_paths"].to_numpy()
+        return [img_paths[self.offsets[i]:self.offsets[i+1]].tolist()
+                for i in range(start, stop)]
+
+    def long_loaddata(self, start=0, stop=None):
+        """
+        long-format loaddata dataframe for a range of imagesets, the same as
+        `loaddata.create_long_loaddata` on the images in the range.
+
+        Parameters:
+        -----------
+        start: int (default=0)
+            first imageset
+        stop: int (default=None)
+            end of the range of imagesets (exclusive), if None then up to
+            the last imageset
+
+        Returns:
+        --------
+        pandas DataFrame
+        """
+        images = self.images.iloc[self._row_slice(start, stop)]
+        codes = images["dir_code"].values
+        df_long = images.drop(["img_paths", "dir_code"], axis=1)
+        for col in metadata.DIRECTORY_COLUMNS:
+            df_long[col] = self.directories[col].to_numpy()[codes]
+        return df_long[loaddata.LONG_COLUMNS].reset_index(drop=True)
+
+    def loaddata(self, start=0, stop=None):
+        """
+        wide-format dataframe for CellProfiler's LoadData module for a range
+        of imagesets
+
+        Parameters:
+        -----------
+        start: int (default=0)
+            first imageset
+        stop: int (default=None)
+            end of the range of imagesets (exclusive), if None then up to
+            the last imageset
+
+        Returns:
+        --------
+        pandas DataFrame
+        """
+        return loaddata.cast_dataframe(self.long_loaddata(start, stop))
+
+
+    def plate_loaddata(self):
+        """
+        wide-format loaddata dataframe for the whole plate, with a row per
+        imageset in catalog order. The loaddata for imagesets `start:stop` is
+        then just the row slice `plate_loaddata().iloc[start:stop]`.
+
+        Returns:
+        --------
+        pandas DataFrame, or None if the imagesets don't all have the same
+        channels from a single directory, in which case each range of
+        imagesets has to be cast separately with `loaddata`
+        """
+        sizes = np.diff(self.offsets)
+        if len(sizes) == 0 or (sizes != sizes[0]).any():
+            return None
+        n_channels = sizes[0]
+        channels = self.images["Metadata_channel"].to_numpy().reshape(-1, n_channels)
+        if not (channels == channels[0]).all() or \
+                (np.diff(channels[0]) == 0).any():
+            return None
+        dir_codes = self.images["dir_code"].to_numpy().reshape(-1, n_channels)
+        if not (dir_codes == dir_codes[:, :1]).all():
+            return None
+        first_rows = self.offsets[:-1]
+        codes = dir_codes[:, 0]
+        metadata_columns = {
+            "Metadata_site": self.images["Metadata_site"].to_numpy()[first_rows],
+            "Metadata_well": self.images["Metadata_well"].to_numpy()[first_rows],
+            "Metadata_platenum": self.directories["Metadata_platenum"].to_numpy()[codes],
+            "Metadata_platename": self.directories["Metadata_platename"].to_numpy()[codes]
+        }
+        filenames = self.images["URL"].to_numpy().reshape(-1, n_channels)
+        paths = self.directories["path"].to_numpy()[codes]
+        return loaddata.wide_dataframe(metadata_columns, filenames, paths,
+                                       channels[0])
+
+
+def _split_wells(wells):
+    """
+    split well names into their row letters and column number, so "B02"
+    and "b2" are both ("B", 2). Wells which can't be parsed are ("", -1).
+
+    Returns:
+    --------
+    tuple of a numpy array of rows and a numpy array of columns
+    """
+    parts = pd.Series(list(wells), dtype=object).astype(str).str.upper().str.extract(
+        r"^([A-Z]+)0*([0-9]+)$")
+    rows = parts[0].fillna("").to_numpy()
+    columns = pd.to_numeric(parts[1], errors="coerce").fillna(-1).astype(int).to_numpy()
+    return rows, columns
+
+
+def _greedy_chunks(cum_bytes, max_bytes, job_size=None):
+    """
+    split imagesets into ranges, adding imagesets to each range until the
+    next would take it over `max_bytes` or `job_size` imagesets
+
+    Parameters:
+    -----------
+    cum_bytes: numpy.ndarray
+        cumulative total of imageset sizes, starting at 0
+    max_bytes: int
+        maximum number of bytes per chunk
+    job_size: int (default=None)
+        maximum number of imagesets per chunk
+
+    Returns:
+    --------
+    list of (start, stop) imageset ranges
+    """
+    n_imagesets = len(cum_bytes) - 1
+    chunks, start = [], 0
+    while start < n_imagesets:
+        stop = np.searchsorted(cum_bytes, cum_bytes[start] + max_bytes,
+                               side="right") - 1
+        stop = max(int(stop), start + 1)
+        if job_size is not None:
+            stop = min(stop, start + job_size)
+        chunks.append((start, stop))
+        start = stop
+    return chunks
@@ -1,22 +1,41 @@
+import csv
 import os
+import re
 
 from cptools2 import utils
 
+# columns of the manifest describing each job, a row per line of the
+# cellprofiler commands file. "chunk" is the job's line in the staging and
+# destaging commands files, which differs from "command" when there is more
+# than one pipeline. "key" is the analysis' key in the result cache, if used
+MANIFEST_COLUMNS = ["command", "plate", "name", "imageset_start",
+                    "imageset_stop", "n_imagesets", "n_images", "bytes",
+                    "order", "pipeline", "chunk", "key"]
 
-def make_cp_cmnd(name, pipeline, location, output_loc):
+# a command made by `cp_command`
+_CP_CMND_REGEX = re.compile(
+    r"^cellprofiler -r -c -p (?P<pipeline>\S+) --data-file=(?P<load_data>\S+) "
+    r"-o (?P<output_location>\S+)(?: -f (?P<first>\d+) -l (?P<last>\d+))?$")
+
+
+def make_cp_cmnd(name, pipeline, location, output_loc, image_sets=None):
     """
     create cellprofiler command
 
     Parameters:
     -----------
     name: string
-        name of the individual job
+        name of the individual job, or of the plate if the loaddata csv
+        contains multiple jobs
     pipeline: string
         filepath to the cellprofiler pipeline
     location: string
         filepath to the directory which contains the loaddata csv files
     output_loc: string
         where to store the results from the cellprofiler job
+    image_sets: tuple (default=None)
+        (first, last) image sets of the loaddata csv to analyse, 1-indexed
+        and inclusive. If None then analyses all image sets.
 
     Returns:
     --------
@@ -25,7 +44,8 @@ def make_cp_cmnd(name, pipeline, location, output_loc):
     loaddata_name = os.path.join(location, "loaddata", name)
     cmnd = cp_command(pipeline=pipeline,
                       load_data=loaddata_name + ".csv",
-                      output_location=output_loc)
+                      output_location=output_loc,
+                      image_sets=image_sets)
     return cmnd
 
 
@@ -47,12 +67,13 @@ def write_loaddata(name, location, dataframe, fix_paths=True):
 
     Returns:
     --------
-    nothing, writes the csv file to disk
+    path to the csv file, writes the csv file to disk
     """
     loaddata_name = os.path.join(location, "loaddata", name + ".csv")
     if fix_paths is True:
         dataframe = utils.prefix_filepaths(dataframe, name, location)
     dataframe.to_csv(loaddata_name, index=False)
+    return loaddata_name
 
 
 def write_filelist(img_list, filelist_name):
@@ -68,11 +89,12 @@ def write_filelist(img_list, filelist_name):
 
     Returns:
     --------
-    nothing, writes filelist to disk
+    path to the filelist, writes filelist to disk
     """
     with open(filelist_name, "w") as f:
         for line in img_list:
             f.write(line + "\n")
+    return filelist_name
 
 
 def _write_single(commands_location, commands, final_name):
@@ -124,7 +146,34 @@ def write_commands(commands_location, rsync_commands, cp_commands, rm_commands):
         _write_single(commands_location, command, name)
 
 
-def make_rsync_cmnd(plate_loc, filelist_name, img_location):
+def write_manifest(commands_location, manifest):
+    """
+    write a csv file describing each job alongside the commands, a row per
+    line of the cellprofiler commands file
+
+    Parameters:
+    -----------
+    commands_location: string
+        directory where the commands are stored
+    manifest: list of dicts
+        a dictionary per job, in the same order as the cellprofiler
+        commands, with the keys in MANIFEST_COLUMNS other than "command".
+        Unknown byte counts are None.
+
+    Returns:
+    --------
+    path to the manifest
+    """
+    manifest_loc = os.path.join(commands_location, "manifest.csv")
+    with open(manifest_loc, "w", newline="") as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=MANIFEST_COLUMNS)
+        writer.writeheader()
+        for command_num, job in enumerate(manifest, 1):
+            writer.writerow(dict(job, command=command_num))
+    return manifest_loc
+
+
+def make_rsync_cmnd(plate_loc, filelist_name, img_location, lines=None):
     """
     Create rsync string pointing to a file-list and a destination
     If the file-list is truncated, then source has to be the location of the
@@ -143,6 +192,10 @@ def make_rsync_cmnd(plate_loc, filelist_name, img_location):
         path to the filelist, this will be used with the --file-from flag
     img_location: string
         path to the directory in which to copy the file to in the rsync command
+    lines: tuple (default=None)
+        (first, last) lines of the file-list to copy, 1-indexed and inclusive.
+        The lines are piped into rsync with sed. If None then copies every
+        file in the file-list.
 
     Returns:
     --------
@@ -151,8 +204,15 @@ def make_rsync_cmnd(plate_loc, filelist_name, img_location):
     # NOTE: setting permissions with o+ means others have read/write/execution
     #       access, not very secture but it's a temporary file which is going
     #       to be deleted afterwards anyway.
-    return "rsync -s --perms --chmod=a+rwx --files-from=\"{filelist}\" \"{source}\" \"{destination}\""\
-        .format(filelist=filelist_name,
+    if lines is None:
+        return "rsync -s --perms --chmod=a+rwx --files-from=\"{filelist}\" \"{source}\" \"{destination}\""\
+            .format(filelist=filelist_name,
+                    source=plate_loc,
+                    destination=img_location)
+    return "sed -n '{first},{last}p' \"{filelist}\" | rsync -s --perms --chmod=a+rwx --files-from=- \"{source}\" \"{destination}\""\
+        .format(first=lines[0],
+                last=lines[1],
+                filelist=filelist_name,
                 source=plate_loc,
                 destination=img_location)
 
@@ -174,7 +234,7 @@ def rm_string(directory):
     return "rm -rf \"{}\"".format(directory)
 
 
-def cp_command(pipeline, load_data, output_location):
+def cp_command(pipeline, load_data, output_location, image_sets=None):
     """
     create cellprofiler commands
 
@@ -186,15 +246,47 @@ def cp_command(pipeline, load_data, output_location):
         path to csv file suitable to Cellprofiler's LoadData module
     output_location: string
         where to store the results from the cellprofiler job
+    image_sets: tuple (default=None)
+        (first, last) image sets to analyse, passed to cellprofiler's
+        -f and -l flags.
 
     Returns:
     --------
     string: a cellprofiler command
     """
-    return "cellprofiler -r -c -p {pipeline} --data-file={load_data} -o {output_location}".format(
+    cmnd = "cellprofiler -r -c -p {pipeline} --data-file={load_data} -o {output_location}".format(
         pipeline=pipeline,
         load_data=load_data,
         output_location=output_location)
+    if image_sets is not None:
+        cmnd += " -f {} -l {}".format(*image_sets)
+    return cmnd
+
+
+def parse_cp_command(cmnd):
+    """
+    the arguments of a cellprofiler command made by `cp_command`
+
+    Parameters:
+    -----------
+    cmnd: string
+        a cellprofiler command
+
+    Returns:
+    --------
+    dictionary of the `cp_command` arguments, `image_sets` being None if the
+    command analyses every image set
+    """
+    match = _CP_CMND_REGEX.match(cmnd.strip())
+    if match is None:
+        raise ValueError("not a cellprofiler command: '{}'".format(cmnd))
+    image_sets = None
+    if match.group("first") is not None:
+        image_sets = (int(match.group("first")), int(match.group("last")))
+    return {"pipeline": match.group("pipeline"),
+            "load_data": match.group("load_data"),
+            "output_location": match.group("output_location"),
+            "image_sets": image_sets}
 
 
 def make_output_directories(location):
@@ -0,0 +1,65 @@
+"""
+Read which channels a CellProfiler pipeline uses.
+
+The LoadData csv files name each channel's image `W<channel>`, from the
+`FileName_W<channel>` columns, so the channels a pipeline uses are those
+whose image names appear in the settings of its enabled modules. Both the
+text `.cppipe` format and the json format of CellProfiler 4 are read.
+"""
+
+import json
+import re
+
+# an image name such as W1, or a column such as FileName_W1, but not part
+# of a longer word
+_CHANNEL_REGEX = re.compile(r"(?<![A-Za-z0-9])W(\d+)(?![A-Za-z0-9])")
+_MODULE_REGEX = re.compile(r"^(\w+):\[(.*)\]\s*$")
+
+
+def _text_settings(text):
+    """setting values of the enabled modules in a text format pipeline"""
+    values = []
+    enabled = False
+    for line in text.splitlines():
+        module = _MODULE_REGEX.match(line)
+        if module is not None:
+            enabled = "enabled:False" not in module.group(2)
+        elif enabled and line[:1].isspace() and ":" in line:
+            values.append(line.split(":", 1)[1])
+    return values
+
+
+def _json_settings(pipeline_dict):
+    """setting values of the enabled modules in a json format pipeline"""
+    values = []
+    for module in pipeline_dict.get("modules", []):
+        if module.get("attributes", {}).get("enabled", True) is False:
+            continue
+        for setting in module.get("settings", []):
+            values.append(str(setting.get("value", "")))
+    return values
+
+
+def pipeline_channels(pipeline):
+    """
+    channels used by a CellProfiler pipeline
+
+    Parameters:
+    -----------
+    pipeline: string
+        path to a .cppipe file
+
+    Returns:
+    --------
+    sorted list of channel numbers, empty if no channels were found
+    """
+    with open(pipeline) as f:
+        text = f.read()
+    if text.lstrip().startswith("{"):
+        values = _json_settings(json.loads(text))
+    else:
+        values = _text_settings(text)
+    channels = set()
+    for value in values:
+        channels.update(int(i) for i in _CHANNEL_REGEX.findall(value))
+    return sorted(channels)
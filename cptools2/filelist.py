@@ -1,12 +1,195 @@
-import glob
+import fnmatch
+import hashlib
+import json
 import os
+import time
+from concurrent import futures
 
 import parserix
 from cptools2 import utils
 
+# default number of threads used to scan plates concurrently, scanning is
+# bound by filesystem latency rather than CPU so this can exceed the core count
+N_WORKERS = 8
+
+# bump this if the layout of the plate index files changes
+INDEX_VERSION = 1
+
+# directories modified more recently than this are always re-listed on the
+# next scan, NFS only guarantees mtimes to the nearest second
+MTIME_RESOLUTION_NS = 2 * 10**9
+
+
+def _scan_dir(directory, dir_only):
+    """
+    list the non-hidden entries of a directory with os.scandir
+
+    Parameters:
+    -----------
+    directory : string
+        path to directory
+    dir_only : Boolean
+        if True only return sub-directories
+
+    Returns:
+    --------
+    list of entry names, in directory order
+    """
+    try:
+        with os.scandir(directory) as entries:
+            if dir_only:
+                return [i.name for i in entries
+                        if not i.name.startswith(".") and i.is_dir()]
+            return [i.name for i in entries if not i.name.startswith(".")]
+    except OSError:
+        return []
+
+
+def _scan_plate(plate_dir, ext, depth, index=None):
+    """
+    find files `depth` directories below `plate_dir` ending in `ext`.
+
+    This returns the same paths, in the same order, as
+    `glob.glob(plate_dir + "/*" * depth + "/*" + ext)` but only makes a single
+    scandir call per directory rather than glob's listdir + pattern matching.
+
+    Parameters:
+    -----------
+    plate_dir : string
+        path to plate directory
+    ext : string
+        file extension
+    depth : int
+        number of directory levels between the plate directory and the files
+    index : dict (default=None)
+        plate index from `_load_index`. Directories whose modification time
+        matches the index are not re-listed, and the index is updated in place
+        with the current listings.
+
+    Returns:
+    --------
+    list of file paths
+    """
+    previous = index["dirs"] if index is not None else {}
+    current = {}
+
+    def listing(directory, relpath, dir_only):
+        if index is None:
+            entries = _scan_dir(directory, dir_only)
+            return entries if dir_only else fnmatch.filter(entries, "*" + ext)
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return []
+        cached = previous.get(relpath)
+        if cached is not None and cached["mtime"] == mtime:
+            entries = cached["entries"]
+        else:
+            entries = _scan_dir(directory, dir_only)
+            if not dir_only:
+                entries = fnmatch.filter(entries, "*" + ext)
+        # a directory modified within the mtime resolution of the filesystem
+        # could change again without its mtime changing, so don't trust it
+        trusted = time.time() * 1e9 - mtime > MTIME_RESOLUTION_NS
+        current[relpath] = {"mtime": mtime if trusted else None,
+                            "entries": entries}
+        return entries
+
+    directories = [(plate_dir, "")]
+    for _ in range(depth):
+        directories = [(os.path.join(directory, name), os.path.join(relpath, name))
+                       for directory, relpath in directories
+                       for name in listing(directory, relpath, dir_only=True)]
+    files = []
+    for directory, relpath in directories:
+        names = listing(directory, relpath, dir_only=False)
+        files.extend(os.path.join(directory, name) for name in names)
+    if index is not None:
+        index["dirs"] = current
+    return files
+
+
+def _index_path(index_location, plate_dir, ext, depth):
+    """
+    path to the index file for a plate, the filename is a hash of the
+    absolute plate path and the scan parameters
+
+    Parameters:
+    -----------
+    index_location : string
+        directory containing the plate indices
+    plate_dir : string
+        path to plate directory
+    ext : string
+        file extension
+    depth : int
+        number of directory levels between the plate directory and the files
+
+    Returns:
+    --------
+    string
+    """
+    key = "{}:{}:{}".format(os.path.abspath(plate_dir), ext, depth)
+    plate_name = os.path.basename(os.path.normpath(plate_dir))
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(index_location, "{}_{}.json".format(plate_name, digest))
+
+
+def _load_index(index_file, plate_dir):
+    """
+    load a plate index from disk, returns an empty index if the file
+    does not exist, is unreadable or belongs to a different plate
+
+    Parameters:
+    -----------
+    index_file : string
+        path to index file
+    plate_dir : string
+        path to plate directory
+
+    Returns:
+    --------
+    dictionary
+    """
+    empty = {"version": INDEX_VERSION,
+             "plate_dir": os.path.abspath(plate_dir),
+             "dirs": {}}
+    try:
+        with open(index_file, "r") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return empty
+    if index.get("version") != INDEX_VERSION or \
+            index.get("plate_dir") != empty["plate_dir"]:
+        return empty
+    return index
+
+
+def _save_index(index_file, index):
+    """
+    write a plate index to disk, writing to a temporary file first so an
+    interrupted run never leaves a truncated index behind
+
+    Parameters:
+    -----------
+    index_file : string
+        path to index file
+    index : dict
+        plate index
+
+    Returns:
+    --------
+    nothing, writes index to disk
+    """
+    utils.make_dir(os.path.dirname(index_file))
+    tmp_file = "{}.{}.tmp".format(index_file, os.getpid())
+    with open(tmp_file, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_file, index_file)
+
 
 def files_from_plate(plate_dir, ext=".tif", clean=True, truncate=True,
-                     sanitise=False, is_new_ix=False):
+                     sanitise=False, is_new_ix=False, index_location=None):
     """
     return all proper image files from a plate directory
 
@@ -24,11 +207,21 @@ def files_from_plate(plate_dir, ext=".tif", clean=True, truncate=True,
         whether to escape whitespace in the filepaths
     is_new_ix: Boolean (default=False)
         whether image paths are from the new IX which are parsed differently
+    index_location: string (default=None)
+        directory in which to keep a persistent index of the plate's files.
+        If given, only directories which have changed since the previous
+        scan are listed again.
     """
     if not os.path.isdir(plate_dir):
         raise RuntimeError("'{}' is not a plate directory".format(plate_dir))
-    glob_str = "/*/*/*/*" if is_new_ix else "/*/*/*"
-    files = glob.glob(plate_dir + glob_str + ext)
+    depth = 3 if is_new_ix else 2
+    if index_location is None:
+        files = _scan_plate(plate_dir, ext, depth)
+    else:
+        index_file = _index_path(index_location, plate_dir, ext, depth)
+        index = _load_index(index_file, plate_dir)
+        files = _scan_plate(plate_dir, ext, depth, index=index)
+        _save_index(index_file, index)
     if clean is True:
         files = parserix.clean.clean(file_list=files, ext=ext)
     if truncate is True:
@@ -46,6 +239,69 @@ def files_from_plate(plate_dir, ext=".tif", clean=True, truncate=True,
     return files
 
 
+def files_from_plates(plate_dirs, n_workers=None, **kwargs):
+    """
+    return image files for multiple plates, scanning the plates concurrently
+
+    Parameters:
+    -----------
+    plate_dirs : list
+        list of paths to plate directories
+    n_workers : int (default=None)
+        maximum number of plates to scan at once, if None then uses
+        `N_WORKERS`
+    **kwargs :
+        additional arguments passed to `files_from_plate`
+
+    Returns:
+    --------
+    list of image lists, in the same order as `plate_dirs`
+    """
+    if n_workers is None:
+        n_workers = N_WORKERS
+    if n_workers < 1:
+        raise ValueError("n_workers has to be at least 1")
+    if len(plate_dirs) == 0:
+        return []
+    n_workers = min(n_workers, len(plate_dirs))
+    with futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        img_files = executor.map(lambda p: files_from_plate(p, **kwargs),
+                                 plate_dirs)
+        return list(img_files)
+
+
+def file_sizes(img_list, n_workers=None):
+    """
+    size in bytes of each file in an image list, the files are stat-ed
+    concurrently in batches as this is bound by filesystem latency
+
+    Parameters:
+    -----------
+    img_list : list
+        list of file paths
+    n_workers : int (default=None)
+        number of threads to stat files with, if None then uses `N_WORKERS`
+
+    Returns:
+    --------
+    list of integers, in the same order as `img_list`
+    """
+    if n_workers is None:
+        n_workers = N_WORKERS
+    if n_workers < 1:
+        raise ValueError("n_workers has to be at least 1")
+    n_batches = min(len(img_list), 4 * n_workers)
+    if n_batches == 0:
+        return []
+    batch_size = -(-len(img_list) // n_batches)
+    batches = [img_list[i:i + batch_size]
+               for i in range(0, len(img_list), batch_size)]
+    with futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        sizes = executor.map(lambda batch: [os.stat(i).st_size for i in batch],
+                             batches)
+        return [size for batch in sizes for size in batch]
+
+
 def paths_to_plates(experiment_directory):
     """
     Return the absolute file path to all plates contained within
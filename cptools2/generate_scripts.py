@@ -11,8 +11,15 @@ import yaml
 from scissorhands import script_generator
 from cptools2 import utils
 from cptools2 import colours
+from cptools2 import result_cache
 from cptools2.colours import pretty_print
 
+# width of each record in a commands index file, excluding the newline.
+# Offsets are right-justified with spaces, which allows files up to 1TB.
+INDEX_WIDTH = 12
+# file in the commands location listing the jobs which ran its commands
+JOBS_NAME = "jobs.txt"
+
 
 def make_command_paths(commands_location):
     """
@@ -25,8 +32,9 @@ def make_command_paths(commands_location):
 def _lines_in_commands(staging, cp_commands, destaging):
     """
     Number of lines in each of the commands file.
-    While the number of lines in each of the files *should* be the same,
-    it's worth checking.
+    The staging and destaging files *should* have the same number of lines,
+    and the cellprofiler commands file the same number again for each
+    pipeline, but it's worth checking.
 
     Parameters:
     -----------
@@ -48,11 +56,33 @@ def _lines_in_commands(staging, cp_commands, destaging):
     paths = [staging, cp_commands, destaging]
     counts = [utils.count_lines_in_file(i) for i in paths]
     # check if the counts differ
-    if len(set(counts)) > 1:
+    n_staging, n_cp, n_destaging = counts
+    if n_staging != n_destaging or (n_staging == 0 and n_cp > 0) or \
+            (n_staging > 0 and n_cp % n_staging != 0):
         raise RuntimeWarning("command files contain differing number of lines")
     return {name: count for name, count in zip(names, counts)}
 
 
+def n_pipelines(commands_count_dict):
+    """
+    number of pipelines each chunk is analysed with, as the cellprofiler
+    commands file has a block of a line per chunk for each pipeline
+    """
+    if commands_count_dict["staging"] == 0:
+        return 1
+    return commands_count_dict["cp_commands"] // commands_count_dict["staging"]
+
+
+def analysis_names(n):
+    """
+    names of the analysis scripts for `n` pipelines, a single "analysis"
+    script or one "analysis_<i>" script per pipeline
+    """
+    if n == 1:
+        return ["analysis"]
+    return ["analysis_{}".format(i) for i in range(n)]
+
+
 def lines_in_commands(commands_location):
     """
     Given a path to a directory which contains the commands:
@@ -78,6 +108,192 @@ def lines_in_commands(commands_location):
     return _lines_in_commands(**command_paths)
 
 
+def index_path(command_file):
+    """
+    path to the index of a commands file, e.g "staging.txt" -> "staging.idx"
+    """
+    return os.path.splitext(command_file)[0] + ".idx"
+
+
+def write_command_index(command_file):
+    """
+    Write a byte-offset index alongside a commands file, so an array task
+    can fetch its command without reading the file from the start.
+
+    The index is a fixed-width record per line of `command_file`, giving the
+    byte offset at which that line starts, followed by a final record of
+    the size of the file. Line `n` (1-indexed) then spans the bytes between
+    records `n` and `n+1`, which are at a known position in the index.
+
+    Parameters:
+    -----------
+    command_file: string
+        path to a commands file
+
+    Returns:
+    --------
+    path to the index file
+    """
+    record = "{:>%d}\n" % INDEX_WIDTH
+    offset = 0
+    idx_file = index_path(command_file)
+    with open(command_file, "rb") as infile, open(idx_file, "w") as outfile:
+        for line in infile:
+            outfile.write(record.format(offset))
+            offset += len(line)
+        outfile.write(record.format(offset))
+    return idx_file
+
+
+def write_command_indices(commands_location):
+    """
+    write an index for each of the staging, cellprofiler and destaging
+    commands files in `commands_location`, and for the result cache markers
+    if the commands were created with a result cache
+
+    Parameters:
+    -----------
+    commands_location: string
+        path to directory containing commands
+
+    Returns:
+    --------
+    Dictionary of paths to the index files
+    """
+    command_paths = make_command_paths(commands_location)
+    markers_loc = result_cache.markers_path(commands_location)
+    if os.path.isfile(markers_loc):
+        command_paths[result_cache.MARKERS_NAME] = markers_loc
+    return {name: write_command_index(path)
+            for name, path in command_paths.items()}
+
+
+def record_job(commands_location, job_file):
+    """
+    note that the job whose log file is `<job_file>.log` runs the commands
+    in `commands_location`, so a log can be matched to its commands later,
+    see `recorded_jobs`
+    """
+    with open(os.path.join(commands_location, JOBS_NAME), "a") as f:
+        f.write(job_file + "\n")
+
+
+def recorded_jobs(commands_location):
+    """
+    names of the jobs which ran the commands in `commands_location`, in the
+    order they were created, empty if none were recorded
+    """
+    jobs_path = os.path.join(commands_location, JOBS_NAME)
+    if not os.path.isfile(jobs_path):
+        return []
+    with open(jobs_path) as f:
+        return [i.strip() for i in f if i.strip()]
+
+
+def read_command(command_file, task_id):
+    """
+    Fetch a single command using the commands file's index, the same as
+    the lookup in the submission scripts.
+
+    Parameters:
+    -----------
+    command_file: string
+        path to a commands file, which has an index from `write_command_index`
+    task_id: int
+        array task number, the (1-indexed) line of the command
+
+    Returns:
+    --------
+    string, the command without a trailing newline
+    """
+    with open(index_path(command_file), "rb") as f:
+        f.seek((task_id - 1) * (INDEX_WIDTH + 1))
+        start, end = [int(i) for i in f.read(2 * (INDEX_WIDTH + 1)).split()]
+    with open(command_file, "rb") as f:
+        f.seek(start)
+        return f.read(end - start).decode().rstrip("\n")
+
+
+def command_lookup_text(input_file, task_id="$SGE_TASK_ID"):
+    """
+    Shell text which sets `$SEED` to an array task's command.
+
+    Rather than scanning the commands file with awk, which means every task
+    reads the file from the start, this reads the task's two records from
+    the fixed-width index and then only the bytes of its own command.
+
+    Parameters:
+    -----------
+    input_file: string
+        path to a commands file, which has an index from `write_command_index`
+    task_id: string (default="$SGE_TASK_ID")
+        shell variable containing the array task number
+
+    Returns:
+    --------
+    string
+    """
+    return textwrap.dedent(
+        """
+        SEEDFILE="{input_file}"
+        INDEXFILE="{index_file}"
+        set -- $(dd if="$INDEXFILE" bs={record_size} skip=$(({task_id} - 1)) count=2 2>/dev/null)
+        SEED=$(tail -c +$(($1 + 1)) "$SEEDFILE" | head -c $(($2 - $1)))
+        """.format(input_file=input_file, index_file=index_path(input_file),
+                   record_size=INDEX_WIDTH + 1, task_id=task_id)
+    )
+
+
+def n_array_tasks(n_commands, tasks_per_job=1):
+    """
+    number of array tasks needed to run `n_commands` commands, with
+    `tasks_per_job` commands run by each array task
+    """
+    if tasks_per_job < 1:
+        raise ValueError("tasks_per_job has to be at least 1")
+    return -(-n_commands // tasks_per_job)
+
+
+def command_loop_text(body, n_commands, tasks_per_job=1,
+                      task_id="$SGE_TASK_ID"):
+    """
+    Shell text which runs `body` once for each command of an array task.
+
+    Array task `t` runs commands (t-1)*tasks_per_job + 1 to
+    t*tasks_per_job, the last task running any remainder. Within `body`
+    the (1-indexed) line of the current command is `$COMMAND_NUM`.
+
+    Parameters:
+    -----------
+    body: string
+        shell text to run for each command
+    n_commands: int
+        total number of commands
+    tasks_per_job: int (default=1)
+        number of commands run by each array task
+    task_id: string (default="$SGE_TASK_ID")
+        shell variable containing the array task number
+
+    Returns:
+    --------
+    string
+    """
+    text = textwrap.dedent(
+        """
+        FIRST_COMMAND=$((({task_id} - 1) * {tasks_per_job} + 1))
+        LAST_COMMAND=$(({task_id} * {tasks_per_job}))
+        if [ "$LAST_COMMAND" -gt {n_commands} ]; then
+            LAST_COMMAND={n_commands}
+        fi
+        for COMMAND_NUM in $(seq "$FIRST_COMMAND" "$LAST_COMMAND"); do
+        """.format(task_id=task_id, tasks_per_job=tasks_per_job,
+                   n_commands=n_commands)
+    )
+    text += textwrap.indent(body, "    ")
+    text += "done\n"
+    return text
+
+
 def load_module_text():
     """returns load module commands"""
     return textwrap.dedent(
@@ -88,11 +304,22 @@ def load_module_text():
     )
 
 
-def make_qsub_scripts(commands_location, commands_count_dict, logfile_location):
+def make_qsub_scripts(commands_location, commands_count_dict, logfile_location,
+                      tasks_per_job=1, analysis_memory="12G"):
     """
     Create and save qsub submission scripts in the same location as the
     commands.
 
+    Each array task runs `tasks_per_job` consecutive commands in turn. As
+    task `t` of each of the staging, analysis and destaging jobs covers the
+    same commands the -hold_jid_ad dependencies between them still hold.
+
+    With more than one pipeline there is an analysis job per pipeline, each
+    held on the staging job, and the destaging job is held on all of them.
+
+    Every task records its metrics in `logfile_location/<phase>`, see
+    `metrics_dir`.
+
     Parameters:
     -----------
     commands_location: string
@@ -106,74 +333,351 @@ def make_qsub_scripts(commands_location, commands_count_dict, logfile_location):
         where to store the log files. By default this will store them
         in a directory alongside the results.
 
+    tasks_per_job: int (default=1)
+        number of commands to run in each array task, so the scheduling
+        and environment setup is only paid once per `tasks_per_job` chunks.
+        Each command still starts its own cellprofiler process.
+
+    analysis_memory: string (default="12G")
+        memory to request for each analysis task
 
     Returns:
     ---------
     Nothing, writes files to `commands_location`
     """
     cmd_path = make_command_paths(commands_location)
+    write_command_indices(commands_location)
     time_now = datetime.now().replace(microsecond=0)
     time_now = str(time_now).replace(" ", "-")
     # append random hex to job names - this allows you to run multiple jobs
     # without the -hold_jid flags fron clashing
     job_hex = script_generator.generate_random_hex()
-    n_tasks = commands_count_dict["cp_commands"]
+    record_job(commands_location, job_hex)
+    n_commands = commands_count_dict["staging"]
+    n_tasks = n_array_tasks(n_commands, tasks_per_job)
+    names = analysis_names(n_pipelines(commands_count_dict))
     # FIXME: using AnalysisScript class for everything, due to the 
     #        {Staging, Destaging}Script class not having loop_through_file
     stage_script = BodgeScript(
         name="staging_{}".format(job_hex),
         memory="1G",
         output=os.path.join(logfile_location, "staging"),
-        tasks=commands_count_dict["staging"]
+        tasks=n_array_tasks(commands_count_dict["staging"], tasks_per_job)
     )
     stage_script += "#$ -q staging\n"
     # limit staging node requests
     stage_script += "#$ -p -500\n"
     stage_script += "#$ -tc 20\n"
     stage_script.bodge_array_loop(phase="staging",
-                                  input_file=cmd_path["staging"])
+                                  input_file=cmd_path["staging"],
+                                  n_commands=commands_count_dict["staging"],
+                                  tasks_per_job=tasks_per_job,
+                                  metrics_dir=metrics_dir(logfile_location,
+                                                          "staging", job_hex))
     stage_loc = os.path.join(commands_location,
                              "{}_staging_script.sh".format(time_now))
     stage_script.save(stage_loc)
-    analysis_script = script_generator.AnalysisScript(
-        name="analysis_{}".format(job_hex),
-        tasks=n_tasks,
-        hold_jid_ad="staging_{}".format(job_hex),
-        pe="sharedmem 1",
-        memory="12G",
-        output=os.path.join(logfile_location, "analysis")
-    )
-    analysis_script += load_module_text()
-    analysis_script.loop_through_file(cmd_path["cp_commands"])
-    analysis_loc = os.path.join(commands_location,
-                                "{}_analysis_script.sh".format(time_now))
-    analysis_script += make_logfile_text(logfile_location,
-                                         job_file=job_hex,
-                                         n_tasks=n_tasks)
-    analysis_script.save(analysis_loc)
+    for pipeline_num, name in enumerate(names):
+        analysis_script = script_generator.AnalysisScript(
+            name="{}_{}".format(name, job_hex),
+            tasks=n_tasks,
+            hold_jid_ad="staging_{}".format(job_hex),
+            pe="sharedmem 1",
+            memory=analysis_memory,
+            output=os.path.join(logfile_location, "analysis")
+        )
+        analysis_script += load_module_text()
+        analysis_script += command_loop_text(
+            analysis_text(cmd_path["cp_commands"], logfile_location,
+                          job_file=job_hex, n_tasks=n_tasks,
+                          line_offset=pipeline_num * n_commands),
+            n_commands, tasks_per_job=tasks_per_job)
+        analysis_loc = os.path.join(commands_location,
+                                    "{}_{}_script.sh".format(time_now, name))
+        analysis_script.save(analysis_loc)
     destaging_script = BodgeScript(
         name="destaging_{}".format(job_hex),
         memory="1G",
-        hold_jid_ad="analysis_{}".format(job_hex),
-        tasks=commands_count_dict["destaging"],
+        hold_jid_ad=",".join("{}_{}".format(name, job_hex) for name in names),
+        tasks=n_array_tasks(commands_count_dict["destaging"], tasks_per_job),
         output=os.path.join(logfile_location, "destaging")
     )
     destaging_script.bodge_array_loop(phase="destaging",
-                                      input_file=cmd_path["destaging"])
+                                      input_file=cmd_path["destaging"],
+                                      n_commands=commands_count_dict["destaging"],
+                                      tasks_per_job=tasks_per_job,
+                                      metrics_dir=metrics_dir(logfile_location,
+                                                              "destaging", job_hex))
     destage_loc = os.path.join(commands_location,
                                "{}_destaging_script.sh".format(time_now))
     destaging_script.save(destage_loc)
     # create script to submit staging, analysis and destaging scripts
-    submit_script = make_submit_script(commands_location, time_now)
+    submit_script = make_submit_script(commands_location, time_now,
+                                       names=["staging"] + names + ["destaging"])
     pretty_print("saving master submission script at {}".format(colours.yellow(submit_script)))
     utils.make_executable(submit_script)
 
 
-def make_logfile_text(logfile_location, job_file, n_tasks):
+def make_pipelined_qsub_scripts(commands_location, commands_count_dict,
+                                logfile_location, tasks_per_job=1, prefetch=1,
+                                analysis_memory="12G"):
+    """
+    Create and save a single qsub submission script which stages, analyses
+    and destages each task's chunks in a pipeline, rather than as three
+    separate array jobs. See `pipelined_loop_text`.
+
+    As the staging runs on the same node as the analysis, that node needs
+    access to the images. There is no separate staging job, so unlike
+    `make_qsub_scripts` the staging isn't limited to 20 tasks at once with
+    `-tc 20`, up to `prefetch` chunks are staged at once by every running
+    task instead.
+
+    Parameters:
+    -----------
+    commands_location: string
+        path to directory that contains staging, cp_commands, and destaging
+        command files.
+    commands_count_dict: dictionary
+        dictionary of the number of commands contain in each of the jobs
+    logfile_location: string
+        where to store the log files.
+    tasks_per_job: int (default=1)
+        number of chunks to run in each array task
+    prefetch: int (default=1)
+        number of chunks to stage ahead of the chunk being analysed
+    analysis_memory: string (default="12G")
+        memory to request for each array task
+
+    Returns:
+    ---------
+    Nothing, writes files to `commands_location`
+    """
+    cmd_path = make_command_paths(commands_location)
+    write_command_indices(commands_location)
+    time_now = datetime.now().replace(microsecond=0)
+    time_now = str(time_now).replace(" ", "-")
+    job_hex = script_generator.generate_random_hex()
+    record_job(commands_location, job_hex)
+    n_commands = commands_count_dict["staging"]
+    n_tasks = n_array_tasks(n_commands, tasks_per_job)
+    pipeline_script = script_generator.AnalysisScript(
+        name="pipeline_{}".format(job_hex),
+        tasks=n_tasks,
+        pe="sharedmem 1",
+        memory=analysis_memory,
+        output=os.path.join(logfile_location, "analysis")
+    )
+    pipeline_script += load_module_text()
+    pipeline_script += pipelined_loop_text(cmd_path, n_commands,
+                                           logfile_location=logfile_location,
+                                           job_file=job_hex,
+                                           tasks_per_job=tasks_per_job,
+                                           prefetch=prefetch,
+                                           n_pipelines=n_pipelines(commands_count_dict))
+    pipeline_loc = os.path.join(commands_location,
+                                "{}_pipeline_script.sh".format(time_now))
+    pipeline_script.save(pipeline_loc)
+    submit_script = make_submit_script(commands_location, time_now,
+                                       names=["pipeline"])
+    pretty_print("saving master submission script at {}".format(colours.yellow(submit_script)))
+    utils.make_executable(submit_script)
+
+
+def pipelined_loop_text(cmd_path, n_commands, logfile_location, job_file,
+                        tasks_per_job=1, prefetch=1, task_id="$SGE_TASK_ID",
+                        job_id="$JOB_ID", n_pipelines=1):
+    """
+    Shell text which stages, analyses and destages the chunks of an array
+    task in a pipeline.
+
+    While a chunk is analysed, up to `prefetch` of the following chunks are
+    staged in the background, and once analysed each chunk is destaged in
+    the background. The network and the CPU are then both kept busy, and
+    only about `prefetch + 1` chunks are on scratch at once per task. With
+    more than one pipeline each chunk is analysed by every pipeline in turn
+    before it is destaged. Each stage, analysis and destage records its
+    metrics in `logfile_location/<phase>`, see `metrics_dir`.
+
+    Parameters:
+    -----------
+    cmd_path: dict
+        paths to the staging, cp_commands and destaging commands files, as
+        from `make_command_paths`, each with an index
+    n_commands: int
+        total number of chunks, i.e lines in the staging and destaging files
+    logfile_location: string
+        where to store the log files
+    job_file: string
+        name of the analysis log file
+    tasks_per_job: int (default=1)
+        number of chunks run by each array task
+    prefetch: int (default=1)
+        number of chunks to stage ahead of the chunk being analysed
+    task_id: string (default="$SGE_TASK_ID")
+        shell variable containing the array task number
+    job_id: string (default="$JOB_ID")
+        shell variable containing the job id, used in the analysis log
+    n_pipelines: int (default=1)
+        number of pipelines, i.e blocks of `n_commands` lines in the
+        cellprofiler commands file
+
+    Returns:
+    --------
+    string
+    """
+    if prefetch < 0:
+        raise ValueError("prefetch can't be negative")
+    metrics = {phase: metrics_dir(logfile_location, phase, job_file)
+               for phase in ["staging", "destaging"]}
+    stage_text = command_lookup_text(cmd_path["staging"], task_id="$NEXT_STAGE")
+    stage_text += "(\n"
+    stage_text += textwrap.indent(
+        transfer_text("staging", 'bash -c "$SEED"', metrics["staging"],
+                      task_id="$NEXT_STAGE", job_id=job_id), "    ")
+    stage_text += textwrap.dedent(
+        """
+            exit "$RETURN_VAL"
+        ) &
+        eval "STAGE_PID_$NEXT_STAGE=$!"
+        NEXT_STAGE=$((NEXT_STAGE + 1))
+        """
+    )
+    body = textwrap.dedent(
+        """
+        # stage this chunk, and up to {prefetch} chunks ahead of it, in the background
+        while [ "$NEXT_STAGE" -le "$LAST_COMMAND" ] && [ "$NEXT_STAGE" -le $((COMMAND_NUM + {prefetch})) ]; do
+        """.format(prefetch=prefetch)
+    )
+    body += textwrap.indent(stage_text, "    ")
+    body += "done\n"
+    body += textwrap.dedent(
+        """
+        # wait for this chunk to be staged
+        eval "wait \\$STAGE_PID_$COMMAND_NUM"
+        """
+    )
+    for pipeline_num in range(n_pipelines):
+        body += analysis_text(cmd_path["cp_commands"], logfile_location,
+                              job_file=job_file, n_tasks=n_commands,
+                              line_offset=pipeline_num * n_commands,
+                              job_id=job_id)
+    body += command_lookup_text(cmd_path["destaging"], task_id="$COMMAND_NUM")
+    body += "# destage in the background while the next chunk is analysed\n(\n"
+    body += textwrap.indent(
+        transfer_text("destaging", 'bash -c "$SEED"', metrics["destaging"],
+                      job_id=job_id), "    ")
+    body += textwrap.dedent(
+        """
+            exit "$RETURN_VAL"
+        ) &
+        DESTAGE_PIDS="$DESTAGE_PIDS $!"
+        """
+    )
+    text = "\nNEXT_STAGE=$((({task_id} - 1) * {tasks_per_job} + 1))\n".format(
+        task_id=task_id, tasks_per_job=tasks_per_job)
+    text += 'DESTAGE_PIDS=""\n'
+    text += command_loop_text(body, n_commands, tasks_per_job=tasks_per_job,
+                              task_id=task_id)
+    text += "# wait for the last chunks to be destaged\nwait $DESTAGE_PIDS\n"
+    return text
+
+
+def analysis_text(cp_commands, logfile_location, job_file, n_tasks,
+                  line_offset=0, job_id="$JOB_ID"):
+    """
+    Shell text which looks up, runs and logs the cellprofiler command on
+    line `$COMMAND_NUM + line_offset`, to be used within `command_loop_text`.
+    Each analysis also appends a record to its metrics file, see
+    `analysis_metrics_text`. If the commands were created with a result cache then a successful
+    analysis is also recorded in the cache, see `result_cache`.
+
+    Parameters:
+    -----------
+    cp_commands: string
+        path to the cellprofiler commands file, which has an index
+    logfile_location: string
+        where to store the log files
+    job_file: string
+        name of the analysis log file
+    n_tasks: int
+        number of array tasks
+    line_offset: int (default=0)
+        offset of the pipeline's block of lines in `cp_commands`
+    job_id: string (default="$JOB_ID")
+        shell variable containing the job id, used in the analysis log
+
+    Returns:
+    --------
+    string
+    """
+    text = ""
+    task_id = "$COMMAND_NUM"
+    if line_offset:
+        text += "\nLINE_NUM=$((COMMAND_NUM + {}))\n".format(line_offset)
+        task_id = "$LINE_NUM"
+    text += command_lookup_text(cp_commands, task_id=task_id)
+    text += timed_command_text()
+    text += make_logfile_text(logfile_location, job_file=job_file,
+                              n_tasks=n_tasks, task_id=task_id, job_id=job_id)
+    text += analysis_metrics_text(
+        metrics_dir(logfile_location, "analysis", job_file),
+        task_id=task_id, job_id=job_id)
+    markers_loc = result_cache.markers_path(os.path.dirname(cp_commands))
+    if os.path.isfile(markers_loc):
+        marker_text = command_lookup_text(markers_loc, task_id=task_id)
+        marker_text += 'touch "$SEED"\n'
+        text += '\n# record the successful analysis in the result cache\n'
+        text += 'if [ "$RETURN_VAL" -eq 0 ]; then\n'
+        text += textwrap.indent(marker_text, "    ")
+        text += "fi\n"
+    return text
+
+
+def timed_command_text():
+    """
+    Shell text which runs the cellprofiler command in `$SEED`, setting
+    `$RETURN_VAL` to its exit code, `$WALL_TIME` to how long it took in
+    seconds and `$MAX_RSS` to its peak memory use in kilobytes.
+
+    The peak memory comes from GNU time, if `/usr/bin/time` is missing or
+    isn't GNU time, such as the BSD time on macOS which has no `-f` or
+    `-o`, then `$MAX_RSS` is "NA".
+
+    Returns:
+    --------
+    string
+    """
     text = """
-    # get the exit code from the cellprofiler job
+    # run the cellprofiler job, recording its wall time and peak memory
+    TIME_FILE=$(mktemp)
+    START_TIME=$SECONDS
+    if [ -x /usr/bin/time ] && /usr/bin/time --version 2>&1 | grep -q GNU; then
+        /usr/bin/time -f "%M" -o "$TIME_FILE" $SEED
+    else
+        $SEED
+    fi
     RETURN_VAL=$?
+    WALL_TIME=$((SECONDS - START_TIME))
+    MAX_RSS=$(tail -n 1 "$TIME_FILE")
+    rm -f "$TIME_FILE"
+    case "$MAX_RSS" in
+        ''|*[!0-9]*) MAX_RSS="NA" ;;
+    esac
+    """
+    return textwrap.dedent(text)
+
 
+def make_logfile_text(logfile_location, job_file, n_tasks,
+                      task_id="$SGE_TASK_ID", job_id="$JOB_ID"):
+    """
+    Shell text which appends the outcome of a cellprofiler command to the
+    job's log file, to be run after `timed_command_text`.
+
+    Each line contains the date, job id, command number, status, wall time
+    in seconds and peak memory in kilobytes, separated by two spaces. See
+    `tune.read_log`.
+    """
+    text = """
     if [[ $RETURN_VAL == 0 ]]; then
         RETURN_STATUS="Finished"
     else
@@ -181,14 +685,175 @@ def make_logfile_text(logfile_location, job_file, n_tasks):
     fi
 
     LOG_FILE_LOC={logfile_location}/{job_file}.log
-    echo "`date +"%Y-%m-%d %H:%M"`  "$JOB_ID"  "$SGE_TASK_ID"  "$RETURN_STATUS"" >> "$LOG_FILE_LOC"
+    echo "`date +"%Y-%m-%d %H:%M"`  "{job_id}"  "{task_id}"  "$RETURN_STATUS"  "$WALL_TIME"  "$MAX_RSS"" >> "$LOG_FILE_LOC"
     """.format(logfile_location=logfile_location,
                job_file=job_file,
-               n_tasks=n_tasks)
+               n_tasks=n_tasks,
+               task_id=task_id,
+               job_id=job_id)
     return textwrap.dedent(text)
 
 
-def make_submit_script(commands_location, job_date):
+def rsync_stats_text(command_text):
+    """
+    Shell text which runs `command_text` with rsync reporting the files and
+    bytes it transferred, setting `$RETURN_VAL` to its exit code.
+
+    Rather than changing the staging commands, a wrapper which adds --stats
+    is put ahead of rsync on the PATH. Only POSIX sh is used, as the job
+    scripts aren't necessarily run by bash.
+    """
+    text = textwrap.dedent(
+        """
+        # have rsync report what it transferred, with a wrapper ahead of it on the PATH
+        RSYNC_DIR=$(mktemp -d)
+        if REAL_RSYNC=$(command -v rsync); then
+            printf '#!/bin/sh\\nexec "%s" --stats "$@"\\n' "$REAL_RSYNC" > "$RSYNC_DIR/rsync"
+            chmod +x "$RSYNC_DIR/rsync"
+        fi
+        OLD_PATH=$PATH
+        PATH="$RSYNC_DIR:$PATH"
+        export PATH
+        """
+    )
+    text += command_text + "\n"
+    text += textwrap.dedent(
+        """\
+        RETURN_VAL=$?
+        PATH=$OLD_PATH
+        rm -rf "$RSYNC_DIR"
+        """
+    )
+    return text
+
+
+def metrics_dir(logfile_location, phase, job_file):
+    """
+    directory in which each of a job's `phase` tasks records its metrics,
+    `logfile_location/<phase>/<job_file>`, in a JSON file named after its
+    command's line number
+    """
+    return os.path.join(logfile_location, phase, job_file)
+
+
+def _record_text(fields, values, metrics_dir, task_id):
+    """
+    Shell text which writes a task's JSON record to its own file in
+    `metrics_dir`. Appending to a shared file isn't safe from many nodes
+    over NFS, and the record is moved into place so it's never read half
+    written.
+    """
+    record = "{}/{}.json".format(metrics_dir, task_id)
+    text = 'mkdir -p "{}"\n'.format(metrics_dir)
+    text += "printf '{{{}}}\\n' {} > \"{}.tmp\"\n".format(fields, values, record)
+    text += 'mv "{0}.tmp" "{0}"\n'.format(record)
+    return text
+
+
+def transfer_text(phase, command_text, metrics_dir, task_id="$COMMAND_NUM",
+                  job_id="$JOB_ID"):
+    """
+    Shell text which runs a staging or destaging command and writes a JSON
+    record of it to `metrics_dir`, setting `$RETURN_VAL` to its exit code.
+
+    Each record has the phase, job id, (1-indexed) command, start and end
+    as seconds since the epoch, duration in seconds and exit status. Staging
+    records also have the number of files and bytes rsync transferred, from
+    its --stats, which are null if the command didn't use rsync.
+
+    Parameters:
+    -----------
+    phase: string
+        "staging" or "destaging"
+    command_text: string
+        a single line of shell which runs the command
+    metrics_dir: string
+        directory of the phase's records, see `metrics_dir`
+    task_id: string (default="$COMMAND_NUM")
+        shell variable containing the command's line in its commands file
+    job_id: string (default="$JOB_ID")
+        shell variable containing the job id
+
+    Returns:
+    --------
+    string
+    """
+    staging = phase == "staging"
+    text = textwrap.dedent(
+        """
+        # run the {phase} command, recording how long it took
+        TASK_OUTPUT=$(mktemp)
+        TASK_START=$(date +%s)
+        """.format(phase=phase)
+    )
+    command_text += ' > "$TASK_OUTPUT" 2>&1'
+    if staging:
+        text += rsync_stats_text(command_text)
+    else:
+        text += command_text + "\nRETURN_VAL=$?\n"
+    text += textwrap.dedent(
+        """
+        TASK_END=$(date +%s)
+        cat "$TASK_OUTPUT"
+        """
+    )
+    if staging:
+        text += textwrap.dedent(
+            """
+            # sum what each rsync transferred, older versions don't say "regular"
+            TRANSFERRED=$(awk -F ': ' '
+                /^Number of (regular )?files transferred:/ {gsub(",", "", $2); files += $2; found = 1}
+                /^Total transferred file size:/ {split($2, size, " "); gsub(",", "", size[1]); bytes += size[1]}
+                END {if (found) print files, bytes; else print "null null"}' "$TASK_OUTPUT")
+            TRANSFERRED_FILES=${TRANSFERRED% *}
+            TRANSFERRED_BYTES=${TRANSFERRED#* }
+            """
+        )
+    text += 'rm -f "$TASK_OUTPUT"\n'
+    fields = '"phase": "{}", "job": "%s", "command": %s, "start": %s, ' \
+             '"end": %s, "duration": %s, "status": %s'.format(phase)
+    values = '"{job_id}" "{task_id}" "$TASK_START" "$TASK_END" ' \
+             '"$((TASK_END - TASK_START))" "$RETURN_VAL"'.format(
+                 job_id=job_id, task_id=task_id)
+    if staging:
+        fields += ', "files": %s, "bytes": %s'
+        values += ' "$TRANSFERRED_FILES" "$TRANSFERRED_BYTES"'
+    text += _record_text(fields, values, metrics_dir, task_id)
+    return text
+
+
+def analysis_metrics_text(metrics_dir, task_id="$COMMAND_NUM",
+                          job_id="$JOB_ID"):
+    """
+    Shell text which writes a JSON record of an analysis to `metrics_dir`,
+    to be run after `timed_command_text`.
+
+    Each record has the phase, job id, the command's (1-indexed) line in the
+    cellprofiler commands file, its chunk, i.e line in the staging commands,
+    the start and end as seconds since the epoch, the wall time in seconds,
+    peak memory in kilobytes, which is null if it wasn't recorded, and the
+    exit status.
+    """
+    text = textwrap.dedent(
+        """
+        TASK_END=$(date +%s)
+        if [ "$MAX_RSS" = "NA" ]; then
+            RSS_VALUE=null
+        else
+            RSS_VALUE=$MAX_RSS
+        fi
+        """
+    )
+    fields = '"phase": "analysis", "job": "%s", "command": %s, "chunk": %s, ' \
+             '"start": %s, "end": %s, "duration": %s, "max_rss": %s, "status": %s'
+    values = '"{job_id}" "{task_id}" "$COMMAND_NUM" "$((TASK_END - WALL_TIME))" ' \
+             '"$TASK_END" "$WALL_TIME" "$RSS_VALUE" "$RETURN_VAL"'.format(
+                 job_id=job_id, task_id=task_id)
+    text += _record_text(fields, values, metrics_dir, task_id)
+    return text
+
+
+def make_submit_script(commands_location, job_date, names=None):
     """
     Create a shell script which will submit the staging, analysis and
     destaging scripts.
@@ -199,14 +864,18 @@ def make_submit_script(commands_location, job_date):
         path to where the commands are stored
     job_date: string
         date for the submission scripts
+    names: list (default=None)
+        names of the scripts to submit, in order. If None then the staging,
+        analysis and destaging scripts.
 
     Returns:
     --------
     path to submit_script
     also writes script to disk in `commands_location`.
     """
+    if names is None:
+        names = ["staging", "analysis", "destaging"]
     # create full paths to the generated scripts
-    names = ["staging", "analysis", "destaging"]
     script_dict = {}
     for name in names:
         script_name = "{}_{}_script.sh".format(job_date, name)
@@ -216,22 +885,18 @@ def make_submit_script(commands_location, job_date):
     output = """
              #!/bin/sh
 
-             # This script submits the staging, analysis and destaging
-             # scripts in the correct order
+             # This script submits the job scripts in the correct order
 
              # NOTE: run this as a shell script, NOT a submission script
              # so either call `./name_of_script` or `bash name_of_script`
 
-             qsub {staging_script}
-             qsub {analysis_script}
-             qsub {destaging_script}
-            """.format(staging_script=script_dict["staging"],
-                       analysis_script=script_dict["analysis"],
-                       destaging_script=script_dict["destaging"])
+             """
+    output = textwrap.dedent(output)
+    output += "".join("qsub {}\n".format(script_dict[name]) for name in names)
     save_location = "{}/{}_SUBMIT_JOBS.sh".format(commands_location, job_date)
     # save this shell script and return it's path
     with open(save_location, "w") as f:
-        f.write(textwrap.dedent(output))
+        f.write(output)
     return save_location
 
 
@@ -249,7 +914,8 @@ class BodgeScript(script_generator.AnalysisScript):
     def __init__(self, *args, **kwargs):
         script_generator.AnalysisScript.__init__(self, *args, **kwargs)
 
-    def bodge_array_loop(self, phase, input_file):
+    def bodge_array_loop(self, phase, input_file, n_commands=None,
+                         tasks_per_job=1, metrics_dir=None):
         """
         As a temporary fix (hopefully), this method can work instead of
         scissorhands.script_generator.AnalysisScript.loop_through_file()
@@ -260,21 +926,36 @@ class BodgeScript(script_generator.AnalysisScript):
             prefix of the hidden commands file, e.g "staging" or "destaging"
         input_file: string
             path to a file. This file should contain multiple lines of commands.
-            Each line will be run separately in an array job.
+            Each line will be run separately in an array job. The file needs
+            an index from `write_command_index`.
+        n_commands: int (default=None)
+            number of commands in `input_file`, if None then the lines in
+            `input_file` are counted
+        tasks_per_job: int (default=1)
+            number of commands to run in each array task
+        metrics_dir: string (default=None)
+            directory in which to record each command's metrics, see
+            `transfer_text`. If None then nothing is recorded.
 
         Returns:
         ---------
         nothing, adds text to template
         """
-        text = textwrap.dedent(
+        if n_commands is None:
+            n_commands = utils.count_lines_in_file(input_file)
+        script = '.{phase}_"$JOB_ID"_"$COMMAND_NUM".sh'.format(phase=phase)
+        text = command_lookup_text(input_file, task_id="$COMMAND_NUM")
+        text += textwrap.dedent(
             """
-            SEEDFILE="{input_file}"
-            SEED=$(awk "NR==$SGE_TASK_ID" "$SEEDFILE")
             # create shell script from single command, run, then delete
-            echo "$SEED" > .{phase}_"$JOB_ID"_"$SGE_TASK_ID".sh
-            bash .{phase}_"$JOB_ID"_"$SGE_TASK_ID".sh
-            rm .{phase}_"$JOB_ID"_"$SGE_TASK_ID".sh
-            """.format(phase=phase, input_file=input_file)
+            echo "$SEED" > {script}
+            """.format(script=script)
         )
-        self.template += text
+        if metrics_dir is None:
+            text += "bash {}\n".format(script)
+        else:
+            text += transfer_text(phase, "bash {}".format(script), metrics_dir)
+        text += "rm {}\n".format(script)
+        self.template += command_loop_text(text, n_commands,
+                                           tasks_per_job=tasks_per_job)
 
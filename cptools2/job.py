@@ -3,24 +3,51 @@ TODO: module docstring
 """
 
 import os
+from concurrent import futures
 
-from cptools2 import colours, commands, filelist, loaddata, splitter, utils
+import pandas as pd
+from cptools2 import (catalog, colours, commands, cppipe, filelist, loaddata,
+                      result_cache, utils, writer)
 from cptools2.colours import pretty_print
 
+# policies for the order in which jobs are written to the commands files
+ORDERS = ("plate", "lpt", "interleave")
+# number of images whose size is looked up to estimate the size of the
+# images skipped by selecting channels or imagesets
+CHANNEL_SAMPLE_SIZE = 100
+
 
 class Job(object):
     """
     class to generate staging, analysis and
     de-stating commands for an SGE array job.
+
+    If `streaming` is True then plates are not scanned for images when they
+    are added. Instead each plate is scanned, chunked, has its LoadData
+    created and written to disk in turn in `create_commands`, and is then
+    released, so only about one plate is held in memory at a time.
     """
 
-    def __init__(self, is_new_ix):
+    def __init__(self, is_new_ix, n_workers=None, index_location=None,
+                 streaming=False):
         self.exp_dir = None
         self.chunked = False
+        self.job_size = None
+        self.max_bytes = None
+        self.pack_tails = False
+        self.channels = None
+        self.subset = None
+        self.dropped_images = 0
+        self.dropped_bytes = 0
+        self.cache_hits = 0
         self.plate_store = dict()
+        self.chunk_store = dict()
         self.loaddata_store = dict()
         self.has_loaddata = False
         self.is_new_ix = is_new_ix
+        self.n_workers = n_workers
+        self.index_location = index_location
+        self.streaming = streaming
 
     def add_experiment(self, exp_dir):
         """
@@ -34,7 +61,7 @@ class Job(object):
         self.exp_dir = exp_dir
         plate_paths = filelist.paths_to_plates(exp_dir)
         plate_names = [i.split(os.sep)[-1] for i in plate_paths]
-        img_files = [filelist.files_from_plate(p, is_new_ix=self.is_new_ix) for p in plate_paths]
+        img_files = self._files_from_plates(plate_paths)
         for idx, plate in enumerate(plate_names):
             self.plate_store[plate] = [plate_paths[idx], img_files[idx]]
 
@@ -57,11 +84,11 @@ class Job(object):
         """
         if isinstance(plates, str):
             full_path = os.path.join(exp_dir, plates)
-            img_files = filelist.files_from_plate(full_path, is_new_ix=self.is_new_ix)
+            img_files = self._files_from_plates([full_path])[0]
             self.plate_store[plates] = [full_path, img_files]
         elif isinstance(plates, list):
             full_path = [os.path.join(exp_dir, i) for i in plates]
-            img_files = [filelist.files_from_plate(plate, is_new_ix=self.is_new_ix) for plate in full_path]
+            img_files = self._files_from_plates(full_path)
             for idx, plate in enumerate(plates):
                 self.plate_store[plate] = [full_path[idx], img_files[idx]]
         else:
@@ -78,116 +105,592 @@ class Job(object):
         """
         if isinstance(plates, str):
             self.plate_store.pop(plates)
+            self.chunk_store.pop(plates, None)
         elif isinstance(plates, list):
             for plate in plates:
                 self.plate_store.pop(plate)
+                self.chunk_store.pop(plate, None)
         else:
             raise ValueError("plates has to be a string or a list of strings")
 
-    def chunk(self, job_size=96):
+    def select_channels(self, channels=None, pipeline=None):
+        """
+        only stage and load the images of some channels, this has to be
+        done before chunking
+
+        Parameters:
+        -----------
+        channels : list of ints, or "auto" (default=None)
+            channel numbers to keep. If "auto" or None then the channels
+            are read from `pipeline`, see `cppipe.pipeline_channels`
+        pipeline : string or list of strings (default=None)
+            path to the cellprofiler pipeline, only used to detect the
+            channels. With a list of pipelines the channels used by any of
+            them are kept.
+        """
+        self._check_not_catalogued()
+        if channels is None or channels == "auto":
+            if pipeline is None:
+                raise ValueError("need a pipeline to detect the channels from")
+            channels = set()
+            for _, path in _pipelines(pipeline):
+                channels.update(cppipe.pipeline_channels(path))
+            channels = sorted(channels)
+            if len(channels) == 0:
+                raise ValueError("no channels found in '{}'".format(pipeline))
+            pretty_print("detected channels {} in the pipeline".format(
+                colours.yellow(channels)))
+        if isinstance(channels, int):
+            channels = [channels]
+        self.channels = sorted(int(i) for i in channels)
+
+    def select_imagesets(self, wells=None, rows=None, columns=None, sites=None,
+                         timepoints=None):
+        """
+        only stage and analyse some of each plate's imagesets, this has to
+        be done before chunking. See `catalog.ImageCatalog.select_imagesets`
+
+        Parameters:
+        -----------
+        wells : list of strings (default=None)
+            wells to keep, e.g ["B02", "C03"]
+        rows : list of strings (default=None)
+            well rows to keep
+        columns : list of ints (default=None)
+            well columns to keep
+        sites : list of ints (default=None)
+            sites to keep
+        timepoints : list of ints (default=None)
+            timepoints to keep
+        """
+        self._check_not_catalogued()
+        subset = {"wells": wells, "rows": rows, "columns": columns,
+                  "sites": sites, "timepoints": timepoints}
+        self.subset = {key: value for key, value in subset.items()
+                       if value is not None}
+
+    def _check_not_catalogued(self):
+        """raise an error if any plates have already been catalogued"""
+        if any(isinstance(img_files, catalog.ImageCatalog)
+               for _, img_files in self.plate_store.values()):
+            raise ValueError("channels and imagesets have to be selected before chunking")
+
+    def _drop_images(self, plate, img_files):
+        """
+        remove the imagesets not in `subset` and channels not in `channels`
+        from a plate's ImageCatalog, adding the dropped images to the total
+        skipped. Their size is estimated from a sample of them rather than
+        looking up every file.
+        """
+        dropped = []
+        if self.subset is not None:
+            dropped += img_files.select_imagesets(**self.subset)
+            if len(img_files) == 0:
+                raise ValueError("no imagesets in '{}' match {}".format(
+                    plate, self.subset))
+        if self.channels is not None:
+            dropped += img_files.select_channels(self.channels)
+        if len(dropped) == 0:
+            return
+        step = max(1, len(dropped) // CHANNEL_SAMPLE_SIZE)
+        root = os.path.dirname(self.plate_store[plate][0])
+        sample = [os.path.join(root, i) for i in dropped[::step]]
+        sizes = filelist.file_sizes(sample, n_workers=self.n_workers)
+        self.dropped_images += len(dropped)
+        self.dropped_bytes += int(sum(sizes) / float(len(sizes)) * len(dropped))
+
+    def _files_from_plates(self, plate_paths):
+        """
+        image lists for the plates at `plate_paths`. When streaming the
+        plates aren't scanned yet, and a placeholder of None is returned for
+        each plate.
+        """
+        if self.streaming is True:
+            return [None] * len(plate_paths)
+        return filelist.files_from_plates(plate_paths,
+                                          n_workers=self.n_workers,
+                                          is_new_ix=self.is_new_ix,
+                                          index_location=self.index_location)
+
+    def _scan_plate(self, plate):
+        """image list of a plate in the plate_store"""
+        return filelist.files_from_plate(self.plate_store[plate][0],
+                                         is_new_ix=self.is_new_ix,
+                                         index_location=self.index_location)
+
+    def _catalog_plate(self, plate):
+        """
+        parse the image list of a plate in the plate_store into an
+        ImageCatalog, replacing the image list, and split it into jobs if
+        the job is chunked. The plate is scanned first if this hasn't
+        already been done, and plates which have already been catalogued
+        are left alone.
+        """
+        img_files = self.plate_store[plate][1]
+        if img_files is None:
+            img_files = self._scan_plate(plate)
+        if not isinstance(img_files, catalog.ImageCatalog):
+            img_files = catalog.ImageCatalog(img_files, is_new_ix=self.is_new_ix)
+            if self.channels is not None or self.subset is not None:
+                self._drop_images(plate, img_files)
+            self.plate_store[plate][1] = img_files
+        if self.chunked is True and plate not in self.chunk_store:
+            if self.max_bytes is not None:
+                img_files.stat(root=os.path.dirname(self.plate_store[plate][0]),
+                               n_workers=self.n_workers)
+                chunks = img_files.chunks_by_size(self.max_bytes, self.job_size)
+            else:
+                chunks = img_files.chunks(self.job_size)
+            self.chunk_store[plate] = chunks
+
+    def _catalog_plates(self):
+        """catalog every plate in the plate_store"""
+        for key in self.plate_store:
+            self._catalog_plate(key)
+
+    def _stream_plates(self, platenames):
+        """
+        iterate through plates, scanning the next plate for images in the
+        background while the current plate is processed. At most two
+        plates' image lists are held at once.
+
+        Parameters:
+        -----------
+        platenames: list
+            plate names, keys in plate_store
+
+        Returns:
+        --------
+        generator of plate names, each plate's image list is in the
+        plate_store by the time it is yielded
+        """
+        def scan(plate):
+            if self.plate_store[plate][1] is None:
+                return self._scan_plate(plate)
+            return self.plate_store[plate][1]
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            scans = [executor.submit(scan, plate) for plate in platenames[:1]]
+            for idx, plate in enumerate(platenames):
+                img_files = scans.pop().result()
+                if idx + 1 < len(platenames):
+                    scans.append(executor.submit(scan, platenames[idx + 1]))
+                self.plate_store[plate][1] = img_files
+                yield plate
+
+    def _release_plate(self, plate):
+        """drop a plate's images, jobs and LoadData once it's been written"""
+        self.plate_store[plate][1] = None
+        self.chunk_store.pop(plate, None)
+        self.loaddata_store.pop(plate, None)
+
+    def _chunks(self, plate):
+        """
+        imageset ranges of the jobs for a plate, if the job has not been
+        chunked then this is a single range covering the whole plate
+        """
+        if self.chunked is True:
+            return self.chunk_store[plate]
+        return [(0, len(self.plate_store[plate][1]))]
+
+    def chunk(self, job_size=96, max_bytes=None, pack_tails=False):
         """
         group image list into separate jobs, individually for each plate
 
         Parameters:
         -----------
         job_size : int (default=96)
-            number of imagesets per job
+            number of imagesets per job. If `max_bytes` is given then this
+            is the maximum number of imagesets per job, and can be None.
+        max_bytes : int (default=None)
+            if given then the size of every image is looked up, and each
+            plate is split into jobs of about the same size in bytes with
+            no more than `max_bytes` per job. Imagesets are never split
+            between jobs.
+        pack_tails : Boolean (default=False)
+            if True then the last job of each plate, if it has fewer than
+            `job_size` imagesets, is merged with the other plates' last
+            jobs into jobs of `job_size` imagesets spanning several plates.
         """
-        # for each image_list in the platestore, split into chunks of job_size
-        for key in self.plate_store:
-            chunks = splitter.split(self.plate_store[key][1], job_size)
-            self.plate_store[key][1] = chunks
+        if job_size is None and max_bytes is None:
+            raise ValueError("need at least one of job_size or max_bytes")
+        if pack_tails and (job_size is None or max_bytes is not None):
+            raise ValueError("pack_tails needs a job_size, and can't be used with max_bytes")
+        self.job_size = job_size
+        self.max_bytes = max_bytes
+        self.pack_tails = pack_tails
         self.chunked = True
+        self.chunk_store = dict()
+        # for each plate in the platestore, split into chunks of job_size.
+        # When streaming this is done as each plate is processed
+        if self.streaming is False:
+            self._catalog_plates()
 
-    def _create_loaddata(self, job_size=None):
+    def _create_loaddata(self, job_size=None, plate_loaddata=False):
         """
-        create dictionary store of loaddata modules
-        pretty much mirroring self.plate_store but dataframes instead of
-        list of lists
+        create dictionary store of loaddata modules, a list of dataframes
+        for each plate with a dataframe per job
+
+        if `plate_loaddata` is True then a single dataframe is built for each
+        plate and each job's dataframe is a row slice of it. Rows within a
+        job are then in imageset order (by well then site) rather than sorted
+        by site.
         """
         for key in self.plate_store:
-            self.loaddata_store[key] = []
-            img_list = self.plate_store[key][1]
-            if self.chunked is True:
-                # create a dataframe for each chunk in the imagelist
-                for index, chunk in enumerate(img_list, 1):
-                    # unnest channel groupings
-                    # only there before chunking to keep images together
-                    unnested = list(utils.flatten(chunk))
-                    df_loaddata = loaddata.create_loaddata(unnested, is_new_ix=self.is_new_ix)
-                    if index < len(img_list):
-                        loaddata.check_dataframe_size(df_loaddata, job_size)
-                    self.loaddata_store[key].append(df_loaddata)
-            elif self.chunked is False:
-                # still nested by channels and wells
-                # flatten these nested lists
-                unnested = list(utils.flatten(img_list))
-                # just a single dataframe for the whole imagelist
-                df_loaddata = loaddata.create_loaddata(unnested, is_new_ix=self.is_new_ix)
-                self.loaddata_store[key] = df_loaddata
+            self._plate_loaddata(key, job_size, plate_loaddata=plate_loaddata)
         self.has_loaddata = True
 
-    def create_commands(self, pipeline, location, commands_location, job_size):
+    def _plate_loaddata(self, plate, job_size=None, plate_loaddata=False):
+        """
+        create the list of loaddata dataframes for a single plate, a
+        dataframe per job, and store it in the loaddata_store
+        """
+        self._catalog_plate(plate)
+        image_catalog = self.plate_store[plate][1]
+        chunks = self._chunks(plate)
+        df_plate = image_catalog.plate_loaddata() if plate_loaddata else None
+        self.loaddata_store[plate] = []
+        for index, (start, stop) in enumerate(chunks, 1):
+            if df_plate is not None:
+                df_loaddata = df_plate.iloc[start:stop]
+            else:
+                df_loaddata = image_catalog.loaddata(start, stop)
+            # jobs are only a fixed number of imagesets when not chunked
+            # by size
+            if self.chunked is True and self.max_bytes is None and \
+                    index < len(chunks):
+                loaddata.check_dataframe_size(df_loaddata, job_size)
+            self.loaddata_store[plate].append(df_loaddata)
+
+    def _plate_commands(self, plate, pipeline, location, layout="chunk",
+                        bulk_writer=None, hash_inputs=False):
+        """
+        write the LoadData and filelists for a plate's jobs to disk, and
+        create the staging, analysis and destaging commands for each job
+
+        Parameters:
+        ------------
+        plate : string
+            plate name, key in plate_store
+        pipeline : list of tuples
+            (name, path) of each cellprofiler pipeline, from `_pipelines`
+        location : string
+            file path to location in which the loaddata, images and results
+            will be stored
+        layout : string (default="chunk")
+            "chunk" to write a LoadData csv and filelist per job, or "plate"
+            to write a single LoadData csv and filelist per plate, with each
+            job selecting its rows
+        bulk_writer : writer.BulkWriter (default=None)
+            if given then files are queued on the writer rather than written
+            before this returns
+        hash_inputs : Boolean (default=False)
+            if True then each job's manifest has the digest of its image
+            list and LoadData as "inputs", see `result_cache.inputs_digest`
+
+        Returns:
+        --------
+        tuple of lists: (rsync_commands, cp_commands, rm_commands, manifest)
+            where cp_commands has a list of a command per pipeline for each
+            job, and manifest has a dictionary describing each job
+        """
+        write = _write if bulk_writer is None else bulk_writer.submit
+        rsync_commands, cp_commands, rm_commands, manifest = [], [], [], []
+        image_catalog = self.plate_store[plate][1]
+        chunks = self._chunks(plate)
+        # make sure filepath has a leading forward-slash and remove
+        # the actual plate name or otherwise the rsync commands ends
+        # with the plate-name duplicated
+        plate_loc = self.plate_store[plate][0]
+        plate_loc = os.path.join("/", *plate_loc.split(os.sep)[:-1])
+        plate_filelist = os.path.join(location, "filelist", plate)
+        plate_dataframes, plate_img_list, n_rows = [], [], 0
+        for job_num, dataframe in enumerate(self.loaddata_store[plate]):
+            name = "{}_{}".format(plate, str(job_num))
+            img_list = image_catalog.img_list(*chunks[job_num])
+            img_location = os.path.join(location, "img_data", name)
+            if layout == "chunk":
+                filelist_name = os.path.join(location, "filelist", name)
+                cp_cmnds = _cp_commands(pipeline, name=name, location=location,
+                                        output_name=name)
+                # write loaddata csv to disk
+                write(commands.write_loaddata, name=name, location=location,
+                      dataframe=dataframe)
+                # write filelist to disk
+                write(commands.write_filelist, img_list=img_list,
+                      filelist_name=filelist_name)
+                rsync_cmnd = commands.make_rsync_cmnd(plate_loc=plate_loc,
+                                                      filelist_name=filelist_name,
+                                                      img_location=img_location)
+            else:
+                # this job's rows in the plate's loaddata and filelist,
+                # 1-indexed and inclusive
+                image_sets = (n_rows + 1, n_rows + len(dataframe))
+                lines = (len(plate_img_list) + 1,
+                         len(plate_img_list) + len(img_list))
+                n_rows += len(dataframe)
+                cp_cmnds = _cp_commands(pipeline, name=plate, location=location,
+                                        output_name=name, image_sets=image_sets)
+                plate_dataframes.append(
+                    utils.prefix_filepaths(dataframe, name, location))
+                plate_img_list.extend(img_list)
+                rsync_cmnd = commands.make_rsync_cmnd(plate_loc=plate_loc,
+                                                      filelist_name=plate_filelist,
+                                                      img_location=img_location,
+                                                      lines=lines)
+            cp_commands.append(cp_cmnds)
+            rsync_commands.append(rsync_cmnd)
+            rm_commands.append(commands.rm_string(directory=img_location))
+            start, stop = chunks[job_num]
+            manifest.append({"plate": plate,
+                             "name": name,
+                             "imageset_start": start,
+                             "imageset_stop": stop,
+                             "n_imagesets": stop - start,
+                             "n_images": len(img_list),
+                             "bytes": image_catalog.n_bytes(start, stop)})
+            if hash_inputs is True:
+                manifest[-1]["inputs"] = result_cache.inputs_digest(img_list,
+                                                                    dataframe)
+        if layout == "plate" and plate_dataframes:
+            write(commands.write_loaddata, name=plate, location=location,
+                  dataframe=pd.concat(plate_dataframes), fix_paths=False)
+            write(commands.write_filelist, img_list=plate_img_list,
+                  filelist_name=plate_filelist)
+        return rsync_commands, cp_commands, rm_commands, manifest
+
+    def _pop_tail(self, plate):
+        """
+        remove a plate's last job from the chunk_store and loaddata_store if
+        it has fewer than `job_size` imagesets, so it can be packed with the
+        other plates' last jobs
+
+        Returns:
+        --------
+        dictionary of the plate name, its source directory and the job's
+        loaddata dataframe, or None if the last job is full
+        """
+        chunks = self.chunk_store[plate]
+        if not chunks or chunks[-1][1] - chunks[-1][0] >= self.job_size:
+            return None
+        self.chunk_store[plate] = chunks[:-1]
+        dataframe = self.loaddata_store[plate][-1]
+        self.loaddata_store[plate] = self.loaddata_store[plate][:-1]
+        plate_loc = self.plate_store[plate][0]
+        plate_loc = os.path.join("/", *plate_loc.split(os.sep)[:-1])
+        return {"plate": plate, "plate_loc": plate_loc, "loaddata": dataframe}
+
+    def _packed_commands(self, tails, pipeline, location, bulk_writer=None,
+                         hash_inputs=False):
         """
-        bit of a beast, TODO: refactor
+        pack the plates' last jobs into jobs of `job_size` imagesets, write
+        their LoadData and filelists to disk and create their commands.
+
+        Each packed job has a single LoadData csv, whose rows keep their own
+        plate's metadata, and a filelist and rsync command per source
+        experiment directory.
+
+        Parameters:
+        ------------
+        tails: list
+            last jobs of each plate, from `_pop_tail`
+        pipeline : list of tuples
+            (name, path) of each cellprofiler pipeline, from `_pipelines`
+        location : string
+            file path to location in which the loaddata, images and results
+            will be stored
+        bulk_writer : writer.BulkWriter (default=None)
+            if given then files are queued on the writer rather than written
+            before this returns
+        hash_inputs : Boolean (default=False)
+            if True then each job's manifest has the digest of its image
+            list and LoadData as "inputs"
+
+        Returns:
+        --------
+        tuple of lists: (rsync_commands, cp_commands, rm_commands, manifest)
+        """
+        write = _write if bulk_writer is None else bulk_writer.submit
+        rsync_commands, cp_commands, rm_commands, manifest = [], [], [], []
+        for job_num, pieces in enumerate(_pack_tails(tails, self.job_size)):
+            name = "packed_{}".format(job_num)
+            img_location = os.path.join(location, "img_data", name)
+            dataframe = pd.concat([piece["loaddata"] for piece in pieces],
+                                  ignore_index=True)
+            write(commands.write_loaddata, name=name, location=location,
+                  dataframe=dataframe)
+            # rsync's --files-from paths are relative to a single source
+            # directory, so the plates from each experiment need their own
+            # filelist
+            sources = dict()
+            for piece in pieces:
+                sources.setdefault(piece["plate_loc"], []).extend(
+                    loaddata.image_paths(piece["loaddata"]))
+            rsync_cmnds, n_images, job_img_list = [], 0, []
+            for source_num, (plate_loc, img_list) in enumerate(sources.items()):
+                filelist_name = os.path.join(location, "filelist", name)
+                if len(sources) > 1:
+                    filelist_name += "_{}".format(source_num)
+                write(commands.write_filelist, img_list=img_list,
+                      filelist_name=filelist_name)
+                rsync_cmnds.append(commands.make_rsync_cmnd(
+                    plate_loc=plate_loc, filelist_name=filelist_name,
+                    img_location=img_location))
+                n_images += len(img_list)
+                job_img_list.extend(img_list)
+            rsync_commands.append(" && ".join(rsync_cmnds))
+            cp_commands.append(_cp_commands(pipeline, name=name,
+                                            location=location, output_name=name))
+            rm_commands.append(commands.rm_string(directory=img_location))
+            plates = []
+            for piece in pieces:
+                if piece["plate"] not in plates:
+                    plates.append(piece["plate"])
+            manifest.append({"plate": "+".join(plates),
+                             "name": name,
+                             "imageset_start": None,
+                             "imageset_stop": None,
+                             "n_imagesets": dataframe.shape[0],
+                             "n_images": n_images,
+                             "bytes": None})
+            if hash_inputs is True:
+                manifest[-1]["inputs"] = result_cache.inputs_digest(job_img_list,
+                                                                    dataframe)
+        return rsync_commands, cp_commands, rm_commands, manifest
 
+    def create_commands(self, pipeline, location, commands_location, job_size,
+                        plate_loaddata=False, layout="chunk", n_writers=None,
+                        order="plate", cache=False):
+        """
         create stage, analysis and destage commands and write to disk
 
         Parameters:
         ------------
-        pipeline : string
-            path to cellprofiler pipeline
+        pipeline : string or list of strings
+            path to cellprofiler pipeline. With a list of pipelines each job
+            is staged and destaged once and analysed by every pipeline, the
+            cellprofiler commands file having every job's command for the
+            first pipeline, then for the second etc. and each pipeline's
+            results going to `raw_data/<pipeline name>/<job name>`.
         location : string
             file path to location in which the loaddata, images and results
             will be stored
         commands_location: string
             file path to location in which to store the stage, analysis and
             destage commands.
+        job_size: int
+            number of imagesets per job, used to check the LoadData
+            dataframes are the expected size
+        plate_loaddata: Boolean (default=False)
+            build the LoadData once per plate and slice it into jobs, rather
+            than building it separately for each job
+        layout: string (default="chunk")
+            "chunk" writes a LoadData csv and filelist for every job.
+            "plate" writes a single LoadData csv and filelist per plate, each
+            job's cellprofiler command selecting its image sets with the
+            -f/-l flags and its staging command selecting its lines of the
+            filelist.
+        n_writers: int (default=None)
+            number of LoadData csv files and filelists to write concurrently,
+            if None then uses `writer.N_WORKERS`
+        order: string (default="plate")
+            order of the jobs in the commands files, one of `ORDERS`.
+            "plate" runs each plate's jobs in turn, "lpt" runs the jobs with
+            the most imagesets (then bytes) first so the largest don't
+            extend the end of the run, and "interleave" takes a job from
+            each plate in turn to spread the staging across plates.
+        cache: Boolean (default=False)
+            skip the jobs whose analyses have already succeeded, as recorded
+            in the result cache in `location`, see `result_cache`. A job
+            with more than one pipeline is analysed by all of them again
+            unless every one of its analyses is cached.
         """
+        if layout not in ("chunk", "plate"):
+            raise ValueError("layout has to be either 'chunk' or 'plate'")
+        if order not in ORDERS:
+            raise ValueError("order has to be one of {}".format(ORDERS))
+        pipeline = _pipelines(pipeline)
         pretty_print("creating image list")
-        if self.has_loaddata is False:
-            self._create_loaddata(job_size)
-        cp_commands, rsync_commands, rm_commands = [], [], []
+        streaming = self.streaming is True and self.has_loaddata is False
+        if self.has_loaddata is False and streaming is False:
+            self._create_loaddata(job_size, plate_loaddata=plate_loaddata)
+        cp_commands, rsync_commands, rm_commands, manifest = [], [], [], []
         pretty_print("creating output directories at {}".format(colours.yellow(location)))
         commands.make_output_directories(location=location)
+        if len(pipeline) > 1:
+            for pipeline_name, _ in pipeline:
+                utils.make_dir(os.path.join(location, "raw_data", pipeline_name))
         # for each job per plate, create loaddata and commands
         platenames = sorted(self.plate_store.keys())
         pretty_print("detected {} {}".format(
             colours.yellow(len(platenames)),
             colours.purple("plates"))
         )
-        for i, plate in enumerate(platenames, 1):
-            print(colours.purple("\t {}.".format(i)), colours.yellow("{}".format(plate)))
-            for job_num, dataframe in enumerate(self.loaddata_store[plate]):
-                name = "{}_{}".format(plate, str(job_num))
-                output_loc = os.path.join(location, "raw_data", name)
-                img_list = list(utils.flatten(self.plate_store[plate][1][job_num]))
-                filelist_name = os.path.join(location, "filelist", name)
-                img_location = os.path.join(location, "img_data", name)
-                plate_loc = self.plate_store[plate][0]
-                # make sure filepath has a leading forward-slash and remove
-                # the actual plate name or otherwise the rsync commands ends
-                # with the plate-name duplicated
-                plate_loc = os.path.join("/", *plate_loc.split(os.sep)[:-1])
-                # append cp commands
-                cp_cmnd = commands.make_cp_cmnd(name=name, pipeline=pipeline,
-                                                location=location,
-                                                output_loc=output_loc)
-                cp_commands.append(cp_cmnd)
-                # write loaddata csv to disk
-                commands.write_loaddata(name=name, location=location,
-                                        dataframe=dataframe)
-                # write filelist to disk
-                commands.write_filelist(img_list=img_list,
-                                        filelist_name=filelist_name)
-                # append rsync commands
-                rsync_cmnd = commands.make_rsync_cmnd(plate_loc=plate_loc,
-                                                      filelist_name=filelist_name,
-                                                      img_location=img_location)
-                rsync_commands.append(rsync_cmnd)
-                # make and append rm command
-                rm_cmd = commands.rm_string(directory=img_location)
-                rm_commands.append(rm_cmd)
+        # the commands are only written once every loaddata csv and filelist
+        # has been written and synced to disk
+        tails = []
+        if streaming is True:
+            platenames = self._stream_plates(platenames)
+        with writer.BulkWriter(n_workers=n_writers) as bulk_writer:
+            for i, plate in enumerate(platenames, 1):
+                print(colours.purple("\t {}.".format(i)), colours.yellow("{}".format(plate)))
+                if streaming is True:
+                    self._plate_loaddata(plate, job_size,
+                                         plate_loaddata=plate_loaddata)
+                if self.pack_tails is True:
+                    tail = self._pop_tail(plate)
+                    if tail is not None:
+                        tails.append(tail)
+                plate_rsync, plate_cp, plate_rm, plate_manifest = self._plate_commands(
+                    plate, pipeline=pipeline, location=location, layout=layout,
+                    bulk_writer=bulk_writer, hash_inputs=cache)
+                rsync_commands.extend(plate_rsync)
+                cp_commands.extend(plate_cp)
+                rm_commands.extend(plate_rm)
+                manifest.extend(plate_manifest)
+                if self.max_bytes is not None:
+                    _print_chunk_sizes(plate_manifest)
+                if streaming is True:
+                    self._release_plate(plate)
+            if tails:
+                packed = self._packed_commands(tails, pipeline=pipeline,
+                                               location=location,
+                                               bulk_writer=bulk_writer,
+                                               hash_inputs=cache)
+                pretty_print("packed the last jobs of {} plates into {} jobs".format(
+                    colours.yellow(len(tails)), colours.yellow(len(packed[0]))))
+                rsync_commands.extend(packed[0])
+                cp_commands.extend(packed[1])
+                rm_commands.extend(packed[2])
+                manifest.extend(packed[3])
+        if self.channels is not None or self.subset is not None:
+            pretty_print("skipped {} images (about {}) not in the selected "
+                         "channels or imagesets".format(
+                             colours.yellow(self.dropped_images),
+                             colours.yellow(utils.format_bytes(self.dropped_bytes))))
+        # reorder every commands file and the manifest together so they
+        # stay line-aligned
+        job_order = _order_jobs(manifest, order)
+        rsync_commands = [rsync_commands[i] for i in job_order]
+        cp_commands = [cp_commands[i] for i in job_order]
+        rm_commands = [rm_commands[i] for i in job_order]
+        manifest = [dict(manifest[i], order=order) for i in job_order]
+        keys = None
+        if cache is True:
+            rsync_commands, cp_commands, rm_commands, manifest, keys = \
+                self._skip_cached(rsync_commands, cp_commands, rm_commands,
+                                  manifest, pipeline, location)
+        # every job's analysis with the first pipeline, then with the
+        # second etc. so each pipeline's commands are a block of lines
+        cp_commands = [job[p] for p in range(len(pipeline)) for job in cp_commands]
+        manifest = [dict(job, pipeline=pipeline_name, chunk=chunk,
+                         key=keys[chunk - 1][p] if keys else None)
+                    for p, (pipeline_name, _) in enumerate(pipeline)
+                    for chunk, job in enumerate(manifest, 1)]
+        for job in manifest:
+            job.pop("inputs", None)
+        if len(pipeline) > 1:
+            pretty_print("analysing each job with {} pipelines".format(
+                colours.yellow(len(pipeline))))
         # write commands to disk as a txt file
         pretty_print("creating image filelist")
         pretty_print("creating csv files for LoadData")
@@ -198,8 +701,207 @@ class Job(object):
                                 rsync_commands=rsync_commands,
                                 cp_commands=cp_commands,
                                 rm_commands=rm_commands)
+        commands.write_manifest(commands_location, manifest)
+        markers_loc = result_cache.markers_path(commands_location)
+        if cache is True:
+            result_cache.write_markers(
+                commands_location,
+                [result_cache.marker_path(location, job["key"]) for job in manifest])
+            if not manifest:
+                # nothing left to run
+                return
+        elif os.path.isfile(markers_loc):
+            # left from a cached run, and no longer lines up with the commands
+            os.remove(markers_loc)
         # check commands files are not empty, raise an error if they are
         names = ["staging", "cp_commands", "destaging"]
         cmnds_files = [os.path.join(commands_location, name + ".txt") for name in names]
         for cmnd_file in cmnds_files:
             commands.check_commands(cmnd_file)
+
+
+    def _skip_cached(self, rsync_commands, cp_commands, rm_commands, manifest,
+                     pipeline, location):
+        """
+        remove the jobs whose analyses with every pipeline have already
+        succeeded from the commands and manifest
+
+        Parameters:
+        -----------
+        rsync_commands, cp_commands, rm_commands, manifest: lists
+            an entry per job, the manifest with the digest of each job's
+            inputs
+        pipeline : list of tuples
+            (name, path) of each cellprofiler pipeline, from `_pipelines`
+        location : string
+            file path to location containing the result cache
+
+        Returns:
+        --------
+        tuple of the lists of the jobs left to run, the same as the
+        arguments, followed by the cache key of each of their analyses
+        """
+        utils.make_dir(os.path.join(location, result_cache.CACHE_DIR))
+        digests = [result_cache.pipeline_digest(path) for _, path in pipeline]
+        keep, keys = [], []
+        for i, job in enumerate(manifest):
+            job_keys = [result_cache.cache_key(digest, job["inputs"])
+                        for digest in digests]
+            if not all(result_cache.is_cached(location, key) for key in job_keys):
+                keep.append(i)
+                keys.append(job_keys)
+        self.cache_hits = len(manifest) - len(keep)
+        pretty_print("found {} of {} jobs in the result cache, {} left to run".format(
+            colours.yellow(self.cache_hits), colours.yellow(len(manifest)),
+            colours.yellow(len(keep))))
+        return ([rsync_commands[i] for i in keep],
+                [cp_commands[i] for i in keep],
+                [rm_commands[i] for i in keep],
+                [manifest[i] for i in keep],
+                keys)
+
+
+def _pipelines(pipeline):
+    """
+    name and path of each cellprofiler pipeline
+
+    Parameters:
+    -----------
+    pipeline: string or list of strings
+        path to a cellprofiler pipeline, or a list of paths
+
+    Returns:
+    --------
+    list of (name, path) tuples, where the name is the pipeline's filename
+    without its extension, suffixed with a number if it is not unique
+    """
+    paths = [pipeline] if isinstance(pipeline, str) else list(pipeline)
+    if len(paths) == 0:
+        raise ValueError("need at least one pipeline")
+    pipelines, seen = [], dict()
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        seen[name] = seen.get(name, 0) + 1
+        if seen[name] > 1:
+            name = "{}_{}".format(name, seen[name])
+        pipelines.append((name, path))
+    return pipelines
+
+
+def _cp_commands(pipelines, name, location, output_name, image_sets=None):
+    """
+    cellprofiler command for each pipeline, see `commands.make_cp_cmnd`.
+    The results are stored in raw_data/<output_name>, or in
+    raw_data/<pipeline name>/<output_name> when there is more than one
+    pipeline.
+
+    Returns:
+    --------
+    list of strings, a command per pipeline
+    """
+    cp_cmnds = []
+    for pipeline_name, path in pipelines:
+        if len(pipelines) > 1:
+            output_loc = os.path.join(location, "raw_data", pipeline_name,
+                                      output_name)
+        else:
+            output_loc = os.path.join(location, "raw_data", output_name)
+        cp_cmnds.append(commands.make_cp_cmnd(name=name, pipeline=path,
+                                              location=location,
+                                              output_loc=output_loc,
+                                              image_sets=image_sets))
+    return cp_cmnds
+
+
+def _pack_tails(tails, job_size):
+    """
+    pack plates' last jobs into jobs of `job_size` imagesets, in plate order.
+    A plate's last job can be split between two packed jobs, and only plates
+    with the same LoadData columns (i.e the same channels) are packed
+    together.
+
+    Parameters:
+    -----------
+    tails: list
+        last jobs of each plate, from `Job._pop_tail`
+    job_size: int
+        number of imagesets per packed job
+
+    Returns:
+    --------
+    list of packed jobs, each a list of pieces of the plates' last jobs in
+    the same format as `tails`
+    """
+    groups = dict()
+    for tail in tails:
+        groups.setdefault(tuple(tail["loaddata"].columns), []).append(tail)
+    packed = []
+    for group in groups.values():
+        job, n_imagesets = [], 0
+        for tail in group:
+            dataframe = tail["loaddata"]
+            start = 0
+            while start < dataframe.shape[0]:
+                stop = min(dataframe.shape[0], start + job_size - n_imagesets)
+                job.append(dict(tail, loaddata=dataframe.iloc[start:stop]))
+                n_imagesets += stop - start
+                start = stop
+                if n_imagesets == job_size:
+                    packed.append(job)
+                    job, n_imagesets = [], 0
+        if job:
+            packed.append(job)
+    return packed
+
+
+def _order_jobs(manifest, order="plate"):
+    """
+    order in which to write the jobs to the commands files
+
+    Parameters:
+    -----------
+    manifest: list of dicts
+        a dictionary per job in plate order, as from `Job._plate_commands`
+    order: string (default="plate")
+        one of `ORDERS`, see `Job.create_commands`
+
+    Returns:
+    --------
+    list of indices into `manifest`
+    """
+    if order == "plate":
+        return list(range(len(manifest)))
+    if order == "lpt":
+        # sorted is stable, so equal jobs stay in plate order
+        return sorted(range(len(manifest)),
+                      key=lambda i: (-manifest[i]["n_imagesets"],
+                                     -(manifest[i]["bytes"] or 0)))
+    if order == "interleave":
+        plates = dict()
+        for i, job in enumerate(manifest):
+            plates.setdefault(job["plate"], []).append(i)
+        # the nth job of every plate, then the n+1th etc.
+        rounds = dict()
+        for plate_jobs in plates.values():
+            for n, i in enumerate(plate_jobs):
+                rounds.setdefault(n, []).append(i)
+        return [i for n in sorted(rounds) for i in rounds[n]]
+    raise ValueError("order has to be one of {}".format(ORDERS))
+
+
+def _print_chunk_sizes(manifest):
+    """print the smallest, median and largest job sizes of a plate"""
+    chunk_bytes = sorted(job["bytes"] for job in manifest)
+    if len(chunk_bytes) == 0:
+        return
+    print(colours.purple("\t    {} jobs of".format(len(chunk_bytes))),
+          colours.yellow("{} / {} / {}".format(
+              utils.format_bytes(chunk_bytes[0]),
+              utils.format_bytes(chunk_bytes[len(chunk_bytes) // 2]),
+              utils.format_bytes(chunk_bytes[-1]))),
+          colours.purple("(min / median / max)"))
+
+
+def _write(func, *args, **kwargs):
+    """write a file straight away, same signature as BulkWriter.submit"""
+    return func(*args, **kwargs)
@@ -2,11 +2,21 @@
 Create dataframes/csv-files for CellProfiler's LoadData module
 """
 
+import os
 import textwrap
 
+import numpy as _np
 import pandas as _pd
-from cptools2 import utils
-from parserix import parse as _parse
+from cptools2 import metadata, utils
+
+
+# columns of the long-format loaddata dataframe
+LONG_COLUMNS = ["URL", "path", "Metadata_platename", "Metadata_well",
+                "Metadata_site", "Metadata_channel", "Metadata_platenum"]
+
+# columns identifying an imageset, the wide dataframe is sorted by these
+INDEX_COLUMNS = ["Metadata_site", "Metadata_well", "Metadata_platenum",
+                 "Metadata_platename", "path"]
 
 
 def create_loaddata(img_list, is_new_ix=False):
@@ -41,24 +51,18 @@ def create_long_loaddata(img_list, is_new_ix=False):
     --------
     pandas DataFrame
     """
-    old_path = False if is_new_ix else True
-    just_filenames = [_parse.img_filename(i) for i in img_list]
-    df_img = _pd.DataFrame({
-        "URL": just_filenames,
-        "path": [_parse.path(i) for i in img_list],
-        "Metadata_platename": [_parse.plate_name(i, old_path=old_path) for i in img_list],
-        "Metadata_well": [_parse.img_well(i) for i in just_filenames],
-        "Metadata_site": [_parse.img_site(i) for i in just_filenames],
-        "Metadata_channel": [_parse.img_channel(i) for i in just_filenames],
-        "Metadata_platenum": [_parse.plate_num(i, old_path=old_path) for i in img_list]
-        })
-    return df_img
+    df_img = metadata.parse_img_list(img_list, is_new_ix=is_new_ix)
+    return df_img[LONG_COLUMNS]
 
 
 def cast_dataframe(dataframe, check_nan=True):
     """
     reshape a create_loaddata dataframe from long to wide format
 
+    When every imageset has exactly one image per channel the wide dataframe
+    is built directly from the sorted long dataframe, otherwise this falls
+    back to a pivot table. Both give the same columns and row order.
+
     Parameters:
     -----------
     dataframe: pandas DataFrame
@@ -70,25 +74,138 @@ def cast_dataframe(dataframe, check_nan=True):
     --------
     pandas DataFrame
     """
-    n_channels = len(set(dataframe.Metadata_channel))
+    wide_df = _reshape_dataframe(dataframe)
+    if wide_df is None:
+        wide_df = _pivot_dataframe(dataframe)
+    if check_nan is True:
+        if utils.any_nan_values(dataframe):
+            raise LoadDataError("dataframe contains missing values")
+    return wide_df
+
+
+def _reshape_dataframe(dataframe):
+    """
+    reshape a long loaddata dataframe to wide format by sorting the rows into
+    imagesets and reshaping the filenames into a column per channel.
+
+    Parameters:
+    -----------
+    dataframe: pandas DataFrame
+        long loaddata dataframe
+
+    Returns:
+    --------
+    pandas DataFrame, or None if the imagesets do not all have exactly one
+    image per channel
+    """
+    n_rows = dataframe.shape[0]
+    channels = _np.sort(dataframe["Metadata_channel"].unique())
+    n_channels = len(channels)
+    if n_rows == 0 or n_rows % n_channels != 0:
+        return None
+    # same row order as the pivot table: sorted by the index columns
+    values = {col: dataframe[col].to_numpy() for col in INDEX_COLUMNS}
+    keys = [_pd.factorize(values[col], sort=True)[0] for col in INDEX_COLUMNS]
+    channel_codes = _np.searchsorted(channels, dataframe["Metadata_channel"].to_numpy())
+    order = _np.lexsort([channel_codes] + keys[::-1])
+    # each block of n_channels rows has to be a single imageset with every
+    # channel, otherwise the channels are ragged
+    if not (channel_codes[order].reshape(-1, n_channels) == _np.arange(n_channels)).all():
+        return None
+    for key in keys:
+        blocks = key[order].reshape(-1, n_channels)
+        if not (blocks == blocks[:, :1]).all():
+            return None
+    first_rows = order[::n_channels]
+    metadata_columns = {col: values[col][first_rows] for col in INDEX_COLUMNS[:-1]}
+    filenames = dataframe["URL"].to_numpy()[order].reshape(-1, n_channels)
+    return wide_dataframe(metadata_columns, filenames,
+                          values["path"][first_rows], channels)
+
+
+def wide_dataframe(metadata_columns, filenames, paths, channels):
+    """
+    assemble a wide loaddata dataframe from arrays with a row per imageset
+
+    Parameters:
+    -----------
+    metadata_columns: dict
+        Metadata_site, Metadata_well, Metadata_platenum and
+        Metadata_platename arrays
+    filenames: numpy.ndarray
+        2D array of filenames with a row per imageset and a column per channel
+    paths: array-like
+        image directory of each imageset
+    channels: array-like
+        channel number of each column in `filenames`
+
+    Returns:
+    --------
+    pandas DataFrame
+    """
+    columns = dict(metadata_columns)
+    for i, channel in enumerate(channels):
+        columns["FileName_W{}".format(channel)] = filenames[:, i]
+    for channel in channels:
+        columns["PathName_W{}".format(channel)] = paths
+    wide_df = _pd.DataFrame(columns)
+    wide_df.columns.name = "Metadata_channel"
+    return wide_df
+
+
+def image_paths(dataframe):
+    """
+    image paths in a wide loaddata dataframe, before its paths have been
+    prefixed, i.e each PathName joined to its FileName
+
+    Parameters:
+    -----------
+    dataframe: pandas DataFrame
+        wide loaddata dataframe
+
+    Returns:
+    --------
+    list of image paths, row by row
+    """
+    channels = [col[len("FileName_"):] for col in dataframe.columns
+                if col.startswith("FileName_")]
+    img_list = []
+    for row in zip(*[zip(dataframe["PathName_" + i], dataframe["FileName_" + i])
+                     for i in channels]):
+        img_list.extend(os.path.join(path, filename) for path, filename in row
+                        if isinstance(filename, str))
+    return img_list
+
+
+def _pivot_dataframe(dataframe):
+    """
+    reshape a long loaddata dataframe to wide format with a pivot table, this
+    copes with imagesets that are missing channels.
+
+    Parameters:
+    -----------
+    dataframe: pandas DataFrame
+        long loaddata dataframe
+
+    Returns:
+    --------
+    pandas DataFrame
+    """
+    channels = sorted(set(dataframe.Metadata_channel))
     wide_df = dataframe.pivot_table(
-        index=["Metadata_site", "Metadata_well", "Metadata_platenum",
-               "Metadata_platename", "path"],
+        index=INDEX_COLUMNS,
         columns="Metadata_channel",
         values="URL",
         aggfunc="first").reset_index()
     # rename FileName columns from 1, 2... to FileName_W1, FileName_W2 ...
     columns = {}
-    for i in range(1, n_channels+1):
+    for i in channels:
         columns[i] = "FileName_W{0}".format(str(i))
     wide_df.rename(columns=columns, inplace=True)
     # duplicate PathName for each channel
-    for i in range(1, n_channels+1):
+    for i in channels:
         wide_df["PathName_W" + str(i)] = wide_df.path
     wide_df.drop(["path"], axis=1, inplace=True)
-    if check_nan is True:
-        if utils.any_nan_values(dataframe):
-            raise LoadDataError("dataframe contains missing values")
     return wide_df
 
 
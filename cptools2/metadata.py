@@ -0,0 +1,218 @@
+"""
+Parse metadata from ImageXpress image paths in bulk.
+
+This does the same job as calling the `parserix.parse` functions on each
+path, but parses a whole image list at once with compiled regular
+expressions. Directory-level metadata (plate name and number) is only parsed
+once per unique directory rather than once per image.
+"""
+
+import os
+import re
+
+import pandas as _pd
+
+# well, site and channel are the last three underscore separated fields of
+# the filename, e.g "val screen_B02_s1_w1AD0ABEBC-3BA8-4199.tif".
+# This is matched against newline-joined filenames, one match per line.
+_FILENAME_REGEX = re.compile(
+    r"_(?P<Metadata_well>[^_\n]+)"
+    r"_s(?P<Metadata_site>[0-9]+)"
+    r"_w(?P<Metadata_channel>[0-9])[^_\n]*$",
+    re.MULTILINE
+)
+
+# old IX paths: plate_name/date/plate_num/image
+_DIR_REGEX_OLD = re.compile(
+    r"(?:^|/)(?P<Metadata_platename>[^/]+)/[^/]+/(?P<Metadata_platenum>[^/]+)$"
+)
+
+# new IX paths have an extra timepoint directory:
+# plate_name/date/plate_num/TimePoint_n/image
+_DIR_REGEX_NEW = re.compile(
+    r"(?:^|/)(?P<Metadata_platename>[^/]+)/[^/]+/(?P<Metadata_platenum>[^/]+)/[^/]+$"
+)
+
+COLUMNS = ["img_paths", "URL", "path", "Metadata_platename", "Metadata_well",
+           "Metadata_site", "Metadata_channel", "Metadata_platenum"]
+
+IMAGE_COLUMNS = ["img_paths", "URL", "dir_code", "Metadata_well",
+                 "Metadata_site", "Metadata_channel"]
+
+DIRECTORY_COLUMNS = ["path", "Metadata_platename", "Metadata_platenum"]
+
+FILENAME_COLUMNS = ["img_paths", "URL", "Metadata_well", "Metadata_site",
+                    "Metadata_channel"]
+
+
+def parse_img_list(img_list, is_new_ix=False):
+    """
+    parse metadata from every path in an image list
+
+    Parameters:
+    -----------
+    img_list: list
+        list of image paths
+    is_new_ix: Boolean (default=False)
+        whether or not the filepaths are from the new ImageXpress
+        which alters how they are parsed.
+
+    Returns:
+    --------
+    pandas DataFrame, a row per image with the columns:
+        img_paths, URL, path, Metadata_platename, Metadata_well,
+        Metadata_site, Metadata_channel, Metadata_platenum
+    """
+    images, directories = parse_img_table(img_list, is_new_ix=is_new_ix)
+    codes = images["dir_code"].values
+    df_img = images.drop("dir_code", axis=1)
+    for col in DIRECTORY_COLUMNS:
+        df_img[col] = directories[col].values[codes]
+    return df_img[COLUMNS]
+
+
+def parse_filenames(img_list):
+    """
+    parse the well, site and channel from the filename of every path in an
+    image list. Unlike `parse_img_list` the directories aren't parsed, so
+    this works on bare filenames and either ImageXpress layout.
+
+    Parameters:
+    -----------
+    img_list: list
+        list of image paths or filenames
+
+    Returns:
+    --------
+    pandas DataFrame, a row per image with the columns:
+        img_paths, URL, Metadata_well, Metadata_site, Metadata_channel
+    """
+    img_list = list(img_list)
+    if len(img_list) == 0:
+        return _pd.DataFrame({col: [] for col in FILENAME_COLUMNS})
+    filenames = [i.rpartition(os.sep)[2] for i in img_list]
+    file_meta = _parse_filenames(img_list, filenames)
+    return _pd.DataFrame({
+        "img_paths": img_list,
+        "URL": filenames,
+        "Metadata_well": file_meta[0],
+        "Metadata_site": _to_int(file_meta[1]),
+        "Metadata_channel": _to_int(file_meta[2])
+    })[FILENAME_COLUMNS]
+
+
+def parse_img_table(img_list, is_new_ix=False):
+    """
+    parse metadata from every path in an image list, keeping image-level
+    and directory-level metadata in separate tables.
+
+    Parameters:
+    -----------
+    img_list: list
+        list of image paths
+    is_new_ix: Boolean (default=False)
+        whether or not the filepaths are from the new ImageXpress
+        which alters how they are parsed.
+
+    Returns:
+    --------
+    tuple of two pandas DataFrames:
+        images: a row per image with the columns img_paths, URL, dir_code,
+            Metadata_well, Metadata_site, Metadata_channel
+        directories: a row per unique image directory with the columns
+            path, Metadata_platename, Metadata_platenum. `dir_code` in
+            `images` is the row number in this table.
+    """
+    img_list = list(img_list)
+    if len(img_list) == 0:
+        return (_pd.DataFrame({col: [] for col in IMAGE_COLUMNS}),
+                _pd.DataFrame({col: [] for col in DIRECTORY_COLUMNS}))
+    dirs, _, filenames = zip(*[i.rpartition(os.sep) for i in img_list])
+    file_meta = _parse_filenames(img_list, filenames)
+    # a plate only has a handful of directories, so parse each once
+    dir_codes, unique_dirs = _pd.factorize(_pd.Series(dirs, dtype=object))
+    dir_regex = _DIR_REGEX_NEW if is_new_ix else _DIR_REGEX_OLD
+    dir_meta = _pd.Series(unique_dirs, dtype=object).str.extract(dir_regex)
+    failed_dirs = dir_meta.isnull().any(axis=1).values
+    if failed_dirs.any():
+        _raise_parse_error([i for i, code in zip(img_list, dir_codes)
+                            if failed_dirs[code]])
+    images = _pd.DataFrame({
+        "img_paths": img_list,
+        "URL": filenames,
+        "dir_code": dir_codes,
+        "Metadata_well": file_meta[0],
+        "Metadata_site": _to_int(file_meta[1]),
+        "Metadata_channel": _to_int(file_meta[2])
+    })
+    directories = _pd.DataFrame({
+        "path": list(unique_dirs),
+        "Metadata_platename": dir_meta["Metadata_platename"].values,
+        "Metadata_platenum": dir_meta["Metadata_platenum"].values
+    })
+    return images[IMAGE_COLUMNS], directories[DIRECTORY_COLUMNS]
+
+
+def _parse_filenames(img_list, filenames):
+    """
+    parse well, site and channel from image filenames
+
+    All filenames are matched in a single pass of the regex engine over the
+    newline-joined filenames, which avoids the overhead of a python function
+    call per image.
+
+    Parameters:
+    -----------
+    img_list: list
+        list of image paths, only used for error messages
+    filenames: list
+        image filenames, in the same order as `img_list`
+
+    Returns:
+    --------
+    tuple of (wells, sites, channels), each a tuple of strings
+    """
+    matches = _FILENAME_REGEX.findall("\n".join(filenames))
+    if len(matches) != len(filenames):
+        _raise_parse_error([path for path, name in zip(img_list, filenames)
+                            if _FILENAME_REGEX.search(name) is None])
+    return tuple(zip(*matches))
+
+
+def _to_int(values):
+    """
+    convert a sequence of integer strings to an integer array, there are only
+    a few distinct sites and channels so only convert the unique values
+
+    Parameters:
+    -----------
+    values: sequence of strings
+
+    Returns:
+    --------
+    numpy array of integers
+    """
+    codes, uniques = _pd.factorize(_pd.Series(values, dtype=object))
+    return _pd.Series([int(i) for i in uniques], dtype="int64").values[codes]
+
+
+def _raise_parse_error(bad_paths):
+    """
+    raise a MetadataError listing the paths which could not be parsed
+
+    Parameters:
+    -----------
+    bad_paths: list
+        image paths which failed to parse
+
+    Returns:
+    --------
+    nothing, raises a MetadataError
+    """
+    msg = "failed to parse metadata from {} image path(s), e.g: '{}'".format(
+        len(bad_paths), bad_paths[0] if bad_paths else None)
+    raise MetadataError(msg)
+
+
+class MetadataError(Exception):
+    pass
@@ -0,0 +1,275 @@
+"""
+Report where the time of a run went, from the metrics its tasks recorded.
+
+Every staging, analysis and destaging task writes a JSON record of its
+start, end, duration and exit status to its own file,
+`location/logfiles/<phase>/<job>/<command>.json`, with the files and bytes
+rsync transferred for staging and the peak memory for analysis, see
+`generate_scripts.transfer_text` and `generate_scripts.analysis_metrics_text`.
+These are summarised per phase as throughput, in images and megabytes a
+second over the phase's span, and the median and tail durations, along with
+the slowest analyses.
+
+usage: cptools2 metrics config.yml [--job JOB] [--slowest N]
+"""
+
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from cptools2 import generate_scripts, parse_yaml
+from cptools2.colours import pretty_print, yellow
+
+PHASES = ["staging", "analysis", "destaging"]
+SUMMARY_COLUMNS = ["tasks", "failed", "span", "images/s", "MB/s",
+                   "median", "p90", "p99", "max"]
+
+
+def rsync_stats(text):
+    """
+    files and bytes transferred, summed over the `rsync --stats` reports in
+    `text`
+
+    Returns:
+    --------
+    tuple of (files, bytes), both None if there are no reports
+    """
+    n_files, n_bytes, found = 0, 0, False
+    for line in text.splitlines():
+        if line.startswith(("Number of regular files transferred:",
+                            "Number of files transferred:")):
+            n_files += int(line.split(":", 1)[1].strip().replace(",", ""))
+            found = True
+        elif line.startswith("Total transferred file size:"):
+            size = line.split(":", 1)[1].split()[0]
+            n_bytes += int(size.replace(",", ""))
+    if not found:
+        return None, None
+    return n_files, n_bytes
+
+
+def write_record(metrics_dir, record):
+    """
+    write a task's record to its own file in `metrics_dir`, named after its
+    command, replacing any record of an earlier run of the command
+    """
+    if not os.path.isdir(metrics_dir):
+        os.makedirs(metrics_dir, exist_ok=True)
+    path = os.path.join(metrics_dir, "{}.json".format(record["command"]))
+    with open(path + ".tmp", "w") as f:
+        f.write(json.dumps(record) + "\n")
+    os.replace(path + ".tmp", path)
+
+
+def latest_job(logfile_location):
+    """
+    name of the job with the most recently modified record in
+    `logfile_location`
+    """
+    files = glob.glob(os.path.join(logfile_location, "*", "*", "*.json"))
+    files = [i for i in files
+             if os.path.basename(os.path.dirname(os.path.dirname(i))) in PHASES]
+    if len(files) == 0:
+        raise MetricsError("no metrics found in '{}'".format(logfile_location))
+    return os.path.basename(os.path.dirname(max(files, key=os.path.getmtime)))
+
+
+def job_commands(commands_location, job):
+    """
+    directory of the commands run by `job`, either `commands_location` or one
+    of the `rerun_*` directories within it, from the jobs recorded by
+    `generate_scripts.record_job`
+
+    Returns:
+    --------
+    string, path to the commands directory, or None if none records the job
+    """
+    for directory, subdirs, _ in os.walk(commands_location):
+        if job in generate_scripts.recorded_jobs(directory):
+            return directory
+        # only reruns' directories can hold commands
+        subdirs[:] = sorted(i for i in subdirs if i.startswith("rerun_"))
+    return None
+
+
+def read_metrics(logfile_location, job):
+    """
+    read the metrics recorded by a job's tasks
+
+    Files which aren't complete records are skipped. Each command has a
+    single record, so if it was run more than once this is its last run.
+
+    Parameters:
+    -----------
+    logfile_location: string
+        directory containing a sub-directory of metrics for each phase
+    job: string
+        name of the job, see `latest_job`
+
+    Returns:
+    --------
+    pandas.DataFrame with a row per task
+    """
+    records = []
+    for phase in PHASES:
+        paths = glob.glob(os.path.join(logfile_location, phase, job, "*.json"))
+        for path in sorted(paths):
+            with open(path) as f:
+                try:
+                    record = json.load(f)
+                except ValueError:
+                    continue
+            if isinstance(record, dict) and record.get("phase") == phase:
+                records.append(record)
+    if len(records) == 0:
+        raise MetricsError("no metrics found for job '{}'".format(job))
+    metrics = pd.DataFrame(records)
+    for col in ["files", "bytes", "chunk", "max_rss"]:
+        if col not in metrics:
+            metrics[col] = np.nan
+    metrics["order"] = metrics["phase"].map(PHASES.index)
+    metrics = metrics.sort_values(["order", "command"], kind="mergesort")
+    return metrics.drop(columns="order").reset_index(drop=True)
+
+
+def _analysed(metrics, manifest):
+    """successful analyses joined with their manifest rows"""
+    analysis = metrics[(metrics["phase"] == "analysis") & (metrics["status"] == 0)]
+    if manifest is None:
+        return analysis
+    columns = [i for i in ["command", "name", "n_images", "bytes"] if i in manifest]
+    return analysis.drop(columns=["bytes"]).merge(manifest[columns],
+                                                  on="command", how="left")
+
+
+def summarise(metrics, manifest=None):
+    """
+    summarise each phase's throughput and task durations
+
+    The span of a phase is from the start of its first task to the end of
+    its last, over which the throughput is measured. The staging throughput
+    counts the files and bytes rsync transferred, and the analysis
+    throughput the images and bytes of the analysed chunks in the manifest.
+    The duration percentiles are of the successful tasks.
+
+    Parameters:
+    -----------
+    metrics: pandas.DataFrame
+        from `read_metrics`
+    manifest: pandas.DataFrame (default=None)
+        the `manifest.csv` of the commands, without it the analysis
+        throughput is NaN
+
+    Returns:
+    --------
+    pandas.DataFrame with a row per phase and columns `SUMMARY_COLUMNS`,
+    times in seconds
+    """
+    rows = []
+    for phase in PHASES:
+        tasks = metrics[metrics["phase"] == phase]
+        if len(tasks) == 0:
+            continue
+        ok = tasks[tasks["status"] == 0]
+        row = {"phase": phase, "tasks": len(tasks),
+               "failed": int((tasks["status"] != 0).sum()),
+               "span": float(tasks["end"].max() - tasks["start"].min()),
+               "images/s": np.nan, "MB/s": np.nan}
+        if phase == "staging":
+            n_images, n_bytes = ok["files"], ok["bytes"]
+        elif phase == "analysis" and manifest is not None:
+            analysed = _analysed(metrics, manifest)
+            n_images = analysed.get("n_images", pd.Series(dtype=float))
+            n_bytes = analysed.get("bytes", pd.Series(dtype=float))
+        else:
+            n_images = n_bytes = pd.Series(dtype=float)
+        if row["span"] > 0:
+            if n_images.notnull().any():
+                row["images/s"] = n_images.sum() / row["span"]
+            if n_bytes.notnull().any():
+                row["MB/s"] = n_bytes.sum() / 1e6 / row["span"]
+        durations = ok["duration"].astype(float)
+        for col, q in [("median", 50), ("p90", 90), ("p99", 99), ("max", 100)]:
+            row[col] = np.percentile(durations, q) if len(durations) else np.nan
+        rows.append(row)
+    return pd.DataFrame(rows).set_index("phase")[SUMMARY_COLUMNS]
+
+
+def slowest(metrics, manifest=None, n=5):
+    """
+    the `n` longest analyses, joined with their manifest rows if given
+
+    Returns:
+    --------
+    pandas.DataFrame sorted by duration, longest first
+    """
+    analysis = metrics[metrics["phase"] == "analysis"]
+    if manifest is not None:
+        columns = [i for i in ["command", "name", "n_images"] if i in manifest]
+        analysis = analysis.merge(manifest[columns], on="command", how="left")
+    analysis = analysis.sort_values("duration", ascending=False, kind="mergesort")
+    return analysis.head(n).reset_index(drop=True)
+
+
+def parse_args(argv):
+    """parse the `cptools2 metrics` command line arguments"""
+    parser = argparse.ArgumentParser(
+        prog="cptools2 metrics",
+        description="report the throughput and task durations of each "
+                    "phase of a run")
+    parser.add_argument("config", help="yaml config file of the run")
+    parser.add_argument("--job", default=None,
+                        help="job to report, defaults to the one with the "
+                             "latest metrics in location/logfiles")
+    parser.add_argument("--slowest", type=int, default=5,
+                        help="number of the slowest analyses to list")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    """run `cptools2 metrics`"""
+    args = parse_args(argv)
+    yaml_dict = parse_yaml.open_yaml(args.config)
+    parse_yaml.check_yaml_args(yaml_dict)
+    logfile_location = os.path.join(yaml_dict["location"], "logfiles")
+    job = args.job
+    if job is None:
+        job = latest_job(logfile_location)
+    pretty_print("reading metrics of job {}".format(yellow(job)))
+    metrics = read_metrics(logfile_location, job)
+    # a rerun's command numbers are lines of its own commands, so the
+    # manifest has to be the one of the commands the job ran
+    commands_location = parse_yaml.create_commands(yaml_dict)["commands_location"]
+    commands_location = job_commands(commands_location, job)
+    manifest = None
+    if commands_location is None:
+        pretty_print("no commands record job {}, so the chunks aren't "
+                     "known".format(yellow(job)))
+    elif os.path.isfile(os.path.join(commands_location, "manifest.csv")):
+        manifest = pd.read_csv(os.path.join(commands_location, "manifest.csv"))
+    summary = summarise(metrics, manifest)
+    for phase, row in summary.iterrows():
+        pretty_print("{}: {} tasks, {} failed, over {:.0f}s".format(
+            phase, yellow(int(row["tasks"])), yellow(int(row["failed"])),
+            row["span"]))
+        pretty_print("    {:.1f} images/s, {:.1f} MB/s".format(
+            row["images/s"], row["MB/s"]))
+        pretty_print("    median {:.0f}s, p90 {:.0f}s, p99 {:.0f}s, max {:.0f}s".format(
+            row["median"], row["p90"], row["p99"], row["max"]))
+    if args.slowest > 0:
+        pretty_print("slowest analyses:")
+        for _, row in slowest(metrics, manifest, n=args.slowest).iterrows():
+            name = "command {}".format(row["command"])
+            if pd.notnull(row.get("name")):
+                name = "{} (command {})".format(row["name"], row["command"])
+            pretty_print("    {} {:.0f}s, exit status {}".format(
+                yellow(name), row["duration"], row["status"]))
+    return summary
+
+
+class MetricsError(Exception):
+    pass
@@ -11,6 +11,7 @@ which can be used in other functions in cptools2 using **kwargs.
 import os
 from collections import namedtuple
 import yaml
+from cptools2 import utils
 
 
 def open_yaml(path_to_yaml):
@@ -74,9 +75,160 @@ def chunk(yaml_dict):
         chunk_arg = yaml_dict["chunk"]
         if isinstance(chunk_arg, list):
             chunk_arg = chunk_arg[0]
-        return {"job_size" : int(chunk_arg)}
+        chunk_args = {"job_size" : int(chunk_arg)}
+    elif "chunk bytes" in yaml_dict:
+        # only chunked by size
+        chunk_args = {"job_size" : None}
     else:
         return None
+    if "chunk bytes" in yaml_dict:
+        bytes_arg = yaml_dict["chunk bytes"]
+        if isinstance(bytes_arg, list):
+            bytes_arg = bytes_arg[0]
+        chunk_args["max_bytes"] = utils.parse_bytes(bytes_arg)
+    if "pack tails" in yaml_dict:
+        chunk_args["pack_tails"] = bool(yaml_dict["pack tails"])
+    return chunk_args
+
+
+def channels(yaml_dict):
+    """
+    get arguments for Job.select_channels method
+
+    this is optional, so if not there then return None
+
+    Parameters:
+    -----------
+    yaml_dict: dict
+        dictionary version of the config yaml file
+
+    Returns:
+    --------
+    dictionary
+    """
+    if "channels" not in yaml_dict:
+        return None
+    channels_arg = yaml_dict["channels"]
+    if str(channels_arg).lower() == "auto":
+        # detected from the pipelines
+        return {"channels": "auto", "pipeline": pipelines(yaml_dict)}
+    if not isinstance(channels_arg, list):
+        channels_arg = [channels_arg]
+    # allow either 1 or W1
+    return {"channels": [int(str(i).upper().lstrip("W")) for i in channels_arg]}
+
+
+def pipelines(yaml_dict):
+    """
+    get the pipeline path, or the list of paths if there is more than one
+    pipeline, each made absolute
+
+    Parameters:
+    -----------
+    yaml_dict: dict
+        dictionary version of the config yaml file
+
+    Returns:
+    --------
+    string, or list of strings
+    """
+    pipeline_arg = yaml_dict["pipeline"]
+    if isinstance(pipeline_arg, list):
+        if len(pipeline_arg) > 1:
+            return [os.path.abspath(path) for path in pipeline_arg]
+        pipeline_arg = pipeline_arg[0]
+    return os.path.abspath(pipeline_arg)
+
+
+def _row_index(label):
+    """index of a plate row label, A=1 ... Z=26, AA=27 ..."""
+    index = 0
+    for letter in label:
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index
+
+
+def _row_label(index):
+    """plate row label of an index, the inverse of `_row_index`"""
+    label = ""
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        label = chr(ord("A") + remainder) + label
+    return label
+
+
+def _expand_ranges(values, letters=False, key="subset"):
+    """
+    expand a value or list of values which can contain inclusive ranges,
+    e.g [1, "3-5"] to [1, 3, 4, 5], or with `letters` "B-D" to
+    ["B", "C", "D"]. Row labels can have more than one letter, as on 1536
+    well plates, so "Y-AB" is ["Y", "Z", "AA", "AB"].
+
+    Raises a ValueError naming `key` if a value isn't a number, or with
+    `letters` a row label.
+    """
+    if not isinstance(values, list):
+        values = [values]
+    expanded = []
+    for value in values:
+        value = str(value).strip().upper()
+        bounds = [i.strip() for i in value.split("-", 1)]
+        if letters:
+            valid = all(i.isalpha() and i.isascii() for i in bounds)
+        else:
+            valid = all(i.isdigit() for i in bounds)
+        if not valid:
+            msg = "'{}' isn't a valid value for '{}', expected {}".format(
+                value, key, "row letters, e.g B or B-D" if letters
+                else "numbers, e.g 3 or 3-5")
+            raise ValueError(msg)
+        # a single value is a range of one
+        start, stop = bounds[0], bounds[-1]
+        if letters:
+            expanded.extend(_row_label(i) for i in
+                            range(_row_index(start), _row_index(stop) + 1))
+        else:
+            expanded.extend(range(int(start), int(stop) + 1))
+    return expanded
+
+
+def subset(yaml_dict):
+    """
+    get arguments for Job.select_imagesets method
+
+    this is optional, so if not there then return None
+
+    Parameters:
+    -----------
+    yaml_dict: dict
+        dictionary version of the config yaml file
+
+    Returns:
+    --------
+    dictionary
+    """
+    if "subset" not in yaml_dict:
+        return None
+    subset_arg = yaml_dict["subset"]
+    # a list of single-key dictionaries, as with add plate, or a dictionary
+    if isinstance(subset_arg, list):
+        subset_arg = {k: v for d in subset_arg for k, v in d.items()}
+    bad_keys = set(subset_arg) - {"wells", "rows", "columns", "sites", "timepoints"}
+    if bad_keys:
+        raise ValueError("Unrecognized subset argument(s) : {}".format(sorted(bad_keys)))
+    subset_args = {}
+    if "wells" in subset_arg:
+        wells_arg = subset_arg["wells"]
+        if not isinstance(wells_arg, list):
+            wells_arg = [wells_arg]
+        subset_args["wells"] = [str(i).strip().upper() for i in wells_arg]
+    if "rows" in subset_arg:
+        subset_args["rows"] = _expand_ranges(subset_arg["rows"], letters=True,
+                                             key="rows")
+    for key in ["columns", "sites", "timepoints"]:
+        if key in subset_arg:
+            subset_args[key] = _expand_ranges(subset_arg[key], key=key)
+    return subset_args
 
 
 def add_plate(yaml_dict):
@@ -146,6 +298,186 @@ def is_new_ix(yaml_dict):
     return new_ix
 
 
+def scan_workers(yaml_dict):
+    """
+    get the number of threads used to scan plates for images
+
+    this is optional, so if not there then return None
+
+    Parameters:
+    -----------
+    yaml_dict: dict
+        dictionary version of the config yaml file
+
+    Returns:
+    --------
+    integer or None
+    """
+    if "scan workers" in yaml_dict:
+        workers_arg = yaml_dict["scan workers"]
+        if isinstance(workers_arg, list):
+            workers_arg = workers_arg[0]
+        return int(workers_arg)
+    else:
+        return None
+
+
+def index_location(yaml_dict):
+    """
+    get the directory in which to store the persistent plate indices.
+
+    this is stored under `location` and is used by default, it can be turned
+    off with `plate index: false`, in which case return None
+
+    Parameters:
+    -----------
+    yaml_dict: dict
+        dictionary version of the config yaml file
+
+    Returns:
+    --------
+    string or None
+    """
+    if yaml_dict.get("plate index", True) is False:
+        return None
+    if "location" in yaml_dict:
+        location_arg = yaml_dict["location"]
+        if isinstance(location_arg, list):
+            location_arg = location_arg[0]
+        return os.path.join(location_arg, "plate_index")
+    else:
+        return None
+
+
+def streaming(yaml_dict):
+    """
+    whether to process one plate at a time rather than holding every plate
+    in memory at once
+
+    this is optional, so if not there then return False
+
+    Parameters:
+    -----------
+    yaml_dict: dict
+        dictionary version of the config yaml file
+
+    Returns:
+    --------
+    Boolean
+    """
+    if "streaming" in yaml_dict:
+        return bool(yaml_dict["streaming"])
+    else:
+        return False
+
+
+def tasks_per_job(yaml_dict):
+    """
+    get the number of commands run by each array task
+
+    this is optional, so if not there then return 1
+
+    Parameters:
+    -----------
+    yaml_dict: dict
+        dictionary version of the config yaml file
+
+    Returns:
+    --------
+    integer
+    """
+    if "tasks per job" in yaml_dict:
+        tasks_arg = yaml_dict["tasks per job"]
+        if isinstance(tasks_arg, list):
+            tasks_arg = tasks_arg[0]
+        tasks_arg = int(tasks_arg)
+        if tasks_arg < 1:
+            raise ValueError("'tasks per job' has to be at least 1")
+        return tasks_arg
+    else:
+        return 1
+
+
+def prefetch(yaml_dict):
+    """
+    get the number of chunks to stage ahead when pipelining the staging,
+    analysis and destaging
+
+    this is only used if `pipelined` is true, otherwise return None
+
+    Parameters:
+    -----------
+    yaml_dict: dict
+        dictionary version of the config yaml file
+
+    Returns:
+    --------
+    integer or None
+    """
+    if yaml_dict.get("pipelined", False) is not True:
+        return None
+    prefetch_arg = yaml_dict.get("prefetch", 1)
+    if isinstance(prefetch_arg, list):
+        prefetch_arg = prefetch_arg[0]
+    prefetch_arg = int(prefetch_arg)
+    if prefetch_arg < 0:
+        raise ValueError("'prefetch' can't be negative")
+    return prefetch_arg
+
+
+def analysis_memory(yaml_dict):
+    """
+    get the memory to request for each analysis task
+
+    this is optional, so if not there then return "12G"
+
+    Parameters:
+    -----------
+    yaml_dict: dict
+        dictionary version of the config yaml file
+
+    Returns:
+    --------
+    string, e.g "12G"
+    """
+    memory_arg = yaml_dict.get("analysis memory", "12G")
+    if isinstance(memory_arg, list):
+        memory_arg = memory_arg[0]
+    memory_arg = str(memory_arg).strip().upper()
+    # check it's understood before it ends up in a submission script
+    utils.parse_bytes(memory_arg)
+    return memory_arg
+
+
+def scheduler(yaml_dict):
+    """
+    get arguments for backends.get_backend
+
+    this is optional, if not there then use SGE
+
+    Parameters:
+    -----------
+    yaml_dict: dict
+        dictionary version of the config yaml file
+
+    Returns:
+    --------
+    dictionary
+    """
+    scheduler_arg = yaml_dict.get("scheduler", "sge")
+    if isinstance(scheduler_arg, list):
+        scheduler_arg = scheduler_arg[0]
+    scheduler_args = {"name": str(scheduler_arg).lower()}
+    if "local workers" in yaml_dict:
+        workers_arg = yaml_dict["local workers"]
+        if isinstance(workers_arg, dict):
+            workers_arg = {str(k): int(v) for k, v in workers_arg.items()}
+        else:
+            workers_arg = int(workers_arg)
+        scheduler_args["n_workers"] = workers_arg
+    return scheduler_args
+
+
 def create_commands(yaml_dict):
     """
     get arguments for Job.create_commands
@@ -162,12 +494,10 @@ def create_commands(yaml_dict):
     dictionary
     """
     if "pipeline" in yaml_dict:
-        pipeline_arg = yaml_dict["pipeline"]
-        if isinstance(pipeline_arg, list):
-            pipeline_arg = pipeline_arg[0]
-        pipeline_arg = os.path.abspath(pipeline_arg)
-        if not os.path.isfile(pipeline_arg):
-            raise IOError("'{}' pipeline not found".format(pipeline_arg))
+        pipeline_arg = pipelines(yaml_dict)
+        for path in [pipeline_arg] if isinstance(pipeline_arg, str) else pipeline_arg:
+            if not os.path.isfile(path):
+                raise IOError("'{}' pipeline not found".format(path))
     if "location" in yaml_dict:
         location_arg = yaml_dict["location"]
         if isinstance(location_arg, list):
@@ -184,10 +514,22 @@ def create_commands(yaml_dict):
             chunk_arg = int(chunk_arg[0])
     else:
         chunk_arg = None
-    return {"pipeline"          : pipeline_arg,
-            "location"          : location_arg,
-            "commands_location" : commands_loc_arg,
-            "job_size"          : chunk_arg}
+    create_command_args = {"pipeline"          : pipeline_arg,
+                           "location"          : location_arg,
+                           "commands_location" : commands_loc_arg,
+                           "job_size"          : chunk_arg}
+    # optional arguments, only passed if present in the config file
+    if "plate loaddata" in yaml_dict:
+        create_command_args["plate_loaddata"] = bool(yaml_dict["plate loaddata"])
+    if "loaddata layout" in yaml_dict:
+        create_command_args["layout"] = str(yaml_dict["loaddata layout"])
+    if "write workers" in yaml_dict:
+        create_command_args["n_writers"] = int(yaml_dict["write workers"])
+    if "order" in yaml_dict:
+        create_command_args["order"] = str(yaml_dict["order"]).lower()
+    if "result cache" in yaml_dict:
+        create_command_args["cache"] = bool(yaml_dict["result cache"])
+    return create_command_args
 
 
 def check_yaml_args(yaml_dict):
@@ -213,7 +555,25 @@ def check_yaml_args(yaml_dict):
                   "commands location",
                   "remove plate",
                   "add plate",
-                  "new_ix"]
+                  "new_ix",
+                  "scan workers",
+                  "plate index",
+                  "plate loaddata",
+                  "loaddata layout",
+                  "write workers",
+                  "streaming",
+                  "tasks per job",
+                  "scheduler",
+                  "local workers",
+                  "pipelined",
+                  "prefetch",
+                  "chunk bytes",
+                  "pack tails",
+                  "analysis memory",
+                  "order",
+                  "result cache",
+                  "channels",
+                  "subset"]
     bad_arguments = []
     for argument in yaml_dict.keys():
         if argument not in valid_args:
@@ -237,21 +597,43 @@ def parse_config_file(config_file):
     namedtuple:
         config.experiment_args     : dict
         config.chunk_args          : dict
+        config.channel_args        : dict
+        config.subset_args         : dict
         config.remove_plate_args   : dict
         config.add_plate_args      : dict
         config.create_command_args : dict
         config.is_new_ix           : bool
+        config.n_workers           : int or None
+        config.index_location      : string or None
+        config.streaming           : bool
+        config.tasks_per_job       : int
+        config.scheduler_args      : dict
+        config.prefetch            : int or None
+        config.analysis_memory     : string
     """
     yaml_dict = open_yaml(config_file)
     # check the arguments in the yaml file are recognised
     check_yaml_args(yaml_dict)
     # create namedtuple to store the configuration dictionaries
-    names = ["experiment_args", "chunk_args", "add_plate_args",
-             "remove_plate_args", "create_command_args", "is_new_ix"]
+    names = ["experiment_args", "chunk_args", "channel_args", "subset_args",
+             "add_plate_args", "remove_plate_args", "create_command_args",
+             "is_new_ix",
+             "n_workers", "index_location", "streaming",
+             "tasks_per_job", "scheduler_args", "prefetch",
+             "analysis_memory"]
     config = namedtuple("config", names)
     return config(experiment_args=experiment(yaml_dict),
                   chunk_args=chunk(yaml_dict),
+                  channel_args=channels(yaml_dict),
+                  subset_args=subset(yaml_dict),
                   remove_plate_args=remove_plate(yaml_dict),
                   add_plate_args=add_plate(yaml_dict),
                   create_command_args=create_commands(yaml_dict),
-                  is_new_ix=is_new_ix(yaml_dict))
+                  is_new_ix=is_new_ix(yaml_dict),
+                  n_workers=scan_workers(yaml_dict),
+                  index_location=index_location(yaml_dict),
+                  streaming=streaming(yaml_dict),
+                  tasks_per_job=tasks_per_job(yaml_dict),
+                  scheduler_args=scheduler(yaml_dict),
+                  prefetch=prefetch(yaml_dict),
+                  analysis_memory=analysis_memory(yaml_dict))
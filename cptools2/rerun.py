@@ -0,0 +1,325 @@
+"""
+Run the analyses which failed, or never reported, again.
+
+Each analysis task appends a line to the job's log file once it has run, so
+an analysis whose last entry isn't "Finished" failed, and one without an
+entry never reported, e.g because it was killed for running out of memory
+or time. The chunks of those analyses are staged, analysed and destaged
+again from a compact set of commands written to a `rerun_<date>` directory
+within the commands location, along with their submission scripts.
+
+With `--split N` each chunk's analysis is split into N analyses of fewer
+image sets, using cellprofiler's -f and -l flags on the chunk's LoadData,
+which is useful when the analyses ran out of memory. The chunk is still
+only staged and destaged once, and the results of each part go to
+`<results>_part<n>`.
+
+usage: cptools2 rerun config.yml [--log LOG] [--commands DIR] [--split N]
+"""
+
+import argparse
+import math
+import os
+from datetime import datetime
+
+import pandas as pd
+
+from cptools2 import (backends, commands, generate_scripts, parse_yaml,
+                      result_cache, tune, utils)
+from cptools2.colours import pretty_print, yellow
+
+# least fraction of the commands a log not recorded for them has to cover
+MIN_COVERAGE = 0.5
+
+
+def read_commands(commands_location):
+    """
+    the staging, cellprofiler and destaging commands in `commands_location`
+
+    Returns:
+    --------
+    dictionary of a list of lines for each of "staging", "cp_commands" and
+    "destaging"
+    """
+    cmnds = {}
+    for name, path in generate_scripts.make_command_paths(commands_location).items():
+        if not os.path.isfile(path):
+            raise RerunError("'{}' not found".format(path))
+        with open(path) as f:
+            cmnds[name] = [i.rstrip("\n") for i in f if i.strip()]
+    n_chunks = len(cmnds["staging"])
+    n_analyses = len(cmnds["cp_commands"])
+    if n_chunks == 0 or len(cmnds["destaging"]) != n_chunks or \
+            n_analyses % n_chunks != 0:
+        raise RerunError("the commands in '{}' don't line up".format(
+            commands_location))
+    return cmnds
+
+
+def unfinished(log_file, n_commands):
+    """
+    analyses which failed or never reported in a log file
+
+    Parameters:
+    -----------
+    log_file: string
+        path to the log file, see `tune.read_log`
+    n_commands: int
+        number of lines in the cellprofiler commands file
+
+    Returns:
+    --------
+    tuple of sorted lists of the (1-indexed) lines of the cellprofiler
+    commands which failed, and which have no entry in the log
+    """
+    log = tune.read_log(log_file)
+    log = log[(log["command"] >= 1) & (log["command"] <= n_commands)]
+    failed = sorted(int(i) for i in log.loc[log["status"] != "Finished", "command"])
+    missing = sorted(set(range(1, n_commands + 1)) - set(log["command"]))
+    return failed, missing
+
+
+def check_coverage(log_file, n_commands, missing):
+    """
+    raise a RerunError if `log_file` has no entry for most of the commands,
+    as it's then likely the log of other commands, e.g of a rerun
+    """
+    if n_commands - len(missing) < MIN_COVERAGE * n_commands:
+        msg = ("'{}' only has entries for {} of {} analyses, so is probably "
+               "the log of other commands, pass the log with --log".format(
+                   log_file, n_commands - len(missing), n_commands))
+        raise RerunError(msg)
+
+
+def chunks_to_rerun(lines, n_chunks):
+    """
+    sorted (0-indexed) chunks of (1-indexed) lines of the cellprofiler
+    commands, which has a block of `n_chunks` lines for each pipeline
+    """
+    return sorted(set((line - 1) % n_chunks for line in lines))
+
+
+def split_ranges(first, last, n_parts):
+    """
+    split the image sets `first` to `last`, inclusive, into `n_parts`
+    ranges which differ in size by at most one
+
+    Returns:
+    --------
+    list of (first, last) tuples
+    """
+    n_image_sets = last - first + 1
+    bounds = [first + (n_image_sets * i) // n_parts for i in range(n_parts + 1)]
+    return [(bounds[i], bounds[i + 1] - 1) for i in range(n_parts)]
+
+
+def _image_set_range(cp_args):
+    """first and last image sets analysed by a cellprofiler command"""
+    if cp_args["image_sets"] is not None:
+        return cp_args["image_sets"]
+    load_data = cp_args["load_data"]
+    if not os.path.isfile(load_data):
+        raise RerunError("can't split the analysis, '{}' not found".format(load_data))
+    # the header plus a row per image set
+    return 1, utils.count_lines_in_file(load_data) - 1
+
+
+def _clean(value):
+    """manifest value read by pandas, without NaN and float counts"""
+    if isinstance(value, float):
+        if math.isnan(value):
+            return None
+        if value.is_integer():
+            return int(value)
+    return value
+
+
+def rerun_commands(cmnds, chunks, manifest=None, markers=None, split=1):
+    """
+    the commands to stage, analyse and destage some of the chunks again
+
+    Parameters:
+    -----------
+    cmnds: dict
+        commands of the run, from `read_commands`
+    chunks: list of int
+        (0-indexed) chunks to run again
+    manifest: list of dicts (default=None)
+        a dictionary per cellprofiler command, as in `manifest.csv`
+    markers: list of strings (default=None)
+        result cache marker of each cellprofiler command
+    split: int (default=1)
+        number of analyses to split each chunk's analysis into, limited to
+        the number of image sets in the smallest analysis
+
+    Returns:
+    --------
+    dictionary of the "staging", "cp_commands" and "destaging" commands,
+    the "manifest" and "markers" of the cellprofiler commands, None if not
+    given or if the analyses are split, and the number of parts in "split"
+    """
+    if split < 1:
+        raise RerunError("split has to be at least 1")
+    n_chunks = len(cmnds["staging"])
+    n_blocks = len(cmnds["cp_commands"]) // n_chunks
+    lines = [[block * n_chunks + chunk for chunk in chunks]
+             for block in range(n_blocks)]
+    ranges = dict()
+    if split > 1:
+        for line in utils.flatten(lines):
+            cp_args = commands.parse_cp_command(cmnds["cp_commands"][line])
+            ranges[line] = (cp_args, _image_set_range(cp_args))
+        split = min([split] + [last - first + 1 for _, (first, last) in ranges.values()])
+    cp_commands, rows, new_markers = [], [], []
+    # a block of a line per chunk for each pipeline, and each part
+    for block_lines in lines:
+        for part in range(split):
+            for chunk_num, line in enumerate(block_lines, 1):
+                row = None
+                if manifest is not None:
+                    row = {key: _clean(value) for key, value in manifest[line].items()
+                           if key in commands.MANIFEST_COLUMNS}
+                    row["chunk"] = chunk_num
+                if split == 1:
+                    cp_commands.append(cmnds["cp_commands"][line])
+                    if markers is not None:
+                        new_markers.append(markers[line])
+                else:
+                    cp_args, (first, last) = ranges[line]
+                    part_first, part_last = split_ranges(first, last, split)[part]
+                    cp_commands.append(commands.cp_command(
+                        pipeline=cp_args["pipeline"],
+                        load_data=cp_args["load_data"],
+                        output_location="{}_part{}".format(
+                            cp_args["output_location"], part + 1),
+                        image_sets=(part_first, part_last)))
+                    if row is not None:
+                        _split_row(row, part_first - first, part_last - part_first + 1)
+                if row is not None:
+                    rows.append(row)
+    return {"staging": [cmnds["staging"][i] for i in chunks],
+            "cp_commands": cp_commands,
+            "destaging": [cmnds["destaging"][i] for i in chunks],
+            "manifest": rows if manifest is not None else None,
+            "markers": new_markers if markers is not None and split == 1 else None,
+            "split": split}
+
+
+def _split_row(row, offset, n_image_sets):
+    """update a manifest row for a part of its analysis"""
+    if row.get("imageset_start") is not None:
+        row["imageset_start"] += offset
+        row["imageset_stop"] = row["imageset_start"] + n_image_sets
+    if row.get("n_images") is not None and row.get("n_imagesets"):
+        row["n_images"] = int(round(row["n_images"] * n_image_sets /
+                                    float(row["n_imagesets"])))
+    row["n_imagesets"] = n_image_sets
+    # only the whole analysis is recorded in the result cache
+    row["key"] = None
+
+
+def write_rerun(commands_location, rerun):
+    """
+    write the commands from `rerun_commands` to a new directory in
+    `commands_location`
+
+    Returns:
+    --------
+    path to the directory
+    """
+    time_now = str(datetime.now().replace(microsecond=0)).replace(" ", "-")
+    rerun_location = os.path.join(commands_location, "rerun_{}".format(time_now))
+    utils.make_dir(rerun_location)
+    commands.write_commands(commands_location=rerun_location,
+                            rsync_commands=rerun["staging"],
+                            cp_commands=rerun["cp_commands"],
+                            rm_commands=rerun["destaging"])
+    if rerun["manifest"] is not None:
+        commands.write_manifest(rerun_location, rerun["manifest"])
+    if rerun["markers"] is not None:
+        result_cache.write_markers(rerun_location, rerun["markers"])
+    return rerun_location
+
+
+def parse_args(argv):
+    """parse the `cptools2 rerun` command line arguments"""
+    parser = argparse.ArgumentParser(
+        prog="cptools2 rerun",
+        description="create commands and submission scripts for the "
+                    "analyses which failed or never reported")
+    parser.add_argument("config", help="yaml config file of the run")
+    parser.add_argument("--log", default=None,
+                        help="log file of the run, defaults to the latest "
+                             "log of the commands in location/logfiles")
+    parser.add_argument("--commands", default=None,
+                        help="directory of the commands that were run, "
+                             "defaults to the commands location, e.g a "
+                             "previous rerun directory")
+    parser.add_argument("--split", type=int, default=1,
+                        help="split each analysis into this many analyses of "
+                             "fewer image sets, e.g after running out of memory")
+    parser.add_argument("--memory", default=None,
+                        help="memory to request for each analysis, defaults "
+                             "to the config's analysis memory")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    """run `cptools2 rerun`"""
+    args = parse_args(argv)
+    yaml_dict = parse_yaml.open_yaml(args.config)
+    parse_yaml.check_yaml_args(yaml_dict)
+    commands_location = args.commands
+    if commands_location is None:
+        commands_location = parse_yaml.create_commands(yaml_dict)["commands_location"]
+    logfile_location = os.path.join(yaml_dict["location"], "logfiles")
+    log_file, recorded = args.log, True
+    if log_file is None:
+        log_file = tune.commands_log(commands_location, logfile_location)
+    if log_file is None:
+        # commands from before their jobs were recorded
+        log_file, recorded = tune.latest_log(logfile_location), False
+    pretty_print("reading {}".format(yellow(log_file)))
+    cmnds = read_commands(commands_location)
+    failed, missing = unfinished(log_file, len(cmnds["cp_commands"]))
+    if not recorded:
+        check_coverage(log_file, len(cmnds["cp_commands"]), missing)
+    pretty_print("{} failed and {} missing of {} analyses".format(
+        yellow(len(failed)), yellow(len(missing)),
+        yellow(len(cmnds["cp_commands"]))))
+    chunks = chunks_to_rerun(failed + missing, len(cmnds["staging"]))
+    if not chunks:
+        pretty_print("nothing to rerun")
+        return None
+    manifest, markers = None, None
+    manifest_path = os.path.join(commands_location, "manifest.csv")
+    if os.path.isfile(manifest_path):
+        manifest = pd.read_csv(manifest_path).to_dict("records")
+    markers_path = result_cache.markers_path(commands_location)
+    if os.path.isfile(markers_path):
+        with open(markers_path) as f:
+            markers = f.read().splitlines()
+    rerun = rerun_commands(cmnds, chunks, manifest=manifest, markers=markers,
+                           split=args.split)
+    rerun_location = write_rerun(commands_location, rerun)
+    pretty_print("rerunning {} chunks in {} analyses, commands at {}".format(
+        yellow(len(chunks)), yellow(len(rerun["cp_commands"])),
+        yellow(rerun_location)))
+    if rerun["split"] != args.split:
+        pretty_print("split each analysis into {} parts, the most the smallest "
+                     "analysis allows".format(yellow(rerun["split"])))
+    backend = backends.get_backend(**parse_yaml.scheduler(yaml_dict))
+    if args.memory is not None:
+        yaml_dict["analysis memory"] = args.memory
+    analysis_memory = parse_yaml.analysis_memory(yaml_dict)
+    backend.launch(rerun_location,
+                   generate_scripts.lines_in_commands(rerun_location),
+                   logfile_location=logfile_location,
+                   tasks_per_job=parse_yaml.tasks_per_job(yaml_dict),
+                   prefetch=parse_yaml.prefetch(yaml_dict),
+                   analysis_memory=analysis_memory)
+    return rerun_location
+
+
+class RerunError(Exception):
+    pass
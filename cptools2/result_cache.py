@@ -0,0 +1,97 @@
+"""
+Cache of which analyses have already succeeded, so re-running a config only
+creates commands for the jobs which still need analysing.
+
+Each analysis is given a key from the contents of its inputs: the job's
+image list, its LoadData and the pipeline file. When the analysis succeeds
+an empty marker file named after the key is written to
+`location/result_cache`, and the next time the commands are created any job
+whose markers all exist is skipped. Changing the pipeline, or which images
+are in a job, changes the key so the job is analysed again.
+
+The marker path of each line of the cellprofiler commands file is written
+to `result_cache.txt` alongside the commands, for the submission scripts to
+look up.
+"""
+
+import hashlib
+import os
+
+# directory of markers within `location`
+CACHE_DIR = "result_cache"
+# commands file with the marker of each cellprofiler command
+MARKERS_NAME = "result_cache"
+
+
+def inputs_digest(img_list, dataframe):
+    """
+    hash of a job's image list and LoadData
+
+    Parameters:
+    -----------
+    img_list: list of strings
+        paths of the job's images
+    dataframe: pandas.DataFrame
+        the job's LoadData, before its paths are prefixed with `location`
+
+    Returns:
+    --------
+    string, hex digest
+    """
+    digest = hashlib.sha256()
+    for path in img_list:
+        digest.update(path.encode() + b"\n")
+    digest.update(b"\0")
+    digest.update(dataframe.to_csv(index=False).encode())
+    return digest.hexdigest()
+
+
+def pipeline_digest(pipeline):
+    """hash of the contents of a pipeline file"""
+    digest = hashlib.sha256()
+    with open(pipeline, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(pipeline_hash, inputs_hash):
+    """key of a job's analysis with a pipeline, from their digests"""
+    return hashlib.sha256(
+        "{}:{}".format(pipeline_hash, inputs_hash).encode()).hexdigest()
+
+
+def marker_path(location, key):
+    """path of the file marking the analysis with `key` as successful"""
+    return os.path.join(location, CACHE_DIR, key)
+
+
+def is_cached(location, key):
+    """whether the analysis with `key` has already succeeded"""
+    return os.path.isfile(marker_path(location, key))
+
+
+def markers_path(commands_location):
+    """path of the commands file listing the marker of each analysis"""
+    return os.path.join(commands_location, MARKERS_NAME + ".txt")
+
+
+def write_markers(commands_location, markers):
+    """
+    write the marker of each cellprofiler command, a line per command
+
+    Returns:
+    --------
+    path to the markers file
+    """
+    markers_loc = markers_path(commands_location)
+    with open(markers_loc, "w") as f:
+        for marker in markers:
+            f.write(marker + "\n")
+    return markers_loc
+
+
+def record_success(marker):
+    """mark an analysis as successful"""
+    with open(marker, "a"):
+        pass
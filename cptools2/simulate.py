@@ -0,0 +1,374 @@
+"""
+Simulate how long a generated job plan will take to run, without running it.
+
+Each job in the `manifest.csv` written by `Job.create_commands` is staged,
+analysed and destaged. Array tasks of each phase wait for the matching task
+of the previous phase, as with qsub's `-hold_jid_ad`, and run in task order
+whenever one of that phase's slots is free. From this the simulation gives
+the makespan, the peak amount of staged data on scratch and how busy the
+slots of each phase are.
+
+Transfers run at a fixed bandwidth per stream, and each analysis takes a
+fixed time plus a cost per imageset, for example as fitted by `cptools2 tune`.
+With more than one pipeline each job is staged and destaged once, and its
+analysis with each pipeline is a separate array task.
+
+usage: cptools2 simulate config.yml [--analysis-slots N] [--per-imageset S]
+"""
+
+import argparse
+import heapq
+import math
+import os
+from datetime import timedelta
+
+import pandas as pd
+
+from cptools2 import backends, parse_yaml, utils
+from cptools2.colours import pretty_print, yellow
+
+# staging array jobs are limited to 20 tasks at once with -tc 20
+DEFAULT_SLOTS = {"staging": 20, "analysis": 100, "destaging": None}
+
+
+def chunk_costs(manifest, bandwidth, per_imageset, analysis_overhead=0,
+                stage_overhead=0, destage_seconds=0, image_bytes=None):
+    """
+    how long each phase of each job in a manifest takes
+
+    Parameters:
+    -----------
+    manifest: pandas.DataFrame
+        the job plan, as written to `manifest.csv`
+    bandwidth: int
+        bytes per second of each staging transfer
+    per_imageset: float
+        seconds to analyse each imageset
+    analysis_overhead: float (default=0)
+        seconds to start each analysis, e.g loading cellprofiler
+    stage_overhead: float (default=0)
+        seconds to start each staging transfer
+    destage_seconds: float (default=0)
+        seconds to destage each job
+    image_bytes: int (default=None)
+        average size of an image, used for jobs whose size isn't in the
+        manifest. If None then every job needs its size in the manifest
+
+    Returns:
+    --------
+    pandas.DataFrame with a row per analysis and columns "chunk", the line
+    of the job in the staging and destaging commands, "bytes", "staging",
+    "analysis" and "destaging", the last three in seconds
+    """
+    if bandwidth <= 0:
+        raise SimulateError("bandwidth has to be positive")
+    n_bytes = pd.to_numeric(manifest["bytes"], errors="coerce")
+    if n_bytes.isnull().any():
+        if image_bytes is None:
+            raise SimulateError("the manifest doesn't have the size of every "
+                                "job, an average image size is needed")
+        n_bytes = n_bytes.fillna(manifest["n_images"] * image_bytes)
+    costs = pd.DataFrame({"bytes": n_bytes.astype(float)})
+    if "chunk" in manifest:
+        costs["chunk"] = manifest["chunk"].values
+    else:
+        costs["chunk"] = range(1, costs.shape[0] + 1)
+    costs["staging"] = stage_overhead + costs["bytes"] / float(bandwidth)
+    costs["analysis"] = analysis_overhead + \
+        per_imageset * manifest["n_imagesets"].astype(float)
+    costs["destaging"] = float(destage_seconds)
+    return costs.reset_index(drop=True)
+
+
+def run_slots(ready, durations, slots=None):
+    """
+    discrete-event simulation of array tasks sharing a limited number of
+    slots
+
+    Whenever a slot becomes free it is given to the task which has been
+    waiting longest, ties going to the lower task number.
+
+    Parameters:
+    -----------
+    ready: list of float
+        time at which each task can start
+    durations: list of float
+        how long each task runs for once started
+    slots: int (default=None)
+        number of tasks which can run at once, if None then no limit
+
+    Returns:
+    --------
+    list of float, the start time of each task
+    """
+    if slots is not None and slots < 1:
+        raise SimulateError("need at least one slot")
+    n_tasks = len(ready)
+    # events are (time, kind, task), where kind 0 (a task finishing) comes
+    # before kind 1 (a task becoming ready) at the same time
+    events = [(ready[task], 1, task) for task in range(n_tasks)]
+    heapq.heapify(events)
+    waiting = []
+    starts = [None] * n_tasks
+    free = n_tasks if slots is None else slots
+    while events:
+        now, kind, task = heapq.heappop(events)
+        if kind == 0:
+            free += 1
+        else:
+            heapq.heappush(waiting, (now, task))
+        while free > 0 and waiting:
+            _, next_task = heapq.heappop(waiting)
+            starts[next_task] = now
+            free -= 1
+            heapq.heappush(events, (now + durations[next_task], 0, next_task))
+    return starts
+
+
+def peak_usage(intervals):
+    """
+    largest total size of overlapping intervals
+
+    Parameters:
+    -----------
+    intervals: list of tuples
+        (start, stop, size)
+
+    Returns:
+    --------
+    float
+    """
+    # at the same time, release before allocating
+    events = sorted([(start, 1, size) for start, _, size in intervals] +
+                    [(stop, 0, -size) for _, stop, size in intervals])
+    usage = peak = 0
+    for _, _, size in events:
+        usage += size
+        peak = max(peak, usage)
+    return peak
+
+
+def _by_chunk(costs):
+    """
+    costs of each job, and the analysis costs of each pipeline
+
+    Returns:
+    --------
+    tuple of a pandas.DataFrame of the costs with a row per job, its
+    analysis the total over the pipelines, and a list of a pandas.Series
+    of the analysis costs of each job for each pipeline
+    """
+    if "chunk" not in costs:
+        return costs, [costs["analysis"]]
+    costs = costs.sort_values("chunk", kind="mergesort").reset_index(drop=True)
+    groups = costs.groupby("chunk", sort=True)
+    jobs = groups.first().reset_index(drop=True)
+    jobs["analysis"] = groups["analysis"].sum().values
+    pipeline_num = groups.cumcount()
+    analyses = [costs["analysis"][pipeline_num == i].reset_index(drop=True)
+                for i in range(pipeline_num.max() + 1)] if costs.shape[0] else []
+    return jobs, analyses or [jobs["analysis"]]
+
+
+def _task_chunks(n_chunks, tasks_per_job):
+    """chunk numbers run by each array task"""
+    n_tasks = int(math.ceil(n_chunks / float(tasks_per_job)))
+    return [list(range(task * tasks_per_job,
+                       min((task + 1) * tasks_per_job, n_chunks)))
+            for task in range(n_tasks)]
+
+
+def _pipelined_task(costs, chunks, prefetch, task_overhead):
+    """
+    timeline of a pipelined task, following
+    `generate_scripts.pipelined_loop_text`
+
+    Returns:
+    --------
+    tuple of the task's duration, and (chunk, staged, destaged) times of
+    each chunk relative to the start of the task
+    """
+    launched = {}
+    iteration_start = task_overhead
+    finished = task_overhead
+    timeline = []
+    for i, chunk in enumerate(chunks):
+        # stage this chunk and up to `prefetch` ahead in the background
+        for ahead in chunks[i:i + prefetch + 1]:
+            launched.setdefault(ahead, iteration_start)
+        analysis_start = max(iteration_start,
+                             launched[chunk] + costs["staging"][chunk])
+        analysis_end = analysis_start + costs["analysis"][chunk]
+        destaged = analysis_end + costs["destaging"][chunk]
+        timeline.append((chunk, launched[chunk], destaged))
+        finished = max(finished, destaged)
+        iteration_start = analysis_end
+    return finished, timeline
+
+
+def simulate(costs, tasks_per_job=1, slots=None, task_overhead=0,
+             prefetch=None):
+    """
+    simulate running every job in `costs`
+
+    Parameters:
+    -----------
+    costs: pandas.DataFrame
+        how long each phase of each job takes, from `chunk_costs`. If the
+        jobs are analysed by more than one pipeline then each pipeline's
+        analyses are separate array tasks, and in a pipelined task each
+        job is analysed by every pipeline in turn.
+    tasks_per_job: int (default=1)
+        number of jobs run by each array task
+    slots: dict (default=None)
+        number of array tasks of each phase which can run at once, None
+        for no limit. Missing phases use `DEFAULT_SLOTS`
+    task_overhead: float (default=0)
+        seconds to schedule and start each array task
+    prefetch: int (default=None)
+        if not None then each array task stages, analyses and destages its
+        jobs in a single pipelined task on an analysis slot, staging up to
+        `prefetch` jobs ahead
+
+    Returns:
+    --------
+    dictionary of the "makespan" in seconds, "peak_scratch" in bytes,
+    "n_tasks", and "phases", a dictionary of the "busy" seconds, "slots"
+    and "utilisation" of each phase's slots
+    """
+    all_slots = dict(DEFAULT_SLOTS)
+    all_slots.update(slots or {})
+    costs, analyses = _by_chunk(costs)
+    tasks = _task_chunks(costs.shape[0], tasks_per_job)
+    busy = {phase: costs[phase].sum() for phase in backends.PHASES}
+    intervals = []
+    if prefetch is not None:
+        timelines = [_pipelined_task(costs, chunks, prefetch, task_overhead)
+                     for chunks in tasks]
+        durations = [duration for duration, _ in timelines]
+        starts = run_slots([0] * len(tasks), durations, all_slots["analysis"])
+        for start, (_, timeline) in zip(starts, timelines):
+            for chunk, staged, destaged in timeline:
+                intervals.append((start + staged, start + destaged,
+                                  costs["bytes"][chunk]))
+        ends = [start + duration for start, duration in zip(starts, durations)]
+        phase_slots = {phase: all_slots["analysis"] for phase in backends.PHASES}
+        n_running = {phase: len(tasks) for phase in backends.PHASES}
+    else:
+        ready = [0] * len(tasks)
+        stage_times = {}
+        phase_slots = {}
+        n_running = {}
+        n_tasks = len(tasks)
+        for phase in backends.PHASES:
+            # an array job per pipeline for the analysis, sharing its slots
+            phase_costs = analyses if phase == "analysis" else [costs[phase]]
+            durations = [task_overhead + phase_cost[chunks].sum()
+                         for phase_cost in phase_costs for chunks in tasks]
+            starts = run_slots(ready * len(phase_costs), durations,
+                               all_slots[phase])
+            for i, start in enumerate(starts):
+                # each task runs its jobs one after the other
+                chunks = tasks[i % n_tasks]
+                elapsed = start + task_overhead
+                for chunk in chunks:
+                    if phase == "staging":
+                        stage_times[chunk] = elapsed
+                    elapsed += phase_costs[i // n_tasks][chunk]
+                    if phase == "destaging":
+                        intervals.append((stage_times[chunk], elapsed,
+                                          costs["bytes"][chunk]))
+            ends = [start + duration for start, duration in zip(starts, durations)]
+            # the next phase waits for the task of every pipeline
+            ready = [max(ends[task::n_tasks]) for task in range(n_tasks)]
+            busy[phase] += task_overhead * len(durations)
+            phase_slots[phase] = all_slots[phase]
+            n_running[phase] = peak_usage([(start, end, 1) for start, end
+                                           in zip(starts, ends)])
+        ends = ready
+    makespan = max(ends) if ends else 0
+    phases = {}
+    for phase in backends.PHASES:
+        # with no limit, the most slots that were in use at once
+        n_slots = phase_slots[phase]
+        if n_slots is None:
+            n_slots = n_running[phase]
+        capacity = n_slots * makespan
+        phases[phase] = {"busy": busy[phase],
+                         "slots": n_slots,
+                         "utilisation": busy[phase] / capacity if capacity else 0}
+    return {"makespan": makespan,
+            "peak_scratch": peak_usage(intervals),
+            "n_tasks": len(tasks),
+            "phases": phases}
+
+
+def parse_args(argv):
+    """parse the `cptools2 simulate` command line arguments"""
+    parser = argparse.ArgumentParser(
+        prog="cptools2 simulate",
+        description="estimate how long the commands generated from a config "
+                    "file will take to run")
+    parser.add_argument("config", help="yaml config file")
+    parser.add_argument("--bandwidth", default="100M",
+                        help="bytes per second of each transfer (default 100M)")
+    parser.add_argument("--per-imageset", type=float, default=10,
+                        help="seconds to analyse an imageset (default 10)")
+    parser.add_argument("--analysis-overhead", type=float, default=30,
+                        help="seconds to start each analysis (default 30)")
+    parser.add_argument("--stage-overhead", type=float, default=0,
+                        help="seconds to start each staging transfer")
+    parser.add_argument("--destage-seconds", type=float, default=10,
+                        help="seconds to destage each job (default 10)")
+    parser.add_argument("--task-overhead", type=float, default=0,
+                        help="seconds to schedule each array task")
+    parser.add_argument("--image-bytes", default=None,
+                        help="average image size, if the manifest doesn't "
+                             "have the size of each job")
+    for phase in backends.PHASES:
+        parser.add_argument("--{}-slots".format(phase), type=int,
+                            default=DEFAULT_SLOTS[phase],
+                            help="{} tasks which can run at once "
+                                 "(default {})".format(phase, DEFAULT_SLOTS[phase]))
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    """run `cptools2 simulate`"""
+    args = parse_args(argv)
+    yaml_dict = parse_yaml.open_yaml(args.config)
+    parse_yaml.check_yaml_args(yaml_dict)
+    commands_location = parse_yaml.create_commands(yaml_dict)["commands_location"]
+    manifest_path = os.path.join(commands_location, "manifest.csv")
+    if not os.path.isfile(manifest_path):
+        raise SimulateError("no manifest found at '{}'".format(manifest_path))
+    image_bytes = args.image_bytes
+    if image_bytes is not None:
+        image_bytes = utils.parse_bytes(image_bytes)
+    costs = chunk_costs(pd.read_csv(manifest_path),
+                        bandwidth=utils.parse_bytes(args.bandwidth),
+                        per_imageset=args.per_imageset,
+                        analysis_overhead=args.analysis_overhead,
+                        stage_overhead=args.stage_overhead,
+                        destage_seconds=args.destage_seconds,
+                        image_bytes=image_bytes)
+    slots = {phase: getattr(args, "{}_slots".format(phase))
+             for phase in backends.PHASES}
+    result = simulate(costs, tasks_per_job=parse_yaml.tasks_per_job(yaml_dict),
+                      slots=slots, task_overhead=args.task_overhead,
+                      prefetch=parse_yaml.prefetch(yaml_dict))
+    pretty_print("{} jobs in {} array tasks".format(
+        yellow(costs["chunk"].nunique()), yellow(result["n_tasks"])))
+    pretty_print("predicted makespan : {}".format(
+        yellow(timedelta(seconds=int(round(result["makespan"]))))))
+    pretty_print("peak scratch usage : {}".format(
+        yellow(utils.format_bytes(result["peak_scratch"]))))
+    for phase in backends.PHASES:
+        pretty_print("{} : {} slots, {:.0%} utilised".format(
+            phase, yellow(result["phases"][phase]["slots"]),
+            result["phases"][phase]["utilisation"]))
+    return result
+
+
+class SimulateError(Exception):
+    pass
@@ -1,5 +1,6 @@
+import numpy as _np
 import pandas as _pd
-from parserix import parse as _parse
+from cptools2 import metadata
 
 
 def _well_site_table(img_list):
@@ -14,40 +15,65 @@ def _well_site_table(img_list):
 
     Returns:
     --------
-    pandas DataFrame of img_paths and Metadata_well, Metadata_site columns
+    pandas DataFrame of img_paths and Metadata_well, Metadata_site,
+    Metadata_channel columns
     """
-    final_files = [_parse.img_filename(i) for i in img_list]
-    df_img = _pd.DataFrame({
-        "img_paths"     : img_list,
-        "Metadata_well" : [_parse.img_well(i) for i in final_files],
-        "Metadata_site" : [_parse.img_site(i) for i in final_files]
-        })
-    return df_img
+    # only the filenames are needed, so any directory layout, or none, is fine
+    df_img = metadata.parse_filenames(img_list)
+    return df_img[["img_paths", "Metadata_well", "Metadata_site",
+                   "Metadata_channel"]]
+
+
+def imageset_order(df_img):
+    """
+    sort the rows of an image table into imagesets.
+
+    Rows are ordered by well, then site, then channel, with images that
+    share all three keeping their original order. This is done with a single
+    stable lexsort on integer-encoded keys rather than grouping in python.
+
+    Parameters:
+    -----------
+    df_img: pandas.DataFrame
+        dataframe containing well, site and channel metadata columns
+
+    Returns:
+    --------
+    tuple of two numpy arrays:
+        order: row positions of `df_img` in imageset order
+        offsets: the position in `order` of the first image of each imageset,
+            followed by the total number of images
+    """
+    well_codes, _ = _pd.factorize(df_img["Metadata_well"], sort=True)
+    sites = df_img["Metadata_site"].to_numpy()
+    channels = df_img["Metadata_channel"].to_numpy()
+    # lexsort is stable and sorts by the last key first
+    order = _np.lexsort((channels, sites, well_codes))
+    well_codes, sites = well_codes[order], sites[order]
+    new_set = _np.ones(len(order), dtype=bool)
+    new_set[1:] = (well_codes[1:] != well_codes[:-1]) | (sites[1:] != sites[:-1])
+    offsets = _np.append(_np.flatnonzero(new_set), len(order))
+    return order, offsets
 
 
 def _group_images(df_img):
     """
-    group a single dataframe into a list of dataframes, with a dataframe
-    per well and site
+    group a single dataframe into a list of image paths per well and site,
+    sorted by channel number
 
     Parameters:
     -----------
     df_img: pandas.DataFrame
-        dataframe containing image paths with well and site metadata columns
+        dataframe containing image paths with well, site and channel
+        metadata columns
 
     Returns:
     --------
-    a list of pandas DataFrames, grouped by well and site
+    a list of lists of image paths, grouped by well and site
     """
-    grouped_list = []
-    for _, group in  df_img.groupby(["Metadata_well", "Metadata_site"]):
-        grouped = list(group["img_paths"])
-        channel_nums = [_parse.img_channel(i) for i in grouped]
-        # create tuple (path, channel_number) and sort by channel number
-        sort_im = sorted(list(zip(grouped, channel_nums)), key=lambda x: x[1])
-        # return on the file-paths back from the list of tuples
-        grouped_list.append([i[0] for i in sort_im])
-    return grouped_list
+    order, offsets = imageset_order(df_img)
+    img_paths = df_img["img_paths"].to_numpy()[order].tolist()
+    return [img_paths[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
 
 
 def chunks(list_like, job_size):
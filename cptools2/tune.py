@@ -0,0 +1,390 @@
+"""
+Recommend a chunk size and analysis memory request from previous runs.
+
+Each analysis task records its wall time and peak memory in the job's log
+file. These are joined with the `manifest.csv` of the commands to fit how the
+cost of a task grows with the number of imagesets in it, which is then used
+to pick the chunk size which finishes the experiment soonest for a given
+number of array tasks running at once.
+
+usage: cptools2 tune config.yml --concurrency N [--apply]
+"""
+
+import argparse
+import math
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from cptools2 import generate_scripts, parse_yaml, utils
+from cptools2.colours import pretty_print, yellow
+
+LOG_COLUMNS = ["date", "job_id", "command", "status", "wall_time", "max_rss"]
+
+
+def latest_log(logfile_location):
+    """
+    find the most recently modified log file in `logfile_location`
+
+    Parameters:
+    -----------
+    logfile_location: string
+        directory containing the analysis log files
+
+    Returns:
+    --------
+    string, path to the log file
+    """
+    if not os.path.isdir(logfile_location):
+        raise TuneError("no log directory at '{}'".format(logfile_location))
+    logs = [os.path.join(logfile_location, i)
+            for i in os.listdir(logfile_location) if i.endswith(".log")]
+    if len(logs) == 0:
+        raise TuneError("no log files found in '{}'".format(logfile_location))
+    return max(logs, key=os.path.getmtime)
+
+
+def commands_log(commands_location, logfile_location):
+    """
+    log file of the latest job recorded as running the commands in
+    `commands_location`, see `generate_scripts.record_job`
+
+    Returns:
+    --------
+    string, path to the log file, or None if there isn't one
+    """
+    logs = [os.path.join(logfile_location, "{}.log".format(job))
+            for job in generate_scripts.recorded_jobs(commands_location)]
+    logs = [i for i in logs if os.path.isfile(i)]
+    return logs[-1] if logs else None
+
+
+def read_log(log_file):
+    """
+    read an analysis log file written by `generate_scripts.make_logfile_text`
+
+    Lines from older versions without the wall time and peak memory have
+    neither recorded. If a command was run more than once only its last
+    entry is kept.
+
+    Parameters:
+    -----------
+    log_file: string
+        path to the log file
+
+    Returns:
+    --------
+    pandas.DataFrame with columns `LOG_COLUMNS`, the wall time in seconds
+    and peak memory in kilobytes, which is NaN if it wasn't recorded
+    """
+    rows = []
+    with open(log_file) as f:
+        for line in f:
+            fields = line.rstrip("\n").split("  ")
+            if len(fields) == len(LOG_COLUMNS) - 2:
+                fields += ["NA", "NA"]
+            if len(fields) == len(LOG_COLUMNS):
+                rows.append(fields)
+    log = pd.DataFrame(rows, columns=LOG_COLUMNS)
+    log["command"] = log["command"].astype(int)
+    for col in ["wall_time", "max_rss"]:
+        log[col] = pd.to_numeric(log[col], errors="coerce")
+    return log.drop_duplicates("command", keep="last").reset_index(drop=True)
+
+
+def read_runs(log_file, commands_location):
+    """
+    join the manifest of the commands with the wall time and peak memory
+    of their successful analyses in `log_file`
+
+    Parameters:
+    -----------
+    log_file: string
+        path to the log file
+    commands_location: string
+        directory containing `manifest.csv`
+
+    Returns:
+    --------
+    pandas.DataFrame with a row per command, the wall time and peak memory
+    are NaN for commands which didn't finish
+    """
+    manifest_path = os.path.join(commands_location, "manifest.csv")
+    if not os.path.isfile(manifest_path):
+        raise TuneError("no manifest found at '{}'".format(manifest_path))
+    manifest = pd.read_csv(manifest_path)
+    log = read_log(log_file)
+    log = log[(log["status"] == "Finished") & log["wall_time"].notnull()]
+    runs = manifest.merge(log, on="command", how="left")
+    if runs["wall_time"].notnull().sum() == 0:
+        raise TuneError("no finished analyses with a recorded wall time "
+                        "in '{}'".format(log_file))
+    return runs
+
+
+def fit_cost(n_imagesets, values):
+    """
+    fit `values` as a linear function of the number of imagesets
+
+    If every task had the same number of imagesets the fixed cost can't be
+    told apart from the per-imageset cost, so all of it is taken to be per
+    imageset.
+
+    Parameters:
+    -----------
+    n_imagesets: array-like
+        number of imagesets in each task
+    values: array-like
+        wall time or peak memory of each task
+
+    Returns:
+    --------
+    tuple of (fixed cost, cost per imageset), neither negative
+    """
+    n_imagesets = np.asarray(n_imagesets, dtype=float)
+    values = np.asarray(values, dtype=float)
+    if len(np.unique(n_imagesets)) < 2:
+        return 0.0, float(np.mean(values / n_imagesets))
+    slope, intercept = np.polyfit(n_imagesets, values, 1)
+    if slope < 0:
+        # costs can't fall with more imagesets, so it's all overhead
+        return float(np.mean(values)), 0.0
+    if intercept < 0:
+        return 0.0, float(np.sum(n_imagesets * values) / np.sum(n_imagesets**2))
+    return float(intercept), float(slope)
+
+
+def makespan(plate_sizes, job_size, concurrency, wall_time_fit, overhead=0,
+             n_pipelines=1):
+    """
+    estimate how long it takes to analyse every plate
+
+    Each plate is split into jobs of `job_size` imagesets, which run
+    `concurrency` at a time in waves, each wave taking as long as a full
+    sized job.
+
+    Parameters:
+    -----------
+    plate_sizes: list of int
+        number of imagesets in each plate
+    job_size: int
+        number of imagesets per job
+    concurrency: int
+        number of array tasks that run at once
+    wall_time_fit: tuple
+        (fixed, per imageset) wall time in seconds, from `fit_cost`
+    overhead: float (default=0)
+        scheduling overhead of each task in seconds, not in the logs
+    n_pipelines: int (default=1)
+        number of pipelines each job is analysed with, each analysis being
+        a task of its own
+
+    Returns:
+    --------
+    float, seconds
+    """
+    n_jobs = n_pipelines * sum(int(math.ceil(n / float(job_size)))
+                               for n in plate_sizes)
+    n_waves = int(math.ceil(n_jobs / float(concurrency)))
+    fixed, per_imageset = wall_time_fit
+    return n_waves * (fixed + per_imageset * job_size + overhead)
+
+
+def memory_request(max_rss, headroom=1.25):
+    """
+    memory to request for a task with a peak memory of `max_rss`
+    kilobytes, rounded up to a whole number of gigabytes
+
+    Returns:
+    --------
+    string, e.g "4G"
+    """
+    return "{}G".format(max(1, int(math.ceil(max_rss * headroom / 1024**2))))
+
+
+def _pipeline_runs(runs):
+    """
+    split `runs` into the runs of each pipeline, manifests from before
+    there could be more than one pipeline having a single pipeline
+    """
+    if "pipeline" not in runs or runs["pipeline"].isnull().all():
+        return [runs]
+    return [group for _, group in runs.groupby("pipeline", sort=False)]
+
+
+def recommend(runs, concurrency, max_memory=None, max_wall_time=None,
+              overhead=0, headroom=1.25):
+    """
+    find the chunk size that minimises the makespan of the plates in `runs`
+
+    With more than one pipeline the costs are fitted for each pipeline, the
+    memory and wall time limits applying to the most demanding one, while
+    the makespan uses their average.
+
+    Parameters:
+    -----------
+    runs: pandas.DataFrame
+        commands and their costs, from `read_runs`
+    concurrency: int
+        number of array tasks that run at once
+    max_memory: string (default=None)
+        largest memory request allowed, e.g "12G". If None then no limit
+    max_wall_time: float (default=None)
+        longest a task can take in seconds. If None then no limit
+    overhead: float (default=0)
+        scheduling overhead of each task in seconds
+    headroom: float (default=1.25)
+        multiple of the predicted peak memory to request
+
+    Returns:
+    --------
+    dictionary with the recommended `job_size` and `memory`, and the
+    predicted `makespan`, `wall_time` and `n_jobs`
+    """
+    if concurrency < 1:
+        raise TuneError("concurrency has to be at least 1")
+    pipeline_runs = _pipeline_runs(runs)
+    wall_time_fits, memory_fits = [], []
+    for group in pipeline_runs:
+        finished = group[group["wall_time"].notnull()]
+        if finished.shape[0] > 0:
+            wall_time_fits.append(fit_cost(finished["n_imagesets"],
+                                           finished["wall_time"]))
+        memory_runs = finished[finished["max_rss"].notnull()]
+        if memory_runs.shape[0] > 0:
+            memory_fits.append(fit_cost(memory_runs["n_imagesets"],
+                                        memory_runs["max_rss"]))
+    wall_time_fit = tuple(np.mean(wall_time_fits, axis=0))
+    # packed jobs are counted as a plate of their own
+    plate_sizes = pipeline_runs[0].groupby("plate")["n_imagesets"].sum().tolist()
+    best = None
+    for job_size in range(1, max(plate_sizes) + 1):
+        wall_time = max(fixed + per_imageset * job_size
+                        for fixed, per_imageset in wall_time_fits)
+        if max_wall_time is not None and wall_time > max_wall_time:
+            break
+        if memory_fits:
+            memory = memory_request(max(fixed + per_imageset * job_size
+                                        for fixed, per_imageset in memory_fits),
+                                    headroom)
+            if max_memory is not None and \
+                    utils.parse_bytes(memory) > utils.parse_bytes(max_memory):
+                break
+        else:
+            memory = None
+        estimate = makespan(plate_sizes, job_size, concurrency, wall_time_fit,
+                            overhead, n_pipelines=len(pipeline_runs))
+        # prefer the larger chunk size when they're as fast, fewer jobs
+        if best is None or estimate <= best["makespan"]:
+            best = {"job_size": job_size,
+                    "memory": memory,
+                    "makespan": estimate,
+                    "wall_time": wall_time,
+                    "n_jobs": len(pipeline_runs) * sum(
+                        int(math.ceil(n / float(job_size))) for n in plate_sizes)}
+    if best is None:
+        raise TuneError("a single imageset doesn't fit within the memory "
+                        "and wall time limits")
+    return best
+
+
+def apply_recommendation(config_file, job_size, memory=None):
+    """
+    set `chunk` and `analysis memory` in a config file, leaving the rest of
+    the file as it is
+
+    Parameters:
+    -----------
+    config_file: string
+        path to the yaml config file
+    job_size: int
+        number of imagesets per job
+    memory: string (default=None)
+        memory request for each analysis task, not changed if None
+
+    Returns:
+    --------
+    nothing, rewrites `config_file`
+    """
+    with open(config_file) as f:
+        text = f.read()
+    settings = [("chunk", job_size)]
+    if memory is not None:
+        settings.append(("analysis memory", memory))
+    for key, value in settings:
+        line = "{} : {}".format(key, value)
+        pattern = r"^{}\s*:.*$".format(re.escape(key))
+        if re.search(pattern, text, flags=re.MULTILINE):
+            text = re.sub(pattern, line, text, count=1, flags=re.MULTILINE)
+        else:
+            if text and not text.endswith("\n"):
+                text += "\n"
+            text += line + "\n"
+    with open(config_file, "w") as f:
+        f.write(text)
+
+
+def parse_args(argv):
+    """parse the `cptools2 tune` command line arguments"""
+    parser = argparse.ArgumentParser(
+        prog="cptools2 tune",
+        description="recommend a chunk size and memory request from the "
+                    "wall time and peak memory of a previous run")
+    parser.add_argument("config", help="yaml config file of the previous run")
+    parser.add_argument("--concurrency", type=int, required=True,
+                        help="number of array tasks that run at once")
+    parser.add_argument("--max-memory", default=None,
+                        help="largest memory request allowed, e.g 12G")
+    parser.add_argument("--max-wall-time", type=float, default=None,
+                        help="longest a task can take, in hours")
+    parser.add_argument("--overhead", type=float, default=0,
+                        help="scheduling overhead of each task in seconds")
+    parser.add_argument("--headroom", type=float, default=1.25,
+                        help="multiple of the predicted peak memory to request")
+    parser.add_argument("--log", default=None,
+                        help="log file to use, defaults to the latest of "
+                             "the jobs run from the commands")
+    parser.add_argument("--apply", action="store_true",
+                        help="write the recommendation to the config file")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    """run `cptools2 tune`"""
+    args = parse_args(argv)
+    yaml_dict = parse_yaml.open_yaml(args.config)
+    parse_yaml.check_yaml_args(yaml_dict)
+    commands_location = parse_yaml.create_commands(yaml_dict)["commands_location"]
+    logfile_location = os.path.join(yaml_dict["location"], "logfiles")
+    log_file = args.log
+    if log_file is None:
+        # a rerun's log numbers its commands by the lines of the rerun's
+        # commands files, so the latest log may not match the manifest
+        log_file = commands_log(commands_location, logfile_location)
+    if log_file is None:
+        # commands from before their jobs were recorded
+        log_file = latest_log(logfile_location)
+    pretty_print("reading {}".format(yellow(log_file)))
+    runs = read_runs(log_file, commands_location)
+    max_wall_time = args.max_wall_time
+    if max_wall_time is not None:
+        max_wall_time *= 3600
+    best = recommend(runs, args.concurrency, max_memory=args.max_memory,
+                     max_wall_time=max_wall_time, overhead=args.overhead,
+                     headroom=args.headroom)
+    pretty_print("fitted {} finished tasks".format(
+        yellow(runs["wall_time"].notnull().sum())))
+    pretty_print("recommended chunk : {}, analysis memory : {}".format(
+        yellow(best["job_size"]), yellow(best["memory"])))
+    pretty_print("{} jobs of about {:.0f}s, makespan about {:.0f}s".format(
+        yellow(best["n_jobs"]), best["wall_time"], best["makespan"]))
+    if args.apply:
+        apply_recommendation(args.config, best["job_size"], best["memory"])
+        pretty_print("updated {}".format(yellow(args.config)))
+    return best
+
+
+class TuneError(Exception):
+    pass
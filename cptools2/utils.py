@@ -67,11 +67,13 @@ def prefix_filepaths(dataframe, name, location):
     """
     path_cols = [col for col in dataframe.columns if col.startswith("PathName")]
     # Updated from deprecated .applymap() to pandas 2.0+ compatible approach
+    # assign returns a new dataframe, so this also works on row slices
+    prefixed = {}
     for col in path_cols:
-        dataframe[col] = dataframe[col].map(
+        prefixed[col] = dataframe[col].map(
             lambda x: os.path.join(location, "img_data", name, x)
         )
-    return dataframe
+    return dataframe.assign(**prefixed)
 
 
 def any_nan_values(dataframe):
@@ -147,3 +149,45 @@ def make_executable(filepath):
     st = os.stat(filepath)
     os.chmod(filepath, st.st_mode | 0o111)
 
+
+def format_bytes(n_bytes):
+    """
+    human readable size, e.g 1536 -> "1.5K"
+
+    Parameters:
+    -----------
+    n_bytes: int
+        number of bytes
+
+    Returns:
+    --------
+    string
+    """
+    size = float(n_bytes)
+    for unit in ["B", "K", "M", "G"]:
+        if abs(size) < 1024:
+            return "{:.1f}{}".format(size, unit).replace(".0B", "B")
+        size /= 1024
+    return "{:.1f}T".format(size)
+
+
+def parse_bytes(size):
+    """
+    convert a size such as 2G, 500M or 1024 to a number of bytes. Suffixes
+    are powers of 1024 and are case-insensitive.
+
+    Parameters:
+    -----------
+    size: int or string
+
+    Returns:
+    --------
+    integer, number of bytes
+    """
+    if isinstance(size, int):
+        return size
+    size = str(size).strip().upper().rstrip("B")
+    multipliers = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    if size and size[-1] in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1]])
+    return int(size)
@@ -0,0 +1,138 @@
+"""
+Write per-job files (LoadData csv files and filelists) on a thread pool.
+
+On a network filesystem each write is dominated by latency rather than
+bandwidth, so writing many small files concurrently is much faster than
+writing them one after another.
+"""
+
+import os
+import threading
+from concurrent import futures
+
+# default number of files to write concurrently
+N_WORKERS = 8
+
+
+class BulkWriter(object):
+    """
+    Queue file writes to a bounded thread pool.
+
+    Each queued function should write a single file and return its path,
+    which is then flushed to disk with fsync. Submitting blocks once
+    `max_pending` writes are queued, so the data waiting to be written never
+    grows without bound. Any errors are collected and raised as a
+    `WriterError` by `close()`, which only returns once every file and the
+    directories containing them have been synced to disk.
+
+    Can be used as a context manager:
+
+        with BulkWriter() as writer:
+            writer.submit(commands.write_filelist, img_list, filelist_name)
+    """
+
+    def __init__(self, n_workers=None, max_pending=None):
+        if n_workers is None:
+            n_workers = N_WORKERS
+        if n_workers < 1:
+            raise ValueError("n_workers has to be at least 1")
+        if max_pending is None:
+            max_pending = 4 * n_workers
+        self.executor = futures.ThreadPoolExecutor(max_workers=n_workers)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.errors = []
+        self.directories = set()
+        self.n_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # don't mask the original exception with write errors
+            self.executor.shutdown(wait=True)
+            return False
+        self.close()
+        return False
+
+    def submit(self, func, *args, **kwargs):
+        """
+        queue a function which writes a file, blocking if too many writes
+        are already waiting.
+
+        Parameters:
+        -----------
+        func: function
+            function which writes a single file and returns its path
+        *args, **kwargs:
+            arguments passed to `func`
+
+        Returns:
+        --------
+        nothing
+        """
+        self.pending.acquire()
+        try:
+            future = self.executor.submit(self._write, func, args, kwargs)
+        except Exception:
+            self.pending.release()
+            raise
+        future.add_done_callback(self._done)
+
+    def _write(self, func, args, kwargs):
+        """run a write function and sync the file it wrote"""
+        path = func(*args, **kwargs)
+        _fsync(path)
+        return path
+
+    def _done(self, future):
+        """record the result of a write and free its slot in the queue"""
+        self.pending.release()
+        error = future.exception()
+        with self.lock:
+            if error is not None:
+                self.errors.append(error)
+            else:
+                self.n_written += 1
+                self.directories.add(os.path.dirname(os.path.abspath(future.result())))
+
+    def close(self):
+        """
+        wait for all queued writes to finish and sync their directories.
+
+        Returns:
+        --------
+        nothing, raises a WriterError if any of the writes failed
+        """
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            msg = "{} file(s) failed to write, first error: {!r}".format(
+                len(self.errors), self.errors[0])
+            raise WriterError(msg)
+        for directory in self.directories:
+            _fsync(directory)
+
+
+def _fsync(path):
+    """
+    flush a file or directory to disk
+
+    Parameters:
+    -----------
+    path: string
+        path to file or directory
+
+    Returns:
+    --------
+    nothing
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriterError(Exception):
+    pass
@@ -0,0 +1,199 @@
+import json
+import os
+import pytest
+from cptools2 import backends
+
+N_CHUNKS = 12
+
+
+def make_commands(tmpdir):
+    """commands which record when each phase of each chunk starts and ends"""
+    record = os.path.join(str(tmpdir), "record")
+    # cellprofiler commands are run without a shell, so use a script
+    recorder = os.path.join(str(tmpdir), "recorder.sh")
+    with open(recorder, "w") as f:
+        f.write('echo start $1 $2 >> {0}; sleep 0.02; echo end $1 $2 >> {0}\n'
+                '[ "$1 $2" != "analysis 3" ]\n'.format(record))
+    commands = {}
+    for phase in backends.PHASES:
+        commands[phase] = ["bash {} {} {}".format(recorder, phase, i)
+                           for i in range(N_CHUNKS)]
+    # analysis job 3 fails
+    return commands, record
+
+
+def read_records(metrics_dir):
+    """the metrics record of each command in `metrics_dir`"""
+    records = []
+    for name in os.listdir(metrics_dir):
+        with open(os.path.join(metrics_dir, name)) as f:
+            records.append(json.load(f))
+    return records
+
+
+def test_get_backend():
+    """cptools2.backends.get_backend(name)"""
+    assert isinstance(backends.get_backend(), backends.SGE)
+    assert isinstance(backends.get_backend("SLURM"), backends.SLURM)
+    local = backends.get_backend("local", n_workers={"analysis": 3})
+    assert local.n_workers["analysis"] == 3
+    assert local.n_workers["staging"] == backends.Local.DEFAULT_WORKERS["staging"]
+    assert backends.get_backend("sge").requires_staging_node is True
+    assert local.requires_staging_node is False
+    with pytest.raises(backends.BackendError):
+        backends.get_backend("pbs")
+    with pytest.raises(backends.BackendError):
+        backends.get_backend("local", n_workers={"analyse": 3})
+
+
+def test_local_run(tmpdir):
+    """cptools2.backends.Local.run(commands, logfile_location, log_file)"""
+    commands, record = make_commands(tmpdir)
+    log_file = os.path.join(str(tmpdir), "local.log")
+    n_workers = {"staging": 2, "analysis": 3, "destaging": 1}
+    local = backends.Local(n_workers=n_workers)
+    results = local.run(commands, str(tmpdir), log_file)
+    assert results["analysis"] == [1 if i == 3 else 0 for i in range(N_CHUNKS)]
+    assert results["staging"] == results["destaging"] == [0] * N_CHUNKS
+    with open(record) as f:
+        events = [line.split() for line in f]
+    # each chunk is staged, then analysed, then destaged
+    for i in range(N_CHUNKS):
+        chunk_events = [e[:2] for e in events if e[2] == str(i)]
+        assert chunk_events == [[event, phase] for phase in backends.PHASES
+                                for event in ["start", "end"]]
+    # no more than n_workers commands of a phase run at once
+    running = {phase: 0 for phase in backends.PHASES}
+    for event, phase, _ in events:
+        running[phase] += 1 if event == "start" else -1
+        assert running[phase] <= n_workers[phase]
+    with open(log_file) as f:
+        log = [line.split("  ") for line in f.read().splitlines()]
+    assert sorted(int(i[2]) for i in log) == list(range(1, N_CHUNKS + 1))
+    assert [i[3] for i in log if i[2] == "4"] == ["Failed with error code: 1"]
+    # along with the wall time and peak memory of each analysis
+    assert all(len(i) == 6 and i[4].isdigit() and int(i[5]) > 0 for i in log)
+    assert os.path.isfile(os.path.join(str(tmpdir), "analysis", "local.o1"))
+    # and the metrics of every command
+    for phase in backends.PHASES:
+        records = read_records(os.path.join(str(tmpdir), phase, "local"))
+        assert sorted(i["command"] for i in records) == list(range(1, N_CHUNKS + 1))
+        assert all(i["end"] >= i["start"] for i in records)
+    assert [i["status"] for i in records if i["command"] == 4] == [0]
+
+
+def test_local_run_markers(tmpdir):
+    """cptools2.backends.Local.run(commands, markers)"""
+    commands, _ = make_commands(tmpdir)
+    markers = [os.path.join(str(tmpdir), "marker_{}".format(i))
+               for i in range(N_CHUNKS)]
+    log_file = os.path.join(str(tmpdir), "local.log")
+    backends.Local(n_workers=2).run(commands, str(tmpdir), log_file,
+                                    markers=markers)
+    # only the successful analyses are recorded
+    assert [os.path.isfile(i) for i in markers] == [i != 3 for i in range(N_CHUNKS)]
+    with pytest.raises(backends.BackendError):
+        backends.Local().run(commands, str(tmpdir), log_file,
+                             markers=markers[1:])
+
+
+def test_local_run_pipelines(tmpdir):
+    """cptools2.backends.Local.run(commands) with more than one pipeline"""
+    commands, record = make_commands(tmpdir)
+    # a second pipeline, whose commands are after those of the first
+    commands["analysis"] += [i.replace("analysis", "analysis_2")
+                             for i in commands["analysis"]]
+    log_file = os.path.join(str(tmpdir), "local.log")
+    local = backends.Local(n_workers={"staging": 2, "analysis": 4, "destaging": 2})
+    results = local.run(commands, str(tmpdir), log_file)
+    assert len(results["analysis"]) == 2 * N_CHUNKS
+    assert results["analysis"][3] == 1 and sum(results["analysis"]) == 1
+    with open(record) as f:
+        events = [tuple(line.split()) for line in f]
+    # a chunk is only destaged once both pipelines have analysed it
+    for i in range(N_CHUNKS):
+        destaged = events.index(("start", "destaging", str(i)))
+        assert events.index(("end", "analysis", str(i))) < destaged
+        assert events.index(("end", "analysis_2", str(i))) < destaged
+    with open(log_file) as f:
+        logged = sorted(int(line.split("  ")[2]) for line in f)
+    assert logged == list(range(1, 2 * N_CHUNKS + 1))
+    commands["analysis"].pop()
+    with pytest.raises(backends.BackendError):
+        local.run(commands, str(tmpdir), log_file)
+
+
+def test_slurm_launch(tmpdir):
+    """cptools2.backends.SLURM.launch(commands_location, ...)"""
+    commands, _ = make_commands(tmpdir)
+    for phase in backends.PHASES:
+        path = os.path.join(str(tmpdir), backends.COMMAND_FILES[phase] + ".txt")
+        with open(path, "w") as f:
+            f.write("\n".join(commands[phase]) + "\n")
+    counts = {name: N_CHUNKS for name in backends.COMMAND_FILES.values()}
+    backends.SLURM().launch(str(tmpdir), counts, logfile_location="/logs",
+                            tasks_per_job=5)
+    files = os.listdir(str(tmpdir))
+    assert "cp_commands.idx" in files
+    submit = [i for i in files if i.endswith("SUBMIT_JOBS.sh")][0]
+    with open(os.path.join(str(tmpdir), submit)) as f:
+        submit_text = f.read()
+    assert submit_text.count("aftercorr") == 2
+    # a chunk which failed to stage doesn't leave its analysis queued forever
+    analysis = [i for i in submit_text.splitlines() if "analysis" in i][0]
+    assert '--dependency=aftercorr:"$STAGING_ID"?afterany:"$STAGING_ID"' in analysis
+    # a chunk whose analysis failed is still destaged
+    destaging = [i for i in submit_text.splitlines() if "destaging" in i][0]
+    assert '--dependency=aftercorr:"$ANALYSIS_ID"?afterany:"$ANALYSIS_ID"' in destaging
+    analysis = [i for i in files if i.endswith("analysis_script.sh")][0]
+    with open(os.path.join(str(tmpdir), analysis)) as f:
+        analysis_text = f.read()
+    assert "#SBATCH --array=1-3\n" in analysis_text
+    assert "$SLURM_ARRAY_TASK_ID" in analysis_text
+    # an analysis job per pipeline, each looking up its own block of lines
+    # and destaging waiting for both of them
+    pipelines_dir = str(tmpdir.mkdir("pipelines"))
+    commands["analysis"] *= 2
+    for phase in backends.PHASES:
+        path = os.path.join(pipelines_dir, backends.COMMAND_FILES[phase] + ".txt")
+        with open(path, "w") as f:
+            f.write("\n".join(commands[phase]) + "\n")
+    counts["cp_commands"] = 2 * N_CHUNKS
+    backends.SLURM().launch(pipelines_dir, counts, logfile_location="/logs")
+    files = os.listdir(pipelines_dir)
+    assert len([i for i in files if "_analysis_" in i]) == 2
+    analysis = [i for i in files if i.endswith("analysis_1_script.sh")][0]
+    with open(os.path.join(pipelines_dir, analysis)) as f:
+        assert "LINE_NUM=$((COMMAND_NUM + {}))".format(N_CHUNKS) in f.read()
+    submit = [i for i in files if i.endswith("SUBMIT_JOBS.sh")][0]
+    with open(os.path.join(pipelines_dir, submit)) as f:
+        submit_text = f.read()
+    assert submit_text.count('aftercorr:"$STAGING_ID"?afterany:"$STAGING_ID"') == 2
+    assert ('--dependency=aftercorr:"$ANALYSIS_0_ID":"$ANALYSIS_1_ID"'
+            '?afterany:"$ANALYSIS_0_ID":"$ANALYSIS_1_ID"') in submit_text
+
+
+def test_local_launch_pipelined(tmpdir):
+    """cptools2.backends.Local.launch(..., prefetch=1)"""
+    commands, record = make_commands(tmpdir)
+    for phase in backends.PHASES:
+        path = os.path.join(str(tmpdir), backends.COMMAND_FILES[phase] + ".txt")
+        with open(path, "w") as f:
+            f.write("\n".join(commands[phase]) + "\n")
+    counts = {name: N_CHUNKS for name in backends.COMMAND_FILES.values()}
+    logfile_location = os.path.join(str(tmpdir), "logs")
+    local = backends.Local(n_workers={"analysis": 3})
+    returncodes = local.launch(str(tmpdir), counts, logfile_location, prefetch=1)
+    assert returncodes == [0, 0, 0]
+    with open(record) as f:
+        events = [line.split() for line in f]
+    assert len(events) == 2 * 3 * N_CHUNKS
+    log_file = [i for i in os.listdir(logfile_location) if i.endswith(".log")][0]
+    with open(os.path.join(logfile_location, log_file)) as f:
+        log = [line.split("  ") for line in f.read().splitlines()]
+    assert sorted(int(i[2]) for i in log) == list(range(1, N_CHUNKS + 1))
+    assert [i[3] for i in log if i[2] == "4"] == ["Failed with error code: 1"]
+    assert all(len(i) == 6 and i[4].isdigit() for i in log)
+    records = read_records(os.path.join(logfile_location, "analysis",
+                                        log_file.replace(".log", "")))
+    assert [i["status"] for i in records if i["command"] == 4] == [1]
@@ -0,0 +1,145 @@
+import os
+import numpy as np
+from cptools2 import catalog
+from cptools2 import filelist
+from cptools2 import loaddata
+from cptools2 import splitter
+
+CURRENT_PATH = os.path.dirname(__file__)
+TEST_PATH = os.path.join(CURRENT_PATH, "example_dir")
+TEST_PATH_NEW = os.path.join(CURRENT_PATH, "example_dir_new_paths")
+TEST_PATH_PLATE_1 = os.path.join(TEST_PATH, "test-plate-1")
+TEST_PATH_NEW_PLATE_1 = os.path.join(TEST_PATH_NEW, "test-plate-1")
+IMG_LIST = filelist.files_from_plate(TEST_PATH_PLATE_1)
+IMG_LIST_NEW = filelist.files_from_plate(TEST_PATH_NEW_PLATE_1, is_new_ix=True)
+
+
+def test_image_catalog():
+    """cptools2.catalog.ImageCatalog(img_list)"""
+    image_catalog = catalog.ImageCatalog(IMG_LIST)
+    assert len(image_catalog) == 60 * 6
+    assert image_catalog.n_images == len(IMG_LIST)
+    # imagesets are the same as grouping with the splitter
+    grouped = splitter._group_images(splitter._well_site_table(IMG_LIST))
+    assert image_catalog.imagesets() == grouped
+    assert image_catalog.img_list() == [i for group in grouped for i in group]
+    # plate metadata is only stored once per directory
+    assert image_catalog.directories.shape[0] == 1
+
+
+def test_image_catalog_chunks():
+    """cptools2.catalog.ImageCatalog.chunks(job_size)"""
+    image_catalog = catalog.ImageCatalog(IMG_LIST)
+    chunks = image_catalog.chunks(96)
+    assert chunks == [(0, 96), (96, 192), (192, 288), (288, 360)]
+    expected = splitter.split(IMG_LIST, 96)
+    for (start, stop), chunk in zip(chunks, expected):
+        assert image_catalog.imagesets(start, stop) == chunk
+
+
+def test_image_catalog_loaddata():
+    """cptools2.catalog.ImageCatalog.loaddata(start, stop)"""
+    for img_list, is_new_ix in [(IMG_LIST, False), (IMG_LIST_NEW, True)]:
+        image_catalog = catalog.ImageCatalog(img_list, is_new_ix=is_new_ix)
+        for start, stop in image_catalog.chunks(50):
+            output = image_catalog.loaddata(start, stop)
+            expected = loaddata.create_loaddata(
+                image_catalog.img_list(start, stop), is_new_ix=is_new_ix)
+            assert output.equals(expected)
+
+
+def test_image_catalog_plate_loaddata():
+    """cptools2.catalog.ImageCatalog.plate_loaddata()"""
+    image_catalog = catalog.ImageCatalog(IMG_LIST)
+    df_plate = image_catalog.plate_loaddata()
+    assert df_plate.shape[0] == len(image_catalog)
+    for start, stop in image_catalog.chunks(96):
+        sliced = df_plate.iloc[start:stop]
+        expected = image_catalog.loaddata(start, stop)
+        assert sliced.columns.tolist() == expected.columns.tolist()
+        # same imagesets, but in well order rather than site order
+        sort_cols = ["Metadata_well", "Metadata_site"]
+        assert sliced.sort_values(sort_cols).to_csv(index=False) == \
+            expected.sort_values(sort_cols).to_csv(index=False)
+    # ragged channels can't be sliced from a single dataframe
+    assert catalog.ImageCatalog(IMG_LIST[1:]).plate_loaddata() is None
+
+
+def check_size_chunks(image_catalog, chunks, max_bytes, job_size=None):
+    """chunks cover every imageset in order, within the size limits"""
+    assert chunks[0][0] == 0 and chunks[-1][1] == len(image_catalog)
+    for (_, stop), (start, _) in zip(chunks[:-1], chunks[1:]):
+        assert stop == start
+    for start, stop in chunks:
+        assert image_catalog.n_bytes(start, stop) <= max_bytes or stop - start == 1
+        if job_size is not None:
+            assert stop - start <= job_size
+
+
+def test_image_catalog_chunks_by_size():
+    """cptools2.catalog.ImageCatalog.chunks_by_size(max_bytes, job_size)"""
+    image_catalog = catalog.ImageCatalog(IMG_LIST)
+    image_catalog.stat(root=TEST_PATH)
+    # the example images are empty, so this is the same as chunks()
+    assert image_catalog.n_bytes() == 0
+    assert image_catalog.chunks_by_size(100, 96) == image_catalog.chunks(96)
+    # imagesets in some wells are much larger than in others
+    wells = image_catalog.images["Metadata_well"].to_numpy()
+    image_catalog.sizes = np.where(np.char.startswith(wells.astype(str), "B"),
+                                   1000, 10).astype(np.int64)
+    total = image_catalog.n_bytes()
+    chunks = image_catalog.chunks_by_size(total // 5)
+    check_size_chunks(image_catalog, chunks, total // 5)
+    chunk_bytes = [image_catalog.n_bytes(*chunk) for chunk in chunks]
+    # balanced, rather than a small chunk left at the end
+    assert len(chunks) <= 6
+    assert min(chunk_bytes) > 0.8 * max(chunk_bytes)
+    chunks = image_catalog.chunks_by_size(total // 5, job_size=50)
+    check_size_chunks(image_catalog, chunks, total // 5, job_size=50)
+    # a single huge imageset falls back to filling each chunk in turn
+    image_catalog.sizes = np.ones(image_catalog.n_images, dtype=np.int64)
+    image_catalog.sizes[-1] = 10**9
+    chunks = image_catalog.chunks_by_size(200)
+    check_size_chunks(image_catalog, chunks, 200)
+    assert chunks[-1] == (len(image_catalog) - 1, len(image_catalog))
+
+
+def test_image_catalog_select_channels():
+    """cptools2.catalog.ImageCatalog.select_channels(channels)"""
+    image_catalog = catalog.ImageCatalog(IMG_LIST)
+    n_images = image_catalog.n_images
+    dropped = image_catalog.select_channels([1, 3])
+    assert len(image_catalog) == 60 * 6
+    assert image_catalog.n_images + len(dropped) == n_images
+    assert sorted(image_catalog.images["Metadata_channel"].unique()) == [1, 3]
+    for imageset in image_catalog.imagesets():
+        assert len(imageset) == 2
+    df = image_catalog.plate_loaddata()
+    assert sorted(i for i in df.columns if i.startswith("FileName")) == \
+        ["FileName_W1", "FileName_W3"]
+    assert image_catalog.loaddata(0, 10).shape[0] == 10
+
+
+def test_image_catalog_select_imagesets():
+    """cptools2.catalog.ImageCatalog.select_imagesets(wells, rows, columns, sites)"""
+    image_catalog = catalog.ImageCatalog(IMG_LIST)
+    n_images = image_catalog.n_images
+    dropped = image_catalog.select_imagesets(rows=["b", "C"], columns=[2, 3, 4],
+                                             sites=[1, 2])
+    assert len(image_catalog) == 2 * 3 * 2
+    assert image_catalog.n_images + len(dropped) == n_images
+    assert sorted(image_catalog.images["Metadata_well"].unique()) == \
+        ["B02", "B03", "B04", "C02", "C03", "C04"]
+    # whole imagesets are kept
+    assert all(len(i) == 5 for i in image_catalog.imagesets())
+    image_catalog = catalog.ImageCatalog(IMG_LIST)
+    image_catalog.select_imagesets(wells=["b2", "C03", "H12"])
+    assert sorted(image_catalog.images["Metadata_well"].unique()) == ["B02", "C03"]
+    assert len(image_catalog) == 2 * 6
+    # timepoints from the new ImageXpress paths
+    image_catalog = catalog.ImageCatalog(IMG_LIST_NEW, is_new_ix=True)
+    image_catalog.select_imagesets(timepoints=[2])
+    assert len(image_catalog) == 0
+    image_catalog = catalog.ImageCatalog(IMG_LIST_NEW, is_new_ix=True)
+    image_catalog.select_imagesets(timepoints=[1])
+    assert len(image_catalog) == 360
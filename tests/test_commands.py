@@ -1,4 +1,5 @@
 import os
+import pytest
 from cptools2 import commands
 
 CURRENT_PATH = os.path.dirname(__file__)
@@ -18,6 +19,19 @@ def test_make_cp_cmnd():
     assert cmnd == correct
 
 
+def test_parse_cp_command():
+    """cptools2.commands.parse_cp_command(cmnd)"""
+    args = {"pipeline": "/path/to/pipeline.cppipe",
+            "load_data": "/path/to/loaddata/plate.csv",
+            "output_location": "/path/to/raw_data/plate_0",
+            "image_sets": None}
+    assert commands.parse_cp_command(commands.cp_command(**args)) == args
+    args["image_sets"] = (97, 192)
+    assert commands.parse_cp_command(commands.cp_command(**args)) == args
+    with pytest.raises(ValueError):
+        commands.parse_cp_command("rm -rf /path/to/img_data/plate_0")
+
+
 def make_rsync_cmnd():
     """cptools2.commands.make_rsync_cmnd(plate_loc, filelist_name, img_location)"""
     plate_loc = "/plate_location"
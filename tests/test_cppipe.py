@@ -0,0 +1,47 @@
+import json
+import os
+from cptools2 import cppipe
+
+TEXT_PIPELINE = """CellProfiler Pipeline: http://www.cellprofiler.org
+Version:3
+DateRevision:319
+ModuleCount:4
+HasImagePlaneDetails:False
+
+LoadData:[module_num:1|svn_version:\\'Unknown\\'|variable_revision_number:6|show_window:False|notes:\\x5B\\x5D|batch_state:array(\\x5B\\x5D, dtype=uint8)|enabled:True|wants_pause:False]
+    Input data file location:Default Input Folder\\x7C
+    Name of the file:load_data.csv
+
+IdentifyPrimaryObjects:[module_num:2|svn_version:\\'Unknown\\'|variable_revision_number:13|show_window:False|notes:\\x5B\\x5D|batch_state:array(\\x5B\\x5D, dtype=uint8)|enabled:True|wants_pause:False]
+    Select the input image:W1
+    Name the primary objects to be identified:Nuclei
+
+MeasureObjectIntensity:[module_num:3|svn_version:\\'Unknown\\'|variable_revision_number:4|show_window:False|notes:\\x5B\\x5D|batch_state:array(\\x5B\\x5D, dtype=uint8)|enabled:True|wants_pause:False]
+    Select images to measure:W1, W3
+    Select objects to measure:Nuclei, W12Cells
+
+SaveImages:[module_num:4|svn_version:\\'Unknown\\'|variable_revision_number:15|show_window:False|notes:\\x5B\\x5D|batch_state:array(\\x5B\\x5D, dtype=uint8)|enabled:False|wants_pause:False]
+    Select the image to save:W5
+"""
+
+
+def test_pipeline_channels(tmpdir):
+    """cptools2.cppipe.pipeline_channels(pipeline)"""
+    pipeline = os.path.join(str(tmpdir), "pipeline.cppipe")
+    with open(pipeline, "w") as f:
+        f.write(TEXT_PIPELINE)
+    # W5 is only used by a disabled module
+    assert cppipe.pipeline_channels(pipeline) == [1, 3]
+    json_pipeline = os.path.join(str(tmpdir), "pipeline_json.cppipe")
+    with open(json_pipeline, "w") as f:
+        json.dump({"modules": [
+            {"attributes": {"module_name": "IdentifyPrimaryObjects", "enabled": True},
+             "settings": [{"name": "Select the input image", "value": "W2"}]},
+            {"attributes": {"module_name": "SaveImages", "enabled": False},
+             "settings": [{"name": "Select the image to save", "value": "W4"}]}
+        ]}, f)
+    assert cppipe.pipeline_channels(json_pipeline) == [2]
+    empty = os.path.join(str(tmpdir), "empty.cppipe")
+    with open(empty, "w") as f:
+        f.write("test1:test\n")
+    assert cppipe.pipeline_channels(empty) == []
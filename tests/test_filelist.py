@@ -1,4 +1,7 @@
+import glob
 import os
+import shutil
+import time
 from cptools2 import filelist
 
 CURRENT_PATH = os.path.dirname(__file__)
@@ -57,3 +60,76 @@ def test_paths_to_plates():
     for ans in output:
         assert ans in make_own
 
+
+
+def test_scan_plate_matches_glob():
+    """filelist._scan_plate returns the same paths as glob"""
+    plate_path = os.path.join(TEST_PATH, "test-plate-1")
+    output = filelist._scan_plate(plate_path, ext=".tif", depth=2)
+    assert output == glob.glob(plate_path + "/*/*/*.tif")
+    plate_path_new = os.path.join(TEST_PATH_NEW, "test-plate-1")
+    output_new = filelist._scan_plate(plate_path_new, ext=".tif", depth=3)
+    assert output_new == glob.glob(plate_path_new + "/*/*/*/*.tif")
+
+
+def test_files_from_plates():
+    """files_from_plates matches files_from_plate for each plate"""
+    plate_paths = filelist.paths_to_plates(TEST_PATH)
+    output = filelist.files_from_plates(plate_paths, n_workers=2)
+    assert len(output) == len(plate_paths)
+    for plate_path, img_files in zip(plate_paths, output):
+        assert img_files == filelist.files_from_plate(plate_path)
+
+
+def test_files_from_plate_index(tmpdir, monkeypatch):
+    """files_from_plate with a persistent plate index"""
+    plate_path = os.path.join(str(tmpdir), "plates", "test-plate-1")
+    shutil.copytree(os.path.join(TEST_PATH, "test-plate-1"), plate_path)
+    # directories modified within MTIME_RESOLUTION_NS aren't trusted, so
+    # date the copy an hour back as if it were an existing plate
+    an_hour_ago = time.time() - 3600
+    for directory, _, _ in os.walk(plate_path):
+        os.utime(directory, (an_hour_ago, an_hour_ago))
+    index_location = os.path.join(str(tmpdir), "plate_index")
+    expected = filelist.files_from_plate(plate_path)
+    output = filelist.files_from_plate(plate_path,
+                                       index_location=index_location)
+    assert output == expected
+    assert len(os.listdir(index_location)) == 1
+    # count the directories listed from here on
+    scanned = []
+    scan_dir = filelist._scan_dir
+    def counting_scan_dir(directory, dir_only):
+        scanned.append(directory)
+        return scan_dir(directory, dir_only)
+    monkeypatch.setattr(filelist, "_scan_dir", counting_scan_dir)
+    # second scan is read from the index without listing any directory
+    output_cached = filelist.files_from_plate(plate_path,
+                                              index_location=index_location)
+    assert output_cached == expected
+    assert scanned == []
+    # touching a directory makes it, and only it, be listed again
+    img_dir = os.path.dirname(glob.glob(plate_path + "/*/*/*.tif")[0])
+    os.utime(img_dir, (an_hour_ago + 60, an_hour_ago + 60))
+    output_touched = filelist.files_from_plate(plate_path,
+                                               index_location=index_location)
+    assert output_touched == expected
+    assert scanned == [img_dir]
+    # new images are picked up when their directory changes
+    new_img = os.path.join(img_dir, "val screen_B02_s9_w1ABCDEF.tif")
+    open(new_img, "w").close()
+    output_updated = filelist.files_from_plate(plate_path,
+                                               index_location=index_location)
+    assert len(output_updated) == len(expected) + 1
+
+
+def test_file_sizes(tmpdir):
+    """cptools2.filelist.file_sizes(img_list)"""
+    img_list = []
+    for i in range(50):
+        path = os.path.join(str(tmpdir), "img_{}.tif".format(i))
+        with open(path, "wb") as f:
+            f.write(b"0" * i)
+        img_list.append(path)
+    assert filelist.file_sizes(img_list, n_workers=3) == list(range(50))
+    assert filelist.file_sizes([]) == []
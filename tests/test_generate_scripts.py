@@ -2,12 +2,33 @@
 module docstring
 """
 
+import json
 import os
+import subprocess
+import pytest
 from cptools2 import generate_scripts
+from cptools2 import result_cache
 
 CURRENT_PATH = os.path.dirname(__file__)
 TEST_DIR_PATH = os.path.join(CURRENT_PATH, "example_commands")
 
+# commands of varying length, with spaces, quotes and non-ascii characters
+COMMANDS = ['rsync --files-from="/a/filelist {}" "/plate dir/" "/img"'.format(i) * (i % 7 + 1)
+            for i in range(300)]
+COMMANDS[0] = "cellprofiler -r -c -p '/path/pipe line.cppipe'  "
+COMMANDS[1] = "rm -rf /tmp/pl\u00e4te_\u03bc\tdir"
+
+
+def write_commands_file(tmpdir):
+    """write COMMANDS to a commands file and index it"""
+    command_file = os.path.join(str(tmpdir), "cp_commands.txt")
+    with open(command_file, "w") as f:
+        for line in COMMANDS:
+            f.write(line + "\n")
+    generate_scripts.write_command_index(command_file)
+    return command_file
+
+
 def test_make_command_paths():
     """cptools2.generate_scripts.make_commands_paths(commands_location)"""
     paths = generate_scripts.make_command_paths(TEST_DIR_PATH)
@@ -33,3 +54,301 @@ def test_lines_in_commnads():
     for name in expected_names:
         assert name in output
     assert len(output.values()) == 3
+
+
+def test_lines_in_commands_pipelines(tmpdir):
+    """cptools2.generate_scripts.lines_in_commands(commands_location)"""
+    write_recording_commands(tmpdir, 5, n_pipelines=3)
+    output = generate_scripts.lines_in_commands(str(tmpdir))
+    assert output == {"staging": 5, "cp_commands": 15, "destaging": 5}
+    assert generate_scripts.n_pipelines(output) == 3
+    assert generate_scripts.analysis_names(3) == ["analysis_0", "analysis_1",
+                                                  "analysis_2"]
+    assert generate_scripts.analysis_names(1) == ["analysis"]
+    # not a whole number of pipelines
+    with open(os.path.join(str(tmpdir), "cp_commands.txt"), "a") as f:
+        f.write("extra\n")
+    with pytest.raises(RuntimeWarning):
+        generate_scripts.lines_in_commands(str(tmpdir))
+
+
+def test_write_command_index(tmpdir):
+    """cptools2.generate_scripts.write_command_index(command_file)"""
+    command_file = write_commands_file(tmpdir)
+    idx_file = os.path.join(str(tmpdir), "cp_commands.idx")
+    assert generate_scripts.index_path(command_file) == idx_file
+    with open(idx_file) as f:
+        records = f.read().splitlines(True)
+    assert len(records) == len(COMMANDS) + 1
+    assert all(len(i) == generate_scripts.INDEX_WIDTH + 1 for i in records)
+    assert int(records[-1]) == os.path.getsize(command_file)
+
+
+def test_read_command(tmpdir):
+    """cptools2.generate_scripts.read_command(command_file, task_id)"""
+    command_file = write_commands_file(tmpdir)
+    for task_id, command in enumerate(COMMANDS, 1):
+        assert generate_scripts.read_command(command_file, task_id) == command
+
+
+def test_command_lookup_text(tmpdir):
+    """cptools2.generate_scripts.command_lookup_text(input_file)"""
+    command_file = write_commands_file(tmpdir)
+    # simulate every array task fetching its command
+    script = "for SGE_TASK_ID in $(seq 1 {}); do\n".format(len(COMMANDS))
+    script += generate_scripts.command_lookup_text(command_file)
+    script += 'printf "%s\\n" "$SEED"\ndone\n'
+    for shell in ["sh", "bash"]:
+        output = subprocess.check_output([shell, "-c", script])
+        assert output.decode().split("\n")[:-1] == COMMANDS
+
+
+def test_n_array_tasks():
+    """cptools2.generate_scripts.n_array_tasks(n_commands, tasks_per_job)"""
+    assert generate_scripts.n_array_tasks(10) == 10
+    assert generate_scripts.n_array_tasks(10, 3) == 4
+    assert generate_scripts.n_array_tasks(9, 3) == 3
+
+
+def test_command_loop_text(tmpdir):
+    """cptools2.generate_scripts.command_loop_text(body, n_commands, tasks_per_job)"""
+    command_file = write_commands_file(tmpdir)
+    body = generate_scripts.command_lookup_text(command_file, task_id="$COMMAND_NUM")
+    body += 'printf "%s\\n" "$SEED"\n'
+    for tasks_per_job in [1, 7, 300, 1000]:
+        n_tasks = generate_scripts.n_array_tasks(len(COMMANDS), tasks_per_job)
+        # every command is run once, in order, across the array tasks
+        script = "for SGE_TASK_ID in $(seq 1 {}); do\n".format(n_tasks)
+        script += generate_scripts.command_loop_text(body, len(COMMANDS),
+                                                     tasks_per_job=tasks_per_job)
+        script += "done\n"
+        output = subprocess.check_output(["sh", "-c", script])
+        assert output.decode().split("\n")[:-1] == COMMANDS
+
+
+def write_recording_commands(tmpdir, n_commands, n_pipelines=1):
+    """
+    staging, cellprofiler and destaging commands files whose commands record
+    when they start and end, with a block of cellprofiler commands for each
+    pipeline
+    """
+    record = os.path.join(str(tmpdir), "record")
+    # cellprofiler commands are run without a shell, so use a script
+    recorder = os.path.join(str(tmpdir), "recorder.sh")
+    with open(recorder, "w") as f:
+        f.write('echo start $1 $2 >> {0}; sleep 0.05; echo end $1 $2 >> {0}\n'.format(record))
+    for name in ["staging", "cp_commands", "destaging"]:
+        with open(os.path.join(str(tmpdir), name + ".txt"), "w") as f:
+            names = [name]
+            if name == "cp_commands" and n_pipelines > 1:
+                names = ["cp_commands_{}".format(p) for p in range(n_pipelines)]
+            for command_name in names:
+                for i in range(1, n_commands + 1):
+                    f.write("bash {} {} {}\n".format(recorder, command_name, i))
+    generate_scripts.write_command_indices(str(tmpdir))
+    return record
+
+
+def test_pipelined_loop_text(tmpdir):
+    """cptools2.generate_scripts.pipelined_loop_text(cmd_path, n_commands, ...)"""
+    n_commands, tasks_per_job, prefetch = 7, 4, 2
+    record = write_recording_commands(tmpdir, n_commands)
+    cmd_path = generate_scripts.make_command_paths(str(tmpdir))
+    for phase in ["staging", "analysis", "destaging"]:
+        os.makedirs(os.path.join(str(tmpdir), phase))
+    script = generate_scripts.pipelined_loop_text(
+        cmd_path, n_commands, logfile_location=str(tmpdir), job_file="log",
+        tasks_per_job=tasks_per_job, prefetch=prefetch, task_id="$1")
+    script_path = os.path.join(str(tmpdir), "pipeline.sh")
+    with open(script_path, "w") as f:
+        f.write(script)
+    for task in range(1, generate_scripts.n_array_tasks(n_commands, tasks_per_job) + 1):
+        subprocess.check_call(["bash", script_path, str(task)])
+    with open(record) as f:
+        events = [(event, name, int(i)) for event, name, i in
+                  (line.split() for line in f)]
+    # every chunk is staged, analysed and destaged exactly once, in order
+    for i in range(1, n_commands + 1):
+        position = {(event, name): events.index((event, name, i))
+                    for event, name, num in events if num == i}
+        assert len(position) == 6
+        assert position[("end", "staging")] < position[("start", "cp_commands")]
+        assert position[("end", "cp_commands")] < position[("start", "destaging")]
+    # staging is never more than `prefetch` chunks ahead of the chunk
+    # being analysed, the one after the last to finish its analysis
+    for idx, (event, name, i) in enumerate(events):
+        if (event, name) == ("start", "staging"):
+            task_start = (i - 1) // tasks_per_job * tasks_per_job + 1
+            analysed = [num for e, n, num in events[:idx]
+                        if (e, n) == ("end", "cp_commands") and num >= task_start]
+            current = max(analysed) + 1 if analysed else task_start
+            assert i <= current + prefetch
+    # and the next chunk is staged while the current one is analysed
+    assert events.index(("start", "staging", 2)) < events.index(("end", "cp_commands", 1))
+    with open(os.path.join(str(tmpdir), "log.log")) as f:
+        assert len(f.read().splitlines()) == n_commands
+    # along with a metrics record for every task of each phase
+    for phase in ["staging", "analysis", "destaging"]:
+        records = read_records(generate_scripts.metrics_dir(str(tmpdir), phase, "log"))
+        assert sorted(i["command"] for i in records) == list(range(1, n_commands + 1))
+        assert all(i["phase"] == phase and i["status"] == 0 for i in records)
+
+
+def read_records(metrics_dir):
+    """the metrics record of each command in `metrics_dir`"""
+    records = []
+    for name in os.listdir(metrics_dir):
+        with open(os.path.join(metrics_dir, name)) as f:
+            records.append(json.load(f))
+    return records
+
+
+def write_fake_rsync(tmpdir):
+    """a stand-in for rsync which only reports its --stats, returns its directory"""
+    bin_dir = tmpdir.mkdir("bin")
+    fake_rsync = os.path.join(str(bin_dir), "rsync")
+    with open(fake_rsync, "w") as f:
+        f.write('#!/bin/sh\n'
+                '[ "$1" = "--stats" ] || exit 2\n'
+                'echo "Number of files: 5 (reg: 4, dir: 1)"\n'
+                'echo "Number of regular files transferred: 4"\n'
+                'echo "Total file size: 2,048,000 bytes"\n'
+                'echo "Total transferred file size: 1,024,000 bytes"\n')
+    os.chmod(fake_rsync, 0o755)
+    return str(bin_dir)
+
+
+def test_transfer_text(tmpdir):
+    """cptools2.generate_scripts.transfer_text(phase, command_text, metrics_dir)"""
+    bin_dir = write_fake_rsync(tmpdir)
+    metrics_dir = os.path.join(str(tmpdir), "metrics")
+    script = 'SEED="rsync a b && rsync c d"\nCOMMAND_NUM=3\nJOB_ID=42\n'
+    script += generate_scripts.transfer_text("staging", 'bash -c "$SEED"',
+                                             metrics_dir)
+    script += 'SEED="exit 3"\n'
+    script += generate_scripts.transfer_text("destaging", 'bash -c "$SEED"',
+                                             metrics_dir, task_id=4)
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ["PATH"])
+    # the job scripts aren't necessarily run by bash
+    for shell in ["sh", "bash"]:
+        subprocess.check_call([shell, "-c", script], env=env)
+        staging, destaging = sorted(read_records(metrics_dir),
+                                    key=lambda i: i["command"])
+        assert staging["phase"] == "staging" and staging["job"] == "42"
+        assert staging["command"] == 3 and staging["status"] == 0
+        # summed over both rsync commands
+        assert staging["files"] == 8 and staging["bytes"] == 2048000
+        assert staging["end"] - staging["start"] == staging["duration"] >= 0
+        assert destaging["status"] == 3 and "bytes" not in destaging
+
+
+def test_timed_command_text():
+    """cptools2.generate_scripts.timed_command_text()"""
+    text = generate_scripts.timed_command_text()
+    # BSD time has no -f or -o, so only GNU time is used
+    assert "/usr/bin/time --version 2>&1 | grep -q GNU" in text
+    script = 'SEED="sh -c \'exit 2\'"\n' + text
+    script += 'echo "$RETURN_VAL $WALL_TIME $MAX_RSS"\n'
+    for shell in ["sh", "bash"]:
+        output = subprocess.check_output([shell, "-c", script]).decode()
+        return_val, wall_time, max_rss = output.split()
+        assert return_val == "2" and wall_time.isdigit()
+        assert max_rss == "NA" or max_rss.isdigit()
+
+
+def test_staging_script_sh(tmpdir):
+    """cptools2.generate_scripts.BodgeScript.bodge_array_loop(phase, input_file, metrics_dir) under sh"""
+    bin_dir = write_fake_rsync(tmpdir)
+    staging = os.path.join(str(tmpdir), "staging.txt")
+    with open(staging, "w") as f:
+        for i in range(3):
+            f.write('rsync --files-from="/a/filelist {0}" "/plate dir/" "/img {0}"\n'.format(i))
+    generate_scripts.write_command_index(staging)
+    metrics_dir = os.path.join(str(tmpdir), "metrics")
+    script = generate_scripts.BodgeScript(name="staging", memory="1G",
+                                          output=str(tmpdir), tasks=2)
+    script.bodge_array_loop(phase="staging", input_file=staging,
+                            tasks_per_job=2, metrics_dir=metrics_dir)
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ["PATH"],
+               JOB_ID="7")
+    # run every array task with sh, as SGE does without -S /bin/bash
+    for task in ["1", "2"]:
+        env["SGE_TASK_ID"] = task
+        subprocess.check_call(["sh", "-c", script.template], env=env,
+                              cwd=str(tmpdir))
+    records = sorted(read_records(metrics_dir), key=lambda i: i["command"])
+    assert [i["command"] for i in records] == [1, 2, 3]
+    assert all(i["status"] == 0 and i["files"] == 4 for i in records)
+
+
+def test_make_submit_script(tmpdir):
+    """cptools2.generate_scripts.make_submit_script(commands_location, job_date)"""
+    path = generate_scripts.make_submit_script(str(tmpdir), "date")
+    with open(path) as f:
+        lines = f.read().splitlines()
+    qsub_lines = [i for i in lines if i.startswith("qsub")]
+    assert qsub_lines == ["qsub {}/date_{}_script.sh".format(str(tmpdir), name)
+                          for name in ["staging", "analysis", "destaging"]]
+    assert lines[0] == "" and lines[1] == "#!/bin/sh"
+    path = generate_scripts.make_submit_script(str(tmpdir), "date",
+                                               names=["pipeline"])
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert lines[-1] == "qsub {}/date_pipeline_script.sh".format(str(tmpdir))
+    assert not any(i.startswith(" ") for i in lines)
+
+
+def test_pipelined_loop_text_pipelines(tmpdir):
+    """cptools2.generate_scripts.pipelined_loop_text(cmd_path, n_commands, n_pipelines)"""
+    n_commands, n_pipelines = 3, 2
+    record = write_recording_commands(tmpdir, n_commands, n_pipelines)
+    cmd_path = generate_scripts.make_command_paths(str(tmpdir))
+    script = generate_scripts.pipelined_loop_text(
+        cmd_path, n_commands, logfile_location=str(tmpdir), job_file="log",
+        tasks_per_job=n_commands, task_id="$1", n_pipelines=n_pipelines)
+    script_path = os.path.join(str(tmpdir), "pipeline.sh")
+    with open(script_path, "w") as f:
+        f.write(script)
+    subprocess.check_call(["bash", script_path, "1"])
+    with open(record) as f:
+        events = [tuple(line.split()) for line in f]
+    # each chunk is analysed by every pipeline before it's destaged
+    for i in range(1, n_commands + 1):
+        destaged = events.index(("start", "destaging", str(i)))
+        for p in range(n_pipelines):
+            assert events.index(("end", "cp_commands_{}".format(p), str(i))) < destaged
+    with open(os.path.join(str(tmpdir), "log.log")) as f:
+        logged = sorted(int(line.split("  ")[2]) for line in f)
+    assert logged == list(range(1, n_commands * n_pipelines + 1))
+
+
+def test_analysis_text_result_cache(tmpdir):
+    """cptools2.generate_scripts.analysis_text(cp_commands, ...) with a result cache"""
+    n_commands = 4
+    write_recording_commands(tmpdir, n_commands)
+    # the 2nd analysis fails
+    cp_commands = os.path.join(str(tmpdir), "cp_commands.txt")
+    with open(cp_commands, "w") as f:
+        f.write("true\nfalse\ntrue\ntrue\n")
+    markers = [os.path.join(str(tmpdir), "marker_{}".format(i))
+               for i in range(1, n_commands + 1)]
+    result_cache.write_markers(str(tmpdir), markers)
+    generate_scripts.write_command_indices(str(tmpdir))
+    assert os.path.isfile(os.path.join(str(tmpdir), "result_cache.idx"))
+    os.makedirs(os.path.join(str(tmpdir), "analysis"))
+    body = generate_scripts.analysis_text(cp_commands, str(tmpdir),
+                                          job_file="log", n_tasks=1)
+    script = generate_scripts.command_loop_text(body, n_commands,
+                                                tasks_per_job=n_commands,
+                                                task_id="$1")
+    script_path = os.path.join(str(tmpdir), "analysis.sh")
+    with open(script_path, "w") as f:
+        f.write(script)
+    subprocess.check_call(["bash", script_path, "1"])
+    assert [os.path.isfile(i) for i in markers] == [True, False, True, True]
+    records = sorted(read_records(generate_scripts.metrics_dir(str(tmpdir), "analysis", "log")),
+                     key=lambda i: i["command"])
+    assert [i["status"] for i in records] == [0, 1, 0, 0]
+    assert [i["chunk"] for i in records] == [1, 2, 3, 4]
+    # without GNU time the peak memory isn't known
+    assert all(i["max_rss"] is None or i["max_rss"] > 0 for i in records)
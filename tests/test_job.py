@@ -0,0 +1,370 @@
+import os
+import pandas as pd
+import pytest
+from cptools2 import job
+
+CURRENT_PATH = os.path.dirname(__file__)
+TEST_PATH = os.path.join(CURRENT_PATH, "example_dir")
+PIPELINE = os.path.join(CURRENT_PATH, "example_pipeline.cppipe")
+
+
+def read_commands(commands_location):
+    """read the staging, cellprofiler and destaging commands"""
+    output = {}
+    for name in ["staging", "cp_commands", "destaging"]:
+        with open(os.path.join(commands_location, name + ".txt")) as f:
+            output[name] = f.read().splitlines()
+    return output
+
+
+def read_outputs(location, commands_location):
+    """read all the commands, loaddata and filelists relative to `location`"""
+    output = read_commands(commands_location)
+    for subdir in ["loaddata", "filelist"]:
+        for name in sorted(os.listdir(os.path.join(location, subdir))):
+            with open(os.path.join(location, subdir, name)) as f:
+                output[(subdir, name)] = f.read().splitlines()
+    return {key: [line.replace(location, "") for line in lines]
+            for key, lines in output.items()}
+
+
+def make_job(tmpdir, job_size=50, streaming=False, **kwargs):
+    """create commands for two of the example plates"""
+    location = os.path.join(str(tmpdir), "location")
+    commands_location = os.path.join(str(tmpdir), "commands")
+    os.makedirs(commands_location)
+    jobber = job.Job(is_new_ix=False, streaming=streaming)
+    jobber.add_plate(["test-plate-1", "test-plate-2"], exp_dir=TEST_PATH)
+    jobber.chunk(job_size=job_size)
+    jobber.create_commands(pipeline=PIPELINE, location=location,
+                           commands_location=commands_location,
+                           job_size=job_size, **kwargs)
+    return location, commands_location
+
+
+def test_create_commands(tmpdir):
+    """cptools2.job.Job.create_commands()"""
+    location, commands_location = make_job(tmpdir)
+    cmnds = read_commands(commands_location)
+    # 360 imagesets per plate in chunks of 50
+    n_jobs = 2 * 8
+    for name in cmnds:
+        assert len(cmnds[name]) == n_jobs
+    assert len(os.listdir(os.path.join(location, "loaddata"))) == n_jobs
+    assert len(os.listdir(os.path.join(location, "filelist"))) == n_jobs
+    df_first = pd.read_csv(os.path.join(location, "loaddata", "test-plate-1_0.csv"))
+    assert df_first.shape[0] == 50
+
+
+def test_create_commands_plate_layout(tmpdir):
+    """cptools2.job.Job.create_commands(layout="plate")"""
+    location, commands_location = make_job(tmpdir.mkdir("plate"), layout="plate")
+    cmnds = read_commands(commands_location)
+    chunk_location, chunk_commands_location = make_job(tmpdir.mkdir("chunk"))
+    chunk_cmnds = read_commands(chunk_commands_location)
+    assert len(cmnds["cp_commands"]) == len(chunk_cmnds["cp_commands"])
+    assert sorted(os.listdir(os.path.join(location, "loaddata"))) == \
+        ["test-plate-1.csv", "test-plate-2.csv"]
+    assert sorted(os.listdir(os.path.join(location, "filelist"))) == \
+        ["test-plate-1", "test-plate-2"]
+    df_plate = pd.read_csv(os.path.join(location, "loaddata", "test-plate-1.csv"))
+    with open(os.path.join(location, "filelist", "test-plate-1")) as f:
+        plate_filelist = f.read().splitlines()
+    for job_num in range(8):
+        name = "test-plate-1_{}".format(job_num)
+        cp_cmnd = cmnds["cp_commands"][job_num]
+        assert cp_cmnd.endswith("-f {} -l {}".format(job_num * 50 + 1,
+                                                     min((job_num + 1) * 50, 360)))
+        # same imagesets, in the same order, as the chunked layout
+        first, last = [int(i) for i in cp_cmnd.split()[-3::2]]
+        df_job = df_plate.iloc[first-1:last]
+        df_chunk = pd.read_csv(os.path.join(chunk_location, "loaddata", name + ".csv"))
+        assert df_job["FileName_W1"].tolist() == df_chunk["FileName_W1"].tolist()
+        img_location = os.path.join(location, "img_data", name)
+        assert df_job["PathName_W1"].str.startswith(img_location).all()
+        # staging command selects the same images as the chunked filelist
+        first_line, last_line = cmnds["staging"][job_num].split("'")[1][:-1].split(",")
+        with open(os.path.join(chunk_location, "filelist", name)) as f:
+            chunk_filelist = f.read().splitlines()
+        assert plate_filelist[int(first_line)-1:int(last_line)] == chunk_filelist
+    # plate loaddata is still the user's choice with the plate layout
+    location, commands_location = make_job(tmpdir.mkdir("plate_loaddata"),
+                                           layout="plate", plate_loaddata=True)
+    df_sliced = pd.read_csv(os.path.join(location, "loaddata", "test-plate-1.csv"))
+    assert df_sliced["FileName_W1"].tolist() != df_plate["FileName_W1"].tolist()
+    assert sorted(df_sliced["FileName_W1"]) == sorted(df_plate["FileName_W1"])
+
+
+def test_create_commands_streaming(tmpdir):
+    """cptools2.job.Job(streaming=True).create_commands()"""
+    for layout in ["chunk", "plate"]:
+        output = read_outputs(*make_job(tmpdir.mkdir(layout), layout=layout))
+        streamed = read_outputs(*make_job(tmpdir.mkdir(layout + "_streamed"),
+                                          layout=layout, streaming=True))
+        assert streamed == output
+    # plates aren't scanned until the commands are created, and are
+    # released once they've been written
+    jobber = job.Job(is_new_ix=False, streaming=True)
+    jobber.add_plate(["test-plate-1", "test-plate-2"], exp_dir=TEST_PATH)
+    jobber.chunk(job_size=50)
+    assert all(img_files is None for _, img_files in jobber.plate_store.values())
+    location = os.path.join(str(tmpdir), "released")
+    os.makedirs(location)
+    jobber.create_commands(pipeline=PIPELINE, location=location,
+                           commands_location=location, job_size=50)
+    assert all(img_files is None for _, img_files in jobber.plate_store.values())
+    assert jobber.loaddata_store == {} and jobber.chunk_store == {}
+
+
+def test_chunk_max_bytes(tmpdir):
+    """cptools2.job.Job.chunk(max_bytes)"""
+    # copy of an example plate where images in column 2 are larger
+    exp_dir = os.path.join(str(tmpdir), "experiment")
+    plate_dir = os.path.join(TEST_PATH, "test-plate-1")
+    total = 0
+    for root, _, files in os.walk(plate_dir):
+        new_root = os.path.join(exp_dir, os.path.relpath(root, TEST_PATH))
+        os.makedirs(new_root)
+        for name in files:
+            size = 100 if "02_s" in name else 10
+            with open(os.path.join(new_root, name), "wb") as f:
+                f.write(b"0" * size)
+            # thumbnails aren't included in the image list
+            total += 0 if "thumb" in name else size
+    location = os.path.join(str(tmpdir), "location")
+    commands_location = os.path.join(str(tmpdir), "commands")
+    os.makedirs(commands_location)
+    jobber = job.Job(is_new_ix=False)
+    jobber.add_plate("test-plate-1", exp_dir=exp_dir)
+    jobber.chunk(job_size=None, max_bytes=10000)
+    jobber.create_commands(pipeline=PIPELINE, location=location,
+                           commands_location=commands_location, job_size=None)
+    manifest = pd.read_csv(os.path.join(commands_location, "manifest.csv"))
+    cmnds = read_commands(commands_location)
+    assert manifest.shape[0] == len(cmnds["cp_commands"])
+    assert manifest["command"].tolist() == list(range(1, manifest.shape[0] + 1))
+    assert (manifest["bytes"] <= 10000).all()
+    assert manifest["bytes"].sum() == total
+    assert manifest["n_imagesets"].sum() == 360
+    assert (manifest["imageset_start"].iloc[1:].values ==
+            manifest["imageset_stop"].iloc[:-1].values).all()
+    for _, row in manifest.iterrows():
+        df = pd.read_csv(os.path.join(location, "loaddata", row["name"] + ".csv"))
+        assert df.shape[0] == row["n_imagesets"]
+
+
+def test_chunk_pack_tails(tmpdir):
+    """cptools2.job.Job.chunk(pack_tails=True)"""
+    # test-plate-2 from a second experiment directory
+    exp_dir = os.path.join(str(tmpdir), "experiment_2")
+    os.makedirs(exp_dir)
+    os.symlink(os.path.join(TEST_PATH, "test-plate-2"),
+               os.path.join(exp_dir, "test-plate-2"))
+    location = os.path.join(str(tmpdir), "location")
+    commands_location = os.path.join(str(tmpdir), "commands")
+    os.makedirs(commands_location)
+    jobber = job.Job(is_new_ix=False)
+    jobber.add_plate(["test-plate-1", "test-plate-3"], exp_dir=TEST_PATH)
+    jobber.add_plate("test-plate-2", exp_dir=exp_dir)
+    jobber.chunk(job_size=96, pack_tails=True)
+    jobber.create_commands(pipeline=PIPELINE, location=location,
+                           commands_location=commands_location, job_size=96)
+    cmnds = read_commands(commands_location)
+    manifest = pd.read_csv(os.path.join(commands_location, "manifest.csv"))
+    # 360 imagesets per plate: 3 full jobs each, then the 3 * 72 imageset
+    # tails packed into jobs of 96
+    assert manifest["n_imagesets"].tolist() == [96] * 9 + [96, 96, 24]
+    assert manifest["plate"].tolist()[-3:] == [
+        "test-plate-1+test-plate-2", "test-plate-2+test-plate-3", "test-plate-3"]
+    assert len(cmnds["staging"]) == 12
+    # packed job with plates from both experiments has an rsync for each
+    assert cmnds["staging"][9].count("rsync") == 2
+    assert exp_dir in cmnds["staging"][9] and TEST_PATH in cmnds["staging"][9]
+    assert cmnds["staging"][11].count("rsync") == 1
+    df_packed = pd.read_csv(os.path.join(location, "loaddata", "packed_0.csv"))
+    assert df_packed.shape[0] == 96
+    assert df_packed["Metadata_platename"].tolist() == \
+        ["test-plate-1"] * 72 + ["test-plate-2"] * 24
+    img_location = os.path.join(location, "img_data", "packed_0")
+    for plate in ["test-plate-1", "test-plate-2"]:
+        rows = df_packed["Metadata_platename"] == plate
+        assert df_packed.loc[rows, "PathName_W1"].str.startswith(
+            os.path.join(img_location, plate)).all()
+    filelists = sorted(i for i in os.listdir(os.path.join(location, "filelist"))
+                       if i.startswith("packed"))
+    assert filelists == ["packed_0_0", "packed_0_1", "packed_1_0", "packed_1_1",
+                         "packed_2"]
+    # every image is staged exactly once across all the jobs
+    img_lists = []
+    for name in os.listdir(os.path.join(location, "filelist")):
+        with open(os.path.join(location, "filelist", name)) as f:
+            img_lists.extend(f.read().splitlines())
+    assert len(img_lists) == len(set(img_lists)) == 3 * 360 * 5
+
+
+def test_create_commands_order(tmpdir):
+    """cptools2.job.Job.create_commands(order)"""
+    location, commands_location = make_job(tmpdir.mkdir("plate"))
+    output = read_outputs(location, commands_location)
+    for order in ["lpt", "interleave"]:
+        location, commands_location = make_job(tmpdir.mkdir(order), order=order)
+        cmnds = read_outputs(location, commands_location)
+        manifest = pd.read_csv(os.path.join(commands_location, "manifest.csv"))
+        assert (manifest["order"] == order).all()
+        # the same jobs, with each line of the files still the same job
+        names = ["staging", "cp_commands", "destaging"]
+        assert sorted(zip(*[cmnds[i] for i in names])) == \
+            sorted(zip(*[output[i] for i in names]))
+        for name, staging, cp_cmnd in zip(manifest["name"], cmnds["staging"],
+                                          cmnds["cp_commands"]):
+            assert "/{}.csv".format(name) in cp_cmnd
+            assert '/filelist/{}"'.format(name) in staging
+        if order == "lpt":
+            # the two 10 imageset jobs are last
+            assert manifest["n_imagesets"].tolist() == [50] * 14 + [10, 10]
+        else:
+            assert manifest["plate"].tolist() == ["test-plate-1", "test-plate-2"] * 8
+    with pytest.raises(ValueError):
+        make_job(tmpdir.mkdir("bad"), order="random")
+
+
+def test_select_channels(tmpdir):
+    """cptools2.job.Job.select_channels(channels)"""
+    pipeline = os.path.join(str(tmpdir), "pipeline.cppipe")
+    with open(pipeline, "w") as f:
+        f.write("IdentifyPrimaryObjects:[module_num:1|enabled:True]\n"
+                "    Select the input image:W2\n"
+                "MeasureObjectIntensity:[module_num:2|enabled:True]\n"
+                "    Select images to measure:W2, W4\n")
+    for streaming in [False, True]:
+        location = os.path.join(str(tmpdir), "location_{}".format(streaming))
+        commands_location = os.path.join(str(tmpdir), "commands_{}".format(streaming))
+        os.makedirs(commands_location)
+        jobber = job.Job(is_new_ix=False, streaming=streaming)
+        jobber.add_plate(["test-plate-1", "test-plate-2"], exp_dir=TEST_PATH)
+        jobber.select_channels("auto", pipeline=pipeline)
+        assert jobber.channels == [2, 4]
+        jobber.chunk(job_size=50)
+        jobber.create_commands(pipeline=PIPELINE, location=location,
+                               commands_location=commands_location, job_size=50)
+        assert jobber.dropped_images == 2 * 360 * 3
+        manifest = pd.read_csv(os.path.join(commands_location, "manifest.csv"))
+        assert manifest["n_imagesets"].sum() == 2 * 360
+        assert (manifest["n_images"] == 2 * manifest["n_imagesets"]).all()
+        df = pd.read_csv(os.path.join(location, "loaddata", "test-plate-1_0.csv"))
+        assert sorted(i for i in df.columns if i.startswith("FileName")) == \
+            ["FileName_W2", "FileName_W4"]
+        with open(os.path.join(location, "filelist", "test-plate-1_0")) as f:
+            assert len(f.read().splitlines()) == 2 * 50
+        if streaming is False:
+            # can't select channels once the plates are chunked
+            with pytest.raises(ValueError):
+                jobber.select_channels([1])
+
+
+def test_select_imagesets(tmpdir):
+    """cptools2.job.Job.select_imagesets(rows, sites)"""
+    location = os.path.join(str(tmpdir), "location")
+    commands_location = os.path.join(str(tmpdir), "commands")
+    os.makedirs(commands_location)
+    jobber = job.Job(is_new_ix=False)
+    jobber.add_plate(["test-plate-1", "test-plate-2"], exp_dir=TEST_PATH)
+    jobber.select_imagesets(rows=["B"], sites=[1, 2, 3])
+    jobber.select_channels([1])
+    jobber.chunk(job_size=10)
+    jobber.create_commands(pipeline=PIPELINE, location=location,
+                           commands_location=commands_location, job_size=10)
+    # 10 wells in row B with 3 sites each
+    manifest = pd.read_csv(os.path.join(commands_location, "manifest.csv"))
+    assert manifest["n_imagesets"].tolist() == [10, 10, 10] * 2
+    assert manifest["n_images"].sum() == 2 * 30
+    assert jobber.dropped_images == 2 * (360 * 5 - 30)
+    df = pd.read_csv(os.path.join(location, "loaddata", "test-plate-1_0.csv"))
+    assert df["Metadata_well"].str.startswith("B").all()
+    assert sorted(df["Metadata_site"].unique()) == [1, 2, 3]
+    jobber = job.Job(is_new_ix=False)
+    jobber.add_plate("test-plate-1", exp_dir=TEST_PATH)
+    jobber.select_imagesets(wells=["H12"])
+    with pytest.raises(ValueError):
+        jobber.chunk(job_size=10)
+
+
+def test_create_commands_pipelines(tmpdir):
+    """cptools2.job.Job.create_commands(pipeline=[...])"""
+    location = os.path.join(str(tmpdir), "location")
+    commands_location = os.path.join(str(tmpdir), "commands")
+    os.makedirs(commands_location)
+    jobber = job.Job(is_new_ix=False)
+    jobber.add_plate(["test-plate-1", "test-plate-2"], exp_dir=TEST_PATH)
+    jobber.chunk(job_size=96)
+    jobber.create_commands(pipeline=[PIPELINE, PIPELINE], location=location,
+                           commands_location=commands_location, job_size=96)
+    cmnds = read_commands(commands_location)
+    n_chunks = len(cmnds["staging"])
+    assert len(cmnds["destaging"]) == n_chunks == 8
+    assert len(cmnds["cp_commands"]) == 2 * n_chunks
+    # a block of commands for each pipeline, with their own outputs
+    for p, name in enumerate(["example_pipeline", "example_pipeline_2"]):
+        block = cmnds["cp_commands"][p * n_chunks:(p + 1) * n_chunks]
+        for cp_cmnd, staging in zip(block, cmnds["staging"]):
+            chunk = staging.split("/img_data/")[1].split()[0].strip('"/')
+            assert os.path.join(location, "raw_data", name, chunk) in cp_cmnd
+        assert os.path.isdir(os.path.join(location, "raw_data", name))
+    manifest = pd.read_csv(os.path.join(commands_location, "manifest.csv"))
+    assert manifest.shape[0] == 2 * n_chunks
+    assert manifest["pipeline"].tolist() == \
+        ["example_pipeline"] * n_chunks + ["example_pipeline_2"] * n_chunks
+    assert manifest["chunk"].tolist() == list(range(1, n_chunks + 1)) * 2
+    assert manifest["n_imagesets"].sum() == 2 * 2 * 360
+
+
+def test_create_commands_cache(tmpdir):
+    """cptools2.job.Job.create_commands(cache=True)"""
+    location = os.path.join(str(tmpdir), "location")
+    commands_location = os.path.join(str(tmpdir), "commands")
+    os.makedirs(commands_location)
+
+    def create(cache=True):
+        jobber = job.Job(is_new_ix=False)
+        jobber.add_plate(["test-plate-1", "test-plate-2"], exp_dir=TEST_PATH)
+        jobber.chunk(job_size=96)
+        jobber.create_commands(pipeline=PIPELINE, location=location,
+                               commands_location=commands_location,
+                               job_size=96, cache=cache)
+        return jobber
+
+    jobber = create()
+    assert jobber.cache_hits == 0
+    manifest = pd.read_csv(os.path.join(commands_location, "manifest.csv"))
+    markers_loc = os.path.join(commands_location, "result_cache.txt")
+    with open(markers_loc) as f:
+        markers = f.read().splitlines()
+    assert len(markers) == manifest.shape[0] == 8
+    assert markers == [os.path.join(location, "result_cache", key)
+                       for key in manifest["key"]]
+    # the same jobs have the same keys
+    create()
+    assert pd.read_csv(os.path.join(commands_location, "manifest.csv"))[
+        "key"].tolist() == manifest["key"].tolist()
+    # mark every job but the 3rd and the last as analysed
+    for i, marker in enumerate(markers):
+        if i not in (2, 7):
+            open(marker, "w").close()
+    jobber = create()
+    assert jobber.cache_hits == 6
+    cmnds = read_commands(commands_location)
+    assert all(len(i) == 2 for i in cmnds.values())
+    left = pd.read_csv(os.path.join(commands_location, "manifest.csv"))
+    assert left["name"].tolist() == manifest["name"].iloc[[2, 7]].tolist()
+    for name, staging, cp_cmnd in zip(left["name"], cmnds["staging"],
+                                      cmnds["cp_commands"]):
+        assert "/img_data/{}".format(name) in staging
+        assert "/raw_data/{}".format(name) in cp_cmnd
+    # nothing left to run
+    for marker in markers:
+        open(marker, "w").close()
+    assert create().cache_hits == 8
+    assert read_commands(commands_location)["staging"] == []
+    # without the cache the markers no longer line up with the commands
+    create(cache=False)
+    assert not os.path.isfile(markers_loc)
@@ -61,3 +61,28 @@ def test_create_loaddata():
     wide_df_new_paths = loaddata.cast_dataframe(long_df_new_paths)
     assert output_new_paths.equals(wide_df_new_paths)
 
+
+
+def test_cast_dataframe_matches_pivot():
+    """cptools2.loaddata.cast_dataframe reshape gives the same as a pivot table"""
+    long_df = loaddata.create_long_loaddata(IMG_LIST).sample(frac=1, random_state=1)
+    reshaped = loaddata._reshape_dataframe(long_df)
+    pivoted = loaddata._pivot_dataframe(long_df)
+    assert reshaped is not None
+    assert reshaped.columns.tolist() == pivoted.columns.tolist()
+    assert reshaped.to_csv(index=False) == pivoted.to_csv(index=False)
+
+
+def test_cast_dataframe_ragged():
+    """cptools2.loaddata.cast_dataframe falls back to a pivot with missing channels"""
+    long_df = loaddata.create_long_loaddata(IMG_LIST[1:])
+    assert loaddata._reshape_dataframe(long_df) is None
+    wide_df = loaddata.cast_dataframe(long_df)
+    assert wide_df.shape[0] == 60 * 6
+    assert wide_df.isnull().any().any()
+
+
+def test_image_paths():
+    """cptools2.loaddata.image_paths(dataframe)"""
+    df_loaddata = loaddata.create_loaddata(IMG_LIST)
+    assert sorted(loaddata.image_paths(df_loaddata)) == sorted(IMG_LIST)
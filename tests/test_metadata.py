@@ -0,0 +1,69 @@
+import os
+import pytest
+import pandas as pd
+from parserix import parse
+from cptools2 import metadata
+from cptools2 import filelist
+
+CURRENT_PATH = os.path.dirname(__file__)
+TEST_PATH = os.path.join(CURRENT_PATH, "example_dir")
+TEST_PATH_NEW = os.path.join(CURRENT_PATH, "example_dir_new_paths")
+TEST_PATH_PLATE_1 = os.path.join(TEST_PATH, "test-plate-1")
+TEST_PATH_NEW_PLATE_1 = os.path.join(TEST_PATH_NEW, "test-plate-1")
+IMG_LIST = filelist.files_from_plate(TEST_PATH_PLATE_1)
+IMG_LIST_NEW = filelist.files_from_plate(TEST_PATH_NEW_PLATE_1, is_new_ix=True)
+
+
+def parse_with_parserix(img_list, old_path):
+    """parse an image list one path at a time with parserix"""
+    filenames = [parse.img_filename(i) for i in img_list]
+    return pd.DataFrame({
+        "img_paths": img_list,
+        "URL": filenames,
+        "path": [parse.path(i) for i in img_list],
+        "Metadata_platename": [parse.plate_name(i, old_path=old_path) for i in img_list],
+        "Metadata_well": [parse.img_well(i) for i in filenames],
+        "Metadata_site": [parse.img_site(i) for i in filenames],
+        "Metadata_channel": [parse.img_channel(i) for i in filenames],
+        "Metadata_platenum": [parse.plate_num(i, old_path=old_path) for i in img_list]
+        })
+
+
+def test_parse_img_list():
+    """cptools2.metadata.parse_img_list(img_list) matches parserix"""
+    output = metadata.parse_img_list(IMG_LIST)
+    expected = parse_with_parserix(IMG_LIST, old_path=True)
+    assert output.columns.tolist() == metadata.COLUMNS
+    for col in metadata.COLUMNS:
+        assert output[col].astype(str).tolist() == expected[col].astype(str).tolist()
+
+
+def test_parse_img_list_new_ix():
+    """cptools2.metadata.parse_img_list(img_list, is_new_ix=True) matches parserix"""
+    output = metadata.parse_img_list(IMG_LIST_NEW, is_new_ix=True)
+    expected = parse_with_parserix(IMG_LIST_NEW, old_path=False)
+    for col in metadata.COLUMNS:
+        assert output[col].astype(str).tolist() == expected[col].astype(str).tolist()
+
+
+def test_parse_img_list_bad_path():
+    """cptools2.metadata.parse_img_list raises on unparseable paths"""
+    with pytest.raises(metadata.MetadataError):
+        metadata.parse_img_list(IMG_LIST + ["plate/2015/4016/not_an_image.tif"])
+
+
+def test_parse_filenames():
+    """cptools2.metadata.parse_filenames(img_list)"""
+    for img_list in [IMG_LIST, IMG_LIST_NEW]:
+        output = metadata.parse_filenames(img_list)
+        expected = parse_with_parserix(img_list, old_path=True)
+        assert output.columns.tolist() == metadata.FILENAME_COLUMNS
+        for col in metadata.FILENAME_COLUMNS:
+            assert output[col].astype(str).tolist() == expected[col].astype(str).tolist()
+    # bare filenames don't need a directory structure
+    output = metadata.parse_filenames(["val screen_B02_s1_w1.tif"])
+    assert output.loc[0, "Metadata_well"] == "B02"
+    assert output.loc[0, "Metadata_site"] == 1
+    assert output.loc[0, "Metadata_channel"] == 1
+    with pytest.raises(metadata.MetadataError):
+        metadata.parse_filenames(["not_an_image.tif"])
@@ -0,0 +1,139 @@
+import os
+import pandas as pd
+import pytest
+from cptools2 import generate_scripts
+from cptools2 import metrics
+
+CURRENT_PATH = os.path.dirname(__file__)
+PIPELINE = os.path.join(CURRENT_PATH, "example_pipeline.cppipe")
+
+RSYNC_OUTPUT = """
+Number of files: 3 (reg: 2, dir: 1)
+Number of regular files transferred: 2
+Total file size: 3,000 bytes
+Total transferred file size: 2,000 bytes
+"""
+
+
+def write_metrics(logfile_location, job="job"):
+    """records of 4 chunks, the last of which failed its analysis"""
+    for phase in metrics.PHASES:
+        os.makedirs(os.path.join(logfile_location, phase))
+    for i in range(1, 5):
+        metrics.write_record(
+            os.path.join(logfile_location, "staging", job),
+            {"phase": "staging", "job": "1", "command": i, "start": 10 * i,
+             "end": 10 * i + 5, "duration": 5, "status": 0, "files": 10,
+             "bytes": 2000000})
+        metrics.write_record(
+            os.path.join(logfile_location, "analysis", job),
+            {"phase": "analysis", "job": "1", "command": i, "chunk": i,
+             "start": 10 * i + 5, "end": 10 * i + 5 + 10 * i,
+             "duration": 10 * i, "max_rss": 1000, "status": int(i == 4)})
+    with open(os.path.join(logfile_location, "analysis", job, "5.json"), "w") as f:
+        # a record which isn't complete
+        f.write('{"phase": "analysis", "job": "1", "com')
+
+
+def test_rsync_stats():
+    """cptools2.metrics.rsync_stats(text)"""
+    assert metrics.rsync_stats(RSYNC_OUTPUT) == (2, 2000)
+    older = "Number of files transferred: 1\nTotal transferred file size: 5 bytes\n"
+    assert metrics.rsync_stats(RSYNC_OUTPUT + older) == (3, 2005)
+    assert metrics.rsync_stats("sending incremental file list\n") == (None, None)
+
+
+def test_read_metrics(tmpdir):
+    """cptools2.metrics.read_metrics(logfile_location, job)"""
+    logfile_location = str(tmpdir)
+    write_metrics(logfile_location)
+    assert metrics.latest_job(logfile_location) == "job"
+    output = metrics.read_metrics(logfile_location, "job")
+    assert len(output) == 8
+    assert output["phase"].tolist() == ["staging"] * 4 + ["analysis"] * 4
+    # a command run again replaces its record
+    metrics.write_record(os.path.join(logfile_location, "analysis", "job"),
+                         {"phase": "analysis", "job": "2", "command": 4,
+                          "start": 100, "end": 110, "duration": 10, "status": 0})
+    output = metrics.read_metrics(logfile_location, "job")
+    assert len(output) == 8
+    assert output["status"].tolist() == [0] * 8
+    with pytest.raises(metrics.MetricsError):
+        metrics.read_metrics(logfile_location, "other_job")
+    with pytest.raises(metrics.MetricsError):
+        metrics.latest_job(str(tmpdir.mkdir("empty")))
+
+
+def test_summarise(tmpdir):
+    """cptools2.metrics.summarise(metrics, manifest)"""
+    logfile_location = str(tmpdir)
+    write_metrics(logfile_location)
+    output = metrics.read_metrics(logfile_location, "job")
+    manifest = pd.DataFrame({"command": [1, 2, 3, 4],
+                             "name": ["chunk_{}".format(i) for i in range(4)],
+                             "n_images": [20, 20, 20, 20],
+                             "bytes": [4e6, 4e6, 4e6, 4e6]})
+    summary = metrics.summarise(output, manifest)
+    assert summary.index.tolist() == ["staging", "analysis"]
+    assert summary.loc["staging", "span"] == 35
+    assert summary.loc["staging", "images/s"] == pytest.approx(40 / 35.0)
+    assert summary.loc["staging", "MB/s"] == pytest.approx(8 / 35.0)
+    assert summary.loc["analysis", "failed"] == 1
+    # the 3 finished analyses over 15 to 85 seconds
+    assert summary.loc["analysis", "images/s"] == pytest.approx(60 / 70.0)
+    assert summary.loc["analysis", "median"] == 20
+    assert summary.loc["analysis", "max"] == 30
+    assert pd.isnull(metrics.summarise(output).loc["analysis", "images/s"])
+    slowest = metrics.slowest(output, manifest, n=2)
+    assert slowest["name"].tolist() == ["chunk_3", "chunk_2"]
+
+
+def write_run(tmpdir):
+    """config, manifest and metrics of a run of 4 chunks and a rerun of the last"""
+    location = str(tmpdir.mkdir("location"))
+    commands_location = str(tmpdir.mkdir("commands"))
+    rerun_location = os.path.join(commands_location, "rerun_date")
+    os.makedirs(rerun_location)
+    pd.DataFrame({"command": [1, 2, 3, 4],
+                  "name": ["chunk_{}".format(i) for i in range(4)],
+                  "n_images": [20, 20, 20, 20]}).to_csv(
+        os.path.join(commands_location, "manifest.csv"), index=False)
+    pd.DataFrame({"command": [1], "name": ["chunk_3"], "n_images": [10]}).to_csv(
+        os.path.join(rerun_location, "manifest.csv"), index=False)
+    generate_scripts.record_job(commands_location, "job")
+    generate_scripts.record_job(rerun_location, "rerun_job")
+    logfile_location = os.path.join(location, "logfiles")
+    write_metrics(logfile_location)
+    # the rerun's command 1 is chunk_3, and its records are the latest
+    metrics.write_record(
+        os.path.join(logfile_location, "analysis", "rerun_job"),
+        {"phase": "analysis", "job": "2", "command": 1, "start": 200,
+         "end": 250, "duration": 50, "status": 0})
+    config = os.path.join(str(tmpdir), "config.yml")
+    with open(config, "w") as f:
+        f.write("pipeline : {}\nlocation : {}\ncommands location : {}\n"
+                "chunk : 10\n".format(PIPELINE, location, commands_location))
+    return config, commands_location, rerun_location
+
+
+def test_job_commands(tmpdir):
+    """cptools2.metrics.job_commands(commands_location, job)"""
+    _, commands_location, rerun_location = write_run(tmpdir)
+    assert metrics.job_commands(commands_location, "job") == commands_location
+    assert metrics.job_commands(commands_location, "rerun_job") == rerun_location
+    assert metrics.job_commands(commands_location, "other_job") is None
+
+
+def test_main(tmpdir):
+    """cptools2.metrics.main(argv)"""
+    config, commands_location, _ = write_run(tmpdir)
+    # the latest job is the rerun, joined with the rerun's manifest
+    summary = metrics.main([config])
+    assert summary.loc["analysis", "tasks"] == 1
+    assert summary.loc["analysis", "images/s"] == pytest.approx(10 / 50.0)
+    summary = metrics.main([config, "--job", "job"])
+    assert summary.loc["analysis", "images/s"] == pytest.approx(60 / 70.0)
+    # without a record of the job its chunks aren't known
+    os.remove(os.path.join(commands_location, "rerun_date",
+                           generate_scripts.JOBS_NAME))
+    assert pd.isnull(metrics.main([config]).loc["analysis", "images/s"])
@@ -71,3 +71,146 @@ def test_new_ix():
     assert parse_yaml.parse_config_file(TEST_PATH).is_new_ix == False
     assert parse_yaml.parse_config_file(TEST_PATH2).is_new_ix == True
 
+
+def test_scan_workers():
+    """cptools2.parse_yaml.scan_workers(yaml_dict)"""
+    yaml_dict_1 = parse_yaml.open_yaml(TEST_PATH)
+    yaml_dict_2 = parse_yaml.open_yaml(TEST_PATH2)
+    assert parse_yaml.scan_workers(yaml_dict_1) is None
+    assert parse_yaml.scan_workers(yaml_dict_2) == 4
+
+
+def test_index_location():
+    """cptools2.parse_yaml.index_location(yaml_dict)"""
+    yaml_dict = parse_yaml.open_yaml(TEST_PATH)
+    assert parse_yaml.index_location(yaml_dict) == "/example/location/plate_index"
+    yaml_dict["plate index"] = False
+    assert parse_yaml.index_location(yaml_dict) is None
+
+
+def test_streaming():
+    """cptools2.parse_yaml.streaming(yaml_dict)"""
+    yaml_dict = parse_yaml.open_yaml(TEST_PATH)
+    assert parse_yaml.streaming(yaml_dict) is False
+    yaml_dict["streaming"] = True
+    assert parse_yaml.streaming(yaml_dict) is True
+    assert parse_yaml.parse_config_file(TEST_PATH).streaming is False
+
+
+def test_tasks_per_job():
+    """cptools2.parse_yaml.tasks_per_job(yaml_dict)"""
+    yaml_dict = parse_yaml.open_yaml(TEST_PATH)
+    assert parse_yaml.tasks_per_job(yaml_dict) == 1
+    yaml_dict["tasks per job"] = 4
+    assert parse_yaml.tasks_per_job(yaml_dict) == 4
+    yaml_dict["tasks per job"] = 0
+    with pytest.raises(ValueError):
+        parse_yaml.tasks_per_job(yaml_dict)
+
+
+def test_scheduler():
+    """cptools2.parse_yaml.scheduler(yaml_dict)"""
+    yaml_dict = parse_yaml.open_yaml(TEST_PATH)
+    assert parse_yaml.scheduler(yaml_dict) == {"name": "sge"}
+    yaml_dict["scheduler"] = "Local"
+    yaml_dict["local workers"] = {"analysis": 16}
+    assert parse_yaml.scheduler(yaml_dict) == {"name": "local",
+                                               "n_workers": {"analysis": 16}}
+    yaml_dict["local workers"] = 4
+    assert parse_yaml.scheduler(yaml_dict)["n_workers"] == 4
+
+
+def test_chunk_bytes():
+    """cptools2.parse_yaml.chunk(yaml_dict) with chunk bytes"""
+    yaml_dict = parse_yaml.open_yaml(TEST_PATH)
+    yaml_dict["chunk bytes"] = "2G"
+    assert parse_yaml.chunk(yaml_dict) == {"job_size": 46, "max_bytes": 2 * 1024**3}
+    yaml_dict.pop("chunk")
+    assert parse_yaml.chunk(yaml_dict) == {"job_size": None, "max_bytes": 2 * 1024**3}
+
+
+def test_pack_tails():
+    """cptools2.parse_yaml.chunk(yaml_dict) with pack tails"""
+    yaml_dict = parse_yaml.open_yaml(TEST_PATH)
+    yaml_dict["pack tails"] = True
+    assert parse_yaml.chunk(yaml_dict) == {"job_size": 46, "pack_tails": True}
+
+
+def test_analysis_memory():
+    """cptools2.parse_yaml.analysis_memory(yaml_dict)"""
+    yaml_dict = parse_yaml.open_yaml(TEST_PATH)
+    assert parse_yaml.analysis_memory(yaml_dict) == "12G"
+    yaml_dict["analysis memory"] = "4g"
+    assert parse_yaml.analysis_memory(yaml_dict) == "4G"
+    yaml_dict["analysis memory"] = "lots"
+    with pytest.raises(ValueError):
+        parse_yaml.analysis_memory(yaml_dict)
+
+
+def test_order():
+    """cptools2.parse_yaml.create_commands(yaml_dict) with order"""
+    yaml_dict = parse_yaml.open_yaml(TEST_PATH)
+    assert "order" not in parse_yaml.create_commands(yaml_dict)
+    yaml_dict["order"] = "LPT"
+    assert parse_yaml.create_commands(yaml_dict)["order"] == "lpt"
+
+
+def test_result_cache():
+    """cptools2.parse_yaml.create_commands(yaml_dict) with result cache"""
+    yaml_dict = parse_yaml.open_yaml(TEST_PATH)
+    assert "cache" not in parse_yaml.create_commands(yaml_dict)
+    yaml_dict["result cache"] = True
+    assert parse_yaml.create_commands(yaml_dict)["cache"] is True
+    parse_yaml.check_yaml_args(yaml_dict)
+
+
+def test_pipelines():
+    """cptools2.parse_yaml.pipelines(yaml_dict)"""
+    yaml_dict = parse_yaml.open_yaml(TEST_PATH)
+    pipeline_loc = os.path.abspath("./tests/example_pipeline.cppipe")
+    assert parse_yaml.pipelines(yaml_dict) == pipeline_loc
+    yaml_dict["pipeline"] = ["./tests/example_pipeline.cppipe"] * 2
+    assert parse_yaml.pipelines(yaml_dict) == [pipeline_loc] * 2
+    assert parse_yaml.create_commands(yaml_dict)["pipeline"] == [pipeline_loc] * 2
+    yaml_dict["pipeline"].append("./tests/missing.cppipe")
+    with pytest.raises(IOError):
+        parse_yaml.create_commands(yaml_dict)
+
+
+def test_channels():
+    """cptools2.parse_yaml.channels(yaml_dict)"""
+    yaml_dict = parse_yaml.open_yaml(TEST_PATH)
+    assert parse_yaml.channels(yaml_dict) is None
+    yaml_dict["channels"] = [1, "W3"]
+    assert parse_yaml.channels(yaml_dict) == {"channels": [1, 3]}
+    yaml_dict["channels"] = "auto"
+    output = parse_yaml.channels(yaml_dict)
+    assert output["channels"] == "auto"
+    assert output["pipeline"] == os.path.abspath("./tests/example_pipeline.cppipe")
+
+
+def test_subset():
+    """cptools2.parse_yaml.subset(yaml_dict)"""
+    yaml_dict = parse_yaml.open_yaml(TEST_PATH)
+    assert parse_yaml.subset(yaml_dict) is None
+    yaml_dict["subset"] = {"wells": ["b02", "C03"], "rows": "B-D",
+                           "columns": [2, "5-7"], "sites": 1}
+    assert parse_yaml.subset(yaml_dict) == {"wells": ["B02", "C03"],
+                                            "rows": ["B", "C", "D"],
+                                            "columns": [2, 5, 6, 7],
+                                            "sites": [1]}
+    yaml_dict["subset"] = [{"timepoints": "1-2"}]
+    assert parse_yaml.subset(yaml_dict) == {"timepoints": [1, 2]}
+    yaml_dict["subset"] = {"plates": ["plate_1"]}
+    with pytest.raises(ValueError):
+        parse_yaml.subset(yaml_dict)
+    # the rows of a 1536 well plate go past Z
+    yaml_dict["subset"] = {"rows": ["Y-AB", "af"]}
+    assert parse_yaml.subset(yaml_dict) == {"rows": ["Y", "Z", "AA", "AB", "AF"]}
+    yaml_dict["subset"] = {"rows": "A-AF"}
+    assert len(parse_yaml.subset(yaml_dict)["rows"]) == 32
+    for bad in [{"sites": "all"}, {"columns": "2-"}, {"rows": "B-3"}]:
+        yaml_dict["subset"] = bad
+        with pytest.raises(ValueError) as err:
+            parse_yaml.subset(yaml_dict)
+        assert list(bad)[0] in str(err.value)
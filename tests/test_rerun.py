@@ -0,0 +1,132 @@
+import os
+import pandas as pd
+import pytest
+from cptools2 import commands
+from cptools2 import generate_scripts
+from cptools2 import rerun
+from cptools2 import tune
+
+CURRENT_PATH = os.path.dirname(__file__)
+PIPELINE = os.path.join(CURRENT_PATH, "example_pipeline.cppipe")
+N_CHUNKS = 4
+
+
+def make_run(tmpdir, n_pipelines=1):
+    """commands, manifest and loaddata of N_CHUNKS chunks of 10 imagesets"""
+    location = str(tmpdir.mkdir("location"))
+    commands_location = str(tmpdir.mkdir("commands"))
+    os.makedirs(os.path.join(location, "loaddata"))
+    staging, cp_commands, destaging, manifest = [], [], [], []
+    for chunk in range(N_CHUNKS):
+        name = "plate_{}".format(chunk)
+        pd.DataFrame({"FileName_W1": range(10)}).to_csv(
+            os.path.join(location, "loaddata", name + ".csv"), index=False)
+        staging.append("rsync {}".format(name))
+        destaging.append("rm -rf {}".format(name))
+    for p in range(n_pipelines):
+        for chunk in range(N_CHUNKS):
+            name = "plate_{}".format(chunk)
+            cp_commands.append(commands.make_cp_cmnd(
+                name=name, pipeline=PIPELINE, location=location,
+                output_loc=os.path.join(location, "raw_data", str(p), name)))
+            manifest.append({"plate": "plate", "name": name,
+                             "imageset_start": 10 * chunk,
+                             "imageset_stop": 10 * chunk + 10,
+                             "n_imagesets": 10, "n_images": 20, "bytes": 100,
+                             "order": "plate", "pipeline": str(p),
+                             "chunk": chunk + 1})
+    commands.write_commands(commands_location, staging, cp_commands, destaging)
+    commands.write_manifest(commands_location, manifest)
+    return location, commands_location
+
+
+def test_unfinished(tmpdir):
+    """cptools2.rerun.unfinished(log_file, n_commands)"""
+    log_file = os.path.join(str(tmpdir), "job.log")
+    with open(log_file, "w") as f:
+        f.write("2020-01-01 12:00  1  1  Finished  10  100\n"
+                "2020-01-01 12:00  1  2  Failed with error code: 1  10  100\n"
+                "2020-01-01 12:00  1  3  Failed with error code: 1  10  100\n"
+                "2020-01-01 12:00  1  5  Finished\n"
+                # the 3rd was rerun successfully
+                "2020-01-01 13:00  2  3  Finished  10  100\n")
+    assert rerun.unfinished(log_file, 6) == ([2], [4, 6])
+
+
+def test_chunks_to_rerun():
+    """cptools2.rerun.chunks_to_rerun(lines, n_chunks)"""
+    assert rerun.chunks_to_rerun([2, 4], 4) == [1, 3]
+    # the same chunk with a second pipeline
+    assert rerun.chunks_to_rerun([2, 6, 7], 4) == [1, 2]
+
+
+def test_split_ranges():
+    """cptools2.rerun.split_ranges(first, last, n_parts)"""
+    assert rerun.split_ranges(1, 10, 2) == [(1, 5), (6, 10)]
+    assert rerun.split_ranges(11, 20, 3) == [(11, 13), (14, 16), (17, 20)]
+    assert rerun.split_ranges(1, 3, 3) == [(1, 1), (2, 2), (3, 3)]
+
+
+def test_rerun_commands(tmpdir):
+    """cptools2.rerun.rerun_commands(cmnds, chunks, manifest, split)"""
+    location, commands_location = make_run(tmpdir, n_pipelines=2)
+    cmnds = rerun.read_commands(commands_location)
+    manifest = pd.read_csv(os.path.join(commands_location, "manifest.csv")).to_dict("records")
+    output = rerun.rerun_commands(cmnds, [1, 3], manifest=manifest)
+    assert output["staging"] == ["rsync plate_1", "rsync plate_3"]
+    assert output["destaging"] == ["rm -rf plate_1", "rm -rf plate_3"]
+    # still a block of lines for each pipeline
+    assert output["cp_commands"] == [cmnds["cp_commands"][i] for i in [1, 3, 5, 7]]
+    assert [row["chunk"] for row in output["manifest"]] == [1, 2, 1, 2]
+    assert output["manifest"][0]["imageset_start"] == 10
+    # split into parts of the LoadData's image sets
+    output = rerun.rerun_commands(cmnds, [1, 3], manifest=manifest, split=2)
+    assert len(output["staging"]) == 2 and len(output["cp_commands"]) == 8
+    first = commands.parse_cp_command(output["cp_commands"][0])
+    second = commands.parse_cp_command(output["cp_commands"][2])
+    assert first["image_sets"] == (1, 5) and second["image_sets"] == (6, 10)
+    assert first["output_location"].endswith("plate_1_part1")
+    assert second["output_location"].endswith("plate_1_part2")
+    assert [row["n_imagesets"] for row in output["manifest"]] == [5] * 8
+    assert output["manifest"][2]["imageset_start"] == 15
+    # can't split into more parts than there are image sets
+    assert rerun.rerun_commands(cmnds, [1], split=100)["split"] == 10
+
+
+def test_main(tmpdir):
+    """cptools2.rerun.main(argv)"""
+    location, commands_location = make_run(tmpdir)
+    os.makedirs(os.path.join(location, "logfiles"))
+    with open(os.path.join(location, "logfiles", "job.log"), "w") as f:
+        f.write("2020-01-01 12:00  1  1  Finished  10  100\n"
+                "2020-01-01 12:00  1  2  Failed with error code: 1  10  100\n")
+    config = os.path.join(str(tmpdir), "config.yml")
+    with open(config, "w") as f:
+        f.write("pipeline : {}\nlocation : {}\ncommands location : {}\n"
+                "chunk : 10\nscheduler : slurm\n".format(
+                    PIPELINE, location, commands_location))
+    generate_scripts.record_job(commands_location, "job")
+    rerun_location = rerun.main([config, "--memory", "24g"])
+    assert os.path.dirname(rerun_location) == commands_location
+    cmnds = rerun.read_commands(rerun_location)
+    assert cmnds["staging"] == ["rsync plate_1", "rsync plate_2", "rsync plate_3"]
+    manifest = pd.read_csv(os.path.join(rerun_location, "manifest.csv"))
+    assert manifest["name"].tolist() == ["plate_1", "plate_2", "plate_3"]
+    analysis = [i for i in os.listdir(rerun_location)
+                if i.endswith("analysis_script.sh")][0]
+    with open(os.path.join(rerun_location, analysis)) as f:
+        assert "#SBATCH --mem=24G\n" in f.read()
+    with pytest.raises(rerun.RerunError):
+        rerun.main([config, "--commands", str(tmpdir.mkdir("empty"))])
+    # the rerun's own log, the latest, isn't taken for the original commands'
+    rerun_job = generate_scripts.recorded_jobs(rerun_location)[-1]
+    with open(os.path.join(location, "logfiles", rerun_job + ".log"), "w") as f:
+        f.write("2020-01-01 13:00  2  1  Finished  10  100\n")
+    assert tune.commands_log(commands_location, os.path.join(location, "logfiles")) == \
+        os.path.join(location, "logfiles", "job.log")
+    second = rerun.main([config])
+    assert rerun.read_commands(second)["staging"] == cmnds["staging"]
+    # and without a record of the jobs, a log of too few commands is refused
+    os.remove(os.path.join(commands_location, generate_scripts.JOBS_NAME))
+    with pytest.raises(rerun.RerunError):
+        rerun.main([config])
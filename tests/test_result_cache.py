@@ -0,0 +1,39 @@
+import os
+import pandas as pd
+from cptools2 import result_cache
+
+
+def test_inputs_digest():
+    """cptools2.result_cache.inputs_digest(img_list, dataframe)"""
+    img_list = ["plate/A01_s1_w1.tif", "plate/A01_s1_w2.tif"]
+    dataframe = pd.DataFrame({"FileName_W1": ["A01_s1_w1.tif"],
+                              "FileName_W2": ["A01_s1_w2.tif"]})
+    digest = result_cache.inputs_digest(img_list, dataframe)
+    assert digest == result_cache.inputs_digest(list(img_list), dataframe.copy())
+    # any change to the images or the LoadData changes the digest
+    assert digest != result_cache.inputs_digest(img_list[:1], dataframe)
+    assert digest != result_cache.inputs_digest(
+        img_list, dataframe.rename(columns={"FileName_W2": "FileName_W3"}))
+
+
+def test_cache_key(tmpdir):
+    """cptools2.result_cache.cache_key(pipeline_hash, inputs_hash)"""
+    pipeline = os.path.join(str(tmpdir), "pipeline.cppipe")
+    with open(pipeline, "w") as f:
+        f.write("CellProfiler Pipeline\n")
+    digest = result_cache.pipeline_digest(pipeline)
+    key = result_cache.cache_key(digest, "inputs")
+    assert key == result_cache.cache_key(digest, "inputs")
+    assert key != result_cache.cache_key(digest, "other inputs")
+    with open(pipeline, "a") as f:
+        f.write("changed\n")
+    assert result_cache.pipeline_digest(pipeline) != digest
+
+
+def test_record_success(tmpdir):
+    """cptools2.result_cache.record_success(marker)"""
+    location = str(tmpdir)
+    os.makedirs(os.path.join(location, result_cache.CACHE_DIR))
+    assert result_cache.is_cached(location, "key") is False
+    result_cache.record_success(result_cache.marker_path(location, "key"))
+    assert result_cache.is_cached(location, "key") is True
@@ -0,0 +1,92 @@
+import pandas as pd
+import pytest
+from cptools2 import simulate
+
+
+def make_costs(n_jobs=4):
+    """jobs of 1000 bytes taking 10s to stage, 20s to analyse and 5s to destage"""
+    manifest = pd.DataFrame({"n_imagesets": [10] * n_jobs,
+                             "n_images": [50] * n_jobs,
+                             "bytes": [1000] * n_jobs})
+    return simulate.chunk_costs(manifest, bandwidth=100, per_imageset=1.5,
+                                analysis_overhead=5, destage_seconds=5)
+
+
+def test_chunk_costs():
+    """cptools2.simulate.chunk_costs(manifest, bandwidth, per_imageset)"""
+    costs = make_costs()
+    assert costs["staging"].tolist() == [10] * 4
+    assert costs["analysis"].tolist() == [20] * 4
+    assert costs["destaging"].tolist() == [5] * 4
+    # job sizes missing from the manifest
+    manifest = pd.DataFrame({"n_imagesets": [10, 10], "n_images": [50, 20],
+                             "bytes": [None, 1000]})
+    with pytest.raises(simulate.SimulateError):
+        simulate.chunk_costs(manifest, bandwidth=100, per_imageset=1)
+    costs = simulate.chunk_costs(manifest, bandwidth=100, per_imageset=1,
+                                 image_bytes=100)
+    assert costs["bytes"].tolist() == [5000, 1000]
+
+
+def test_run_slots():
+    """cptools2.simulate.run_slots(ready, durations, slots)"""
+    assert simulate.run_slots([0] * 5, [1] * 5, slots=2) == [0, 0, 1, 1, 2]
+    assert simulate.run_slots([0] * 5, [1] * 5) == [0] * 5
+    # the task that was ready first gets the next free slot
+    assert simulate.run_slots([0, 3, 1], [5, 1, 1], slots=1) == [0, 6, 5]
+
+
+def test_peak_usage():
+    """cptools2.simulate.peak_usage(intervals)"""
+    assert simulate.peak_usage([(0, 2, 5), (1, 3, 5), (2, 4, 5)]) == 10
+    assert simulate.peak_usage([]) == 0
+
+
+def test_simulate():
+    """cptools2.simulate.simulate(costs, slots)"""
+    slots = {"staging": 1, "analysis": 1, "destaging": None}
+    result = simulate.simulate(make_costs(), slots=slots)
+    # analysis is the bottleneck after the first job is staged
+    assert result["makespan"] == 10 + 4 * 20 + 5
+    # every job is on scratch just after the last starts staging
+    assert result["peak_scratch"] == 4000
+    assert result["phases"]["analysis"]["utilisation"] == pytest.approx(80 / 95.)
+    assert result["phases"]["destaging"]["slots"] == 1
+    # each task stages all its jobs before any are analysed
+    result = simulate.simulate(make_costs(), tasks_per_job=2, slots=slots)
+    assert result["n_tasks"] == 2
+    assert result["makespan"] == 20 + 40 + 40 + 10
+
+
+def test_simulate_pipelined():
+    """cptools2.simulate.simulate(costs, prefetch)"""
+    slots = {"analysis": 1}
+    result = simulate.simulate(make_costs(), tasks_per_job=4, slots=slots,
+                               prefetch=1)
+    # staging overlaps with the analysis of the previous job
+    assert result["makespan"] == 10 + 4 * 20 + 5
+    assert result["peak_scratch"] == 3000
+    result = simulate.simulate(make_costs(), tasks_per_job=4, slots=slots,
+                               prefetch=0)
+    assert result["makespan"] == 4 * (10 + 20) + 5
+    assert result["peak_scratch"] == 2000
+
+
+def test_simulate_pipelines():
+    """cptools2.simulate.simulate(costs) with more than one pipeline"""
+    manifest = pd.DataFrame({"n_imagesets": [10] * 8, "n_images": [50] * 8,
+                             "bytes": [1000] * 8,
+                             "chunk": [1, 2, 3, 4] * 2})
+    costs = simulate.chunk_costs(manifest, bandwidth=100, per_imageset=1.5,
+                                 analysis_overhead=5, destage_seconds=5)
+    slots = {"staging": 1, "analysis": 2, "destaging": None}
+    result = simulate.simulate(costs, slots=slots)
+    # each job is staged once, then analysed by both pipelines at once
+    assert result["makespan"] == 10 + 4 * 20 + 5
+    assert result["phases"]["staging"]["busy"] == 40
+    assert result["phases"]["analysis"]["busy"] == 160
+    assert result["peak_scratch"] == 4000
+    # in a pipelined task the pipelines run one after the other
+    result = simulate.simulate(costs, tasks_per_job=4, slots={"analysis": 1},
+                               prefetch=1)
+    assert result["makespan"] == 10 + 4 * 40 + 5
@@ -15,13 +15,23 @@ def test_well_site_table():
     output = splitter._well_site_table(IMG_LIST)
     assert isinstance(output, pd.DataFrame)
     # check the dataframe is the right size
-    # should have a row per image in image list and 3 columns
-    assert output.shape == (len(IMG_LIST), 3)
+    # should have a row per image in image list and 4 columns
+    assert output.shape == (len(IMG_LIST), 4)
     # need to short as for some unknown reason the order is being mixed up
     # though doesn't matter as always use column names rather than index
     assert sorted(output.columns.tolist()) == sorted(["img_paths",
                                                       "Metadata_well",
-                                                      "Metadata_site"])
+                                                      "Metadata_site",
+                                                      "Metadata_channel"])
+    # only the filename is parsed, so bare filenames and new_ix paths work
+    output = splitter._well_site_table(["val screen_B02_s1_w1.tif",
+                                        "val screen_B02_s1_w2.tif"])
+    assert output["Metadata_well"].tolist() == ["B02", "B02"]
+    assert output["Metadata_channel"].tolist() == [1, 2]
+    new_ix = filelist.files_from_plate(
+        os.path.join(CURRENT_PATH, "example_dir_new_paths", "test-plate-1"),
+        is_new_ix=True)
+    assert len(splitter._well_site_table(new_ix)) == len(new_ix)
 
 
 def test_group_images():
@@ -68,3 +78,13 @@ def test_split():
     assert len(output[0]) == job_size
     for job in output[:-1]:
         assert len(job) == job_size
+
+
+def test_group_images_matches_groupby():
+    """_group_images gives the same groups as a pandas groupby on shuffled images"""
+    df_img = splitter._well_site_table(IMG_LIST).sample(frac=1, random_state=42)
+    expected = []
+    for _, group in df_img.groupby(["Metadata_well", "Metadata_site"]):
+        sort_im = group.sort_values("Metadata_channel", kind="mergesort")
+        expected.append(list(sort_im["img_paths"]))
+    assert splitter._group_images(df_img) == expected
@@ -0,0 +1,163 @@
+import os
+import time
+import pytest
+from cptools2 import commands
+from cptools2 import generate_scripts
+from cptools2 import tune
+
+PIPELINE = os.path.join(os.path.dirname(__file__), "example_pipeline.cppipe")
+
+# two plates of 360 imagesets run in chunks of 96 and 48, each analysis
+# taking 30s plus 2s per imageset and 1G plus 10M per imageset
+CHUNKS = [96, 96, 96, 72, 48, 48, 48, 48, 48, 48, 48, 24]
+
+
+def make_run(tmpdir):
+    """write a manifest and log file for the runs in CHUNKS"""
+    manifest = []
+    log_lines = []
+    for i, n_imagesets in enumerate(CHUNKS):
+        command = i + 1
+        manifest.append({"plate": "plate_1" if i < 4 else "plate_2",
+                         "name": "chunk_{}".format(i),
+                         "imageset_start": 0, "imageset_stop": n_imagesets,
+                         "n_imagesets": n_imagesets, "n_images": 5 * n_imagesets,
+                         "bytes": None})
+        wall_time = 30 + 2 * n_imagesets
+        max_rss = 1024**2 + 10 * 1024 * n_imagesets
+        status = "Failed with error code: 1" if command == 12 else "Finished"
+        log_lines.append("2020-01-01 12:00  1234  {}  {}  {}  {}".format(
+            command, status, wall_time, max_rss))
+    # line from before wall times were recorded, and a rerun command
+    log_lines.insert(0, "2019-01-01 12:00  1  1  Finished")
+    log_lines.append("2020-01-01 13:00  1235  5  Finished  126  NA")
+    commands.write_manifest(str(tmpdir), manifest)
+    log_file = os.path.join(str(tmpdir), "job.log")
+    with open(log_file, "w") as f:
+        f.write("\n".join(log_lines) + "\n")
+    return log_file
+
+
+def test_read_log(tmpdir):
+    """cptools2.tune.read_log(log_file)"""
+    log = tune.read_log(make_run(tmpdir))
+    assert log.shape[0] == len(CHUNKS)
+    assert sorted(log["command"]) == list(range(1, len(CHUNKS) + 1))
+    rerun = log[log["command"] == 5].iloc[0]
+    assert rerun["wall_time"] == 126 and rerun["max_rss"] != rerun["max_rss"]
+
+
+def test_read_runs(tmpdir):
+    """cptools2.tune.read_runs(log_file, commands_location)"""
+    runs = tune.read_runs(make_run(tmpdir), str(tmpdir))
+    assert runs.shape[0] == len(CHUNKS)
+    assert runs.groupby("plate")["n_imagesets"].sum().tolist() == [360, 360]
+    # the failed command has no costs
+    assert runs["wall_time"].isnull().tolist() == [False] * 11 + [True]
+    with pytest.raises(tune.TuneError):
+        tune.read_runs(make_run(tmpdir), str(tmpdir.mkdir("no_manifest")))
+
+
+def test_commands_log(tmpdir):
+    """cptools2.tune.commands_log(commands_location, logfile_location)"""
+    logfile_location = str(tmpdir.mkdir("logfiles"))
+    commands_location = str(tmpdir.mkdir("commands"))
+    rerun_location = os.path.join(commands_location, "rerun_date")
+    os.makedirs(rerun_location)
+    assert tune.commands_log(commands_location, logfile_location) is None
+    generate_scripts.record_job(commands_location, "job")
+    generate_scripts.record_job(rerun_location, "rerun_job")
+    for job in ["job", "rerun_job"]:
+        with open(os.path.join(logfile_location, job + ".log"), "w") as f:
+            f.write("2020-01-01 12:00  1234  1  Finished  10  100\n")
+    # the rerun's log is the latest, but isn't the log of the commands
+    an_hour_ago = time.time() - 3600
+    os.utime(os.path.join(logfile_location, "job.log"), (an_hour_ago, an_hour_ago))
+    assert tune.latest_log(logfile_location) == \
+        os.path.join(logfile_location, "rerun_job.log")
+    assert tune.commands_log(commands_location, logfile_location) == \
+        os.path.join(logfile_location, "job.log")
+    assert tune.commands_log(rerun_location, logfile_location) == \
+        os.path.join(logfile_location, "rerun_job.log")
+
+
+def test_main_rerun_log(tmpdir):
+    """cptools2.tune.main(argv) with a rerun's log newer than the run's"""
+    log_file = make_run(tmpdir)
+    location = str(tmpdir.mkdir("location"))
+    logfile_location = os.path.join(location, "logfiles")
+    os.makedirs(logfile_location)
+    os.rename(log_file, os.path.join(logfile_location, "job.log"))
+    generate_scripts.record_job(str(tmpdir), "job")
+    # a rerun of the failed command, which is line 1 of its commands
+    rerun_location = str(tmpdir.mkdir("rerun_date"))
+    generate_scripts.record_job(rerun_location, "rerun_job")
+    with open(os.path.join(logfile_location, "rerun_job.log"), "w") as f:
+        f.write("2020-01-02 12:00  1236  1  Finished  1000  {}\n".format(50 * 1024**2))
+    an_hour_ago = time.time() - 3600
+    os.utime(os.path.join(logfile_location, "job.log"), (an_hour_ago, an_hour_ago))
+    config = os.path.join(str(tmpdir), "config.yml")
+    with open(config, "w") as f:
+        f.write("pipeline : {}\nlocation : {}\ncommands location : {}\n"
+                "chunk : 96\n".format(PIPELINE, location, str(tmpdir)))
+    best = tune.main([config, "--concurrency", "8"])
+    expected = tune.recommend(tune.read_runs(
+        os.path.join(logfile_location, "job.log"), str(tmpdir)), concurrency=8)
+    assert best["job_size"] == expected["job_size"] == 90
+    assert best["memory"] == expected["memory"] == "3G"
+
+
+def test_fit_cost():
+    """cptools2.tune.fit_cost(n_imagesets, values)"""
+    fixed, per_imageset = tune.fit_cost([10, 20, 40], [50, 70, 110])
+    assert fixed == pytest.approx(30) and per_imageset == pytest.approx(2)
+    # can't separate the fixed cost with a single chunk size
+    assert tune.fit_cost([10, 10], [50, 50]) == (0.0, 5.0)
+    # neither is negative
+    assert tune.fit_cost([10, 20], [100, 50])[1] == 0.0
+    assert tune.fit_cost([10, 20], [10, 30])[0] == 0.0
+
+
+def test_makespan():
+    """cptools2.tune.makespan(plate_sizes, job_size, concurrency, wall_time_fit)"""
+    # 4 + 4 jobs in two waves of 5, each 30 + 2 * 96 seconds
+    assert tune.makespan([360, 360], 96, 5, (30, 2)) == 2 * 222
+    assert tune.makespan([360, 360], 96, 8, (30, 2), overhead=10) == 232
+
+
+def test_recommend(tmpdir):
+    """cptools2.tune.recommend(runs, concurrency)"""
+    runs = tune.read_runs(make_run(tmpdir), str(tmpdir))
+    best = tune.recommend(runs, concurrency=8)
+    # one job per array task
+    assert best["job_size"] == 90 and best["n_jobs"] == 8
+    assert best["makespan"] == pytest.approx(30 + 2 * 90, rel=0.05)
+    # 1G + 10M * 90 with headroom
+    assert best["memory"] == "3G"
+    # the smallest chunks in a single wave when there's a task per chunk
+    assert tune.recommend(runs, concurrency=1000)["job_size"] == 1
+    limited = tune.recommend(runs, concurrency=8, max_memory="2G")
+    assert limited["memory"] == "2G" and limited["job_size"] < 90
+    assert tune.recommend(runs, concurrency=8,
+                          max_wall_time=150)["job_size"] <= 60
+    with pytest.raises(tune.TuneError):
+        tune.recommend(runs, concurrency=8, max_wall_time=1)
+
+
+def test_apply_recommendation(tmpdir):
+    """cptools2.tune.apply_recommendation(config_file, job_size, memory)"""
+    config_file = os.path.join(str(tmpdir), "config.yml")
+    with open(config_file, "w") as f:
+        f.write("experiment : /path/to/experiment\n"
+                "chunk : 46\n"
+                "location : /path/to/location\n")
+    tune.apply_recommendation(config_file, 90, "3G")
+    with open(config_file) as f:
+        assert f.read() == ("experiment : /path/to/experiment\n"
+                            "chunk : 90\n"
+                            "location : /path/to/location\n"
+                            "analysis memory : 3G\n")
+    tune.apply_recommendation(config_file, 60, "2G")
+    with open(config_file) as f:
+        lines = f.read().splitlines()
+    assert lines[1] == "chunk : 60" and lines[3] == "analysis memory : 2G"
@@ -63,3 +63,19 @@ def test_count_lines_in_file():
     answer2 = utils.count_lines_in_file(path_to_test_file2)
     assert answer1 == expected
     assert answer2 == expected
+
+
+def test_parse_bytes():
+    """cptools2.utils.parse_bytes(size)"""
+    assert utils.parse_bytes(1000) == 1000
+    assert utils.parse_bytes("1000") == 1000
+    assert utils.parse_bytes("2K") == 2048
+    assert utils.parse_bytes("1.5g") == 1.5 * 1024**3
+    assert utils.parse_bytes("500MB") == 500 * 1024**2
+
+
+def test_format_bytes():
+    """cptools2.utils.format_bytes(n_bytes)"""
+    assert utils.format_bytes(512) == "512B"
+    assert utils.format_bytes(1536) == "1.5K"
+    assert utils.format_bytes(3 * 1024**3) == "3.0G"
@@ -0,0 +1,27 @@
+import os
+import pytest
+from cptools2 import commands
+from cptools2 import writer
+
+
+def test_bulk_writer(tmpdir):
+    """cptools2.writer.BulkWriter writes every queued file"""
+    names = [os.path.join(str(tmpdir), "filelist_{}".format(i)) for i in range(50)]
+    with writer.BulkWriter(n_workers=4, max_pending=2) as bulk_writer:
+        for name in names:
+            bulk_writer.submit(commands.write_filelist, ["a", "b"], name)
+    assert bulk_writer.n_written == len(names)
+    for name in names:
+        with open(name) as f:
+            assert f.read() == "a\nb\n"
+
+
+def test_bulk_writer_errors(tmpdir):
+    """cptools2.writer.BulkWriter raises a WriterError if a write fails"""
+    good = os.path.join(str(tmpdir), "good")
+    bad = os.path.join(str(tmpdir), "missing_dir", "bad")
+    with pytest.raises(writer.WriterError):
+        with writer.BulkWriter(n_workers=2) as bulk_writer:
+            bulk_writer.submit(commands.write_filelist, ["a"], bad)
+            bulk_writer.submit(commands.write_filelist, ["a"], good)
+    assert os.path.isfile(good)